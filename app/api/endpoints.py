@@ -1,12 +1,22 @@
 from fastapi import APIRouter, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from app.models.models import ChatRequest, ChatResponse, HistoryResponse, MemoryExtractRequest
 from app.core.llm import llm_service
 from app.core.memory import memory_service
+from app.core.intent import intent_classifier
+from app.core.time_parser import time_parser
+from app.core.summarizer import summarizer
+from app.core.usage import prompt_cache_telemetry
+from app.core.sql_tool import sql_tool
+from app.core.leader import leader_election
+from app.core.embedding_queue import embedding_queue
+from app.db.write_behind import write_behind
+from app.db.conversation_stats import conversation_stats
 from app.config import settings
 import asyncio
+import json
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timedelta
 
 router = APIRouter()
 
@@ -15,6 +25,28 @@ async def get_config():
     """Get public configuration like bot name."""
     return {"bot_name": settings.bot_name}
 
+@router.get("/metrics")
+async def get_metrics():
+    """Internal counters for cache sizing and tuning."""
+    return {
+        "collection_cache": memory_service.collection_cache_stats(),
+        "embedding_cache": memory_service.embedding_function.stats(),
+        "retrieval_cache": memory_service.retrieval_cache_stats(),
+        "intent_router": intent_classifier.stats(),
+        "time_parser": time_parser.stats(),
+        "write_behind": write_behind.stats(),
+        "embedding_queue": embedding_queue.stats(),
+        "summaries": summarizer.stats(),
+        "prompt_cache": prompt_cache_telemetry.stats(),
+        "sql_tool": sql_tool.stats(),
+        "leader": leader_election.stats(),
+    }
+
+@router.get("/metrics/prompt-cache/{user_id}")
+async def get_prompt_cache_metrics(user_id: str):
+    """DeepSeek prompt-cache hit/miss token totals for one user."""
+    return await prompt_cache_telemetry.user_stats(user_id)
+
 @router.get("/avatar")
 async def get_avatar():
     """Get AI avatar image from static directory."""
@@ -34,24 +66,27 @@ async def get_avatar():
     
     return FileResponse(image_files[0])
 
-async def background_save_memory(user_id: str, user_msg: str, ai_msg: str):
-    """Background task to save messages to vector DB (simulate async processing)"""
-    # In a real app, we might want to summarize before adding to vector DB
+def background_save_memory(user_id: str, user_msg: str, ai_msg: str):
+    """
+    Background task to queue messages for the vector DB (L0 Memory).
+    Embedding and Chroma writes happen in micro-batches on the ingest queue's own thread;
+    this only blocks (in Starlette's threadpool) when the queue applies backpressure.
+    """
     # For MVP, we add raw messages to vector DB for retrieval
-    memory_service.add_memory(user_id, f"User: {user_msg}")
-    memory_service.add_memory(user_id, f"{settings.bot_name}: {ai_msg}")
+    embedding_queue.submit(user_id, f"User: {user_msg}")
+    embedding_queue.submit(user_id, f"{settings.bot_name}: {ai_msg}")
 
 @router.post("/chat", response_model=ChatResponse)
 async def chat_endpoint(request: ChatRequest, background_tasks: BackgroundTasks):
     try:
         # 1. Save User Message to DB & Redis
-        memory_service.save_conversation(request.user_id, "user", request.message)
+        await memory_service.save_conversation(request.user_id, "user", request.message)
         
         # 2. Generate AI Response
-        ai_response_text, is_recalling = llm_service.generate_response(request.user_id, request.message, request.context_flags)
+        ai_response_text, is_recalling = await llm_service.generate_response(request.user_id, request.message, request.context_flags)
         
         # 3. Save AI Message to DB & Redis
-        memory_service.save_conversation(request.user_id, "assistant", ai_response_text)
+        await memory_service.save_conversation(request.user_id, "assistant", ai_response_text)
         
         # 4. Add background task to update Vector DB (L0 Memory)
         background_tasks.add_task(background_save_memory, request.user_id, request.message, ai_response_text)
@@ -67,9 +102,85 @@ async def chat_endpoint(request: ChatRequest, background_tasks: BackgroundTasks)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# Appended to a streamed reply that was cut off by a disconnect or an error
+PARTIAL_REPLY_MARK = "……"
+
+def _sse(event: str, data: dict) -> str:
+    """Format a single Server-Sent Events frame."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@router.post("/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest):
+    """
+    Stream the AI reply as Server-Sent Events.
+    Events: "recalling" (retrieval route chosen), "token" (incremental text),
+    "done" (final text + display time; "interrupted" if the model failed mid-reply), "error".
+    A reply cut off by a disconnect or an error is still saved, with PARTIAL_REPLY_MARK appended.
+    """
+    # 1. Save User Message to DB & Redis
+    await memory_service.save_conversation(request.user_id, "user", request.message)
+
+    # Vector DB update runs after the stream closes (same as /chat background task)
+    background_tasks = BackgroundTasks()
+
+    async def event_stream():
+        chunks = []
+        saved = False
+        try:
+            async for event in llm_service.stream_response(request.user_id, request.message, request.context_flags):
+                if event["event"] == "recalling":
+                    yield _sse("recalling", {})
+                elif event["event"] == "token":
+                    chunks.append(event["content"])
+                    yield _sse("token", {"content": event["content"]})
+                elif event["event"] == "done":
+                    ai_response_text = event["response"]
+                    # The model failed mid-reply: store it marked as cut off, like a disconnect
+                    saved_text = ai_response_text + PARTIAL_REPLY_MARK if event["interrupted"] else ai_response_text
+
+                    # 2. Persist the final assistant message once generation finished
+                    saved = True
+                    await asyncio.shield(memory_service.save_conversation(request.user_id, "assistant", saved_text))
+                    background_tasks.add_task(background_save_memory, request.user_id, request.message, saved_text)
+
+                    yield _sse("done", {
+                        "response": ai_response_text,
+                        "is_recalling": event["is_recalling"],
+                        "interrupted": event["interrupted"],
+                        "timestamp_display": datetime.now().strftime("%H:%M")
+                    })
+        except Exception as e:
+            print(f"Chat stream error: {e}")
+            yield _sse("error", {"detail": str(e)})
+        finally:
+            # Client disconnected (CancelledError / GeneratorExit) or the stream failed before "done":
+            # keep what the user already saw, marked as cut off
+            if not saved and chunks:
+                saved = True
+                partial_text = "".join(chunks) + PARTIAL_REPLY_MARK
+                print(f"[stream] persisting partial reply for {request.user_id} ({len(partial_text)} chars)")
+                try:
+                    # Shielded: a disconnect cancels this task, but the write must still land
+                    await asyncio.shield(memory_service.save_conversation(request.user_id, "assistant", partial_text))
+                except Exception as e:
+                    print(f"[stream] failed to persist partial reply: {e}")
+                # The response's background tasks don't run after a disconnect: queue the fragment here,
+                # off the event loop (submit blocks under queue backpressure)
+                try:
+                    await asyncio.shield(asyncio.to_thread(background_save_memory, request.user_id, request.message, partial_text))
+                except Exception as e:
+                    print(f"[stream] failed to queue partial reply memory: {e}")
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=background_tasks
+    )
+
 @router.get("/history/{user_id}", response_model=list[HistoryResponse])
 async def get_history(user_id: str):
-    history = memory_service.get_recent_history(user_id)
+    history = await memory_service.get_recent_history(user_id)
     
     formatted_history = []
     for h in history:
@@ -103,10 +214,22 @@ async def get_history(user_id: str):
         
     return formatted_history
 
+@router.get("/stats/{user_id}")
+async def get_stats(user_id: str):
+    """Conversation stats from the rollup tables: totals, first/last message, last 7 days, hour histogram."""
+    today = datetime.now().date()
+    week_start = (today - timedelta(days=6)).isoformat()
+    overview, daily, hours = await asyncio.gather(
+        asyncio.to_thread(conversation_stats.overview, user_id),
+        asyncio.to_thread(conversation_stats.daily_counts, user_id, week_start, today.isoformat()),
+        asyncio.to_thread(conversation_stats.hour_histogram, user_id),
+    )
+    return {"overview": overview, "daily": daily, "hours": hours}
+
 @router.delete("/memory/{user_id}")
 async def delete_memory(user_id: str):
     try:
-        memory_service.delete_user_memory(user_id)
+        await memory_service.delete_user_memory(user_id)
         return {"status": "success", "message": "Memory deleted successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
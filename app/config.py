@@ -1,5 +1,8 @@
+import hashlib
 import json
 import os
+import threading
+import time
 import yaml
 from pathlib import Path
 
@@ -11,13 +14,127 @@ class Config:
         self.prompt_yaml_path = BASE_DIR / "prompt.yaml"
         self.prompt_json_path = BASE_DIR / "prompt.json"
         self.chroma_path = BASE_DIR / "chroma_db"
+        # "persistent": embedded store in chroma_path (one process only).
+        # "http": a Chroma server (e.g. `chroma run --path ./chroma_db`), shared by all workers/hosts
+        self.chroma_mode = os.getenv("CHROMA_MODE", "persistent")
+        self.chroma_host = os.getenv("CHROMA_HOST", "localhost")
+        self.chroma_port = int(os.getenv("CHROMA_PORT", 8001))
+        self.chroma_collection_cache_size = int(os.getenv("CHROMA_COLLECTION_CACHE_SIZE", 256))  # ~ active users
+        
+        # Background embedding ingest queue (app/core/embedding_queue.py)
+        self.embedding_queue_max_depth = int(os.getenv("EMBEDDING_QUEUE_MAX_DEPTH", 2000))
+        self.embedding_queue_put_timeout = float(os.getenv("EMBEDDING_QUEUE_PUT_TIMEOUT", 2.0))
+        self.embedding_batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", 64))
+        self.embedding_batch_window = float(os.getenv("EMBEDDING_BATCH_WINDOW", 0.5))
+        self.embedding_drain_timeout = float(os.getenv("EMBEDDING_DRAIN_TIMEOUT", 10.0))
+        self.embedding_journal_path = BASE_DIR / "embedding_journal.jsonl"
+        
+        # Embedding cache (content hash -> vector) and per-user retrieval result cache
+        self.embedding_cache_local_size = int(os.getenv("EMBEDDING_CACHE_LOCAL_SIZE", 4096))
+        self.embedding_cache_ttl = int(os.getenv("EMBEDDING_CACHE_TTL", 30 * 24 * 3600))
+        self.retrieval_cache_size = int(os.getenv("RETRIEVAL_CACHE_SIZE", 1024))
+        self.retrieval_cache_ttl = float(os.getenv("RETRIEVAL_CACHE_TTL", 300))
         self.sqlite_path = BASE_DIR / "app.db"
         
+        # Serving: uvicorn worker processes on this host. A Redis lock elects the one instance
+        # (across workers and hosts) that runs the summary scheduler (app/core/leader.py); the
+        # lock expires if its holder dies. On by default: workers started outside main.py
+        # (uvicorn main:app --workers N) can't tell they aren't alone, and a single process
+        # wins the lock on its first attempt. LEADER_ELECTION=0 only for one process without Redis
+        self.host = os.getenv("HOST", "127.0.0.1")
+        self.port = int(os.getenv("PORT", 8000))
+        self.web_workers = int(os.getenv("WEB_WORKERS", 1))
+        self.leader_election = os.getenv("LEADER_ELECTION", "1") == "1"
+        self.leader_lock_key = os.getenv("LEADER_LOCK_KEY", "scheduler:leader")
+        self.leader_lock_ttl_ms = int(os.getenv("LEADER_LOCK_TTL_MS", 30000))
+        self.leader_renew_interval = float(os.getenv("LEADER_RENEW_INTERVAL", 10.0))
+        
+        # SQLite tuning (see app/db/sqlite.py ConnectionManager)
+        self.sqlite_cache_size_kb = int(os.getenv("SQLITE_CACHE_SIZE_KB", 20000))  # ~20MB page cache per connection
+        self.sqlite_mmap_size = int(os.getenv("SQLITE_MMAP_SIZE", 268435456))  # 256MB memory-mapped I/O
+        self.sqlite_busy_timeout_ms = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))
+        self.sqlite_migration_busy_timeout_ms = int(os.getenv("SQLITE_MIGRATION_BUSY_TIMEOUT_MS", 30 * 60 * 1000))  # startup only
+        
+        # Sandbox for intent-generated SQL (app/core/sql_tool.py)
+        self.sql_tool_timeout = float(os.getenv("SQL_TOOL_TIMEOUT", 1.0))  # seconds per query
+        self.sql_tool_max_rows = int(os.getenv("SQL_TOOL_MAX_ROWS", 50))
+        self.sql_tool_cache_size = int(os.getenv("SQL_TOOL_CACHE_SIZE", 256))
+        self.sql_tool_cache_ttl = float(os.getenv("SQL_TOOL_CACHE_TTL", 30))
+        
+        # Write-behind batching for conversation/timeline inserts (app/db/write_behind.py)
+        self.write_behind_batch_size = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", 200))
+        self.write_behind_flush_interval = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", 0.5))
+        self.write_behind_failed_path = BASE_DIR / "write_behind_failed.jsonl"  # rows dropped after repeated failures
+        
+        # Redis short-term session cache (read-through for recent history)
+        self.redis_session_size = int(os.getenv("REDIS_SESSION_SIZE", 20))
+        self.redis_session_ttl = int(os.getenv("REDIS_SESSION_TTL", 7 * 24 * 3600))
+        # How long a user deletion stays visible to other workers (app/db/user_tombstones.py)
+        self.user_tombstone_ttl = int(os.getenv("USER_TOMBSTONE_TTL", 30 * 24 * 3600))
+        
+        # Local intent router: decisions at/above this confidence skip the LLM router
+        self.intent_local_confidence = float(os.getenv("INTENT_LOCAL_CONFIDENCE", 0.8))
+        
+        # Summary jobs (app/core/summarizer.py): worker pool size and provider rate limits
+        self.summary_concurrency = int(os.getenv("SUMMARY_CONCURRENCY", 8))
+        self.summary_rpm = int(os.getenv("SUMMARY_RPM", 60))
+        self.summary_tpm = int(os.getenv("SUMMARY_TPM", 300000))
+        self.summary_max_retries = int(os.getenv("SUMMARY_MAX_RETRIES", 4))
+        self.summary_retry_base_delay = float(os.getenv("SUMMARY_RETRY_BASE_DELAY", 2.0))
+        self.summary_start_jitter = float(os.getenv("SUMMARY_START_JITTER", 1.0))
+        # A 'running' ledger claim older than this (seconds) is assumed dead and taken over
+        self.summary_claim_timeout = int(os.getenv("SUMMARY_CLAIM_TIMEOUT", 1800))
+        # Map-reduce windows: input per LLM call stays under summary_window_tokens
+        self.summary_window_tokens = int(os.getenv("SUMMARY_WINDOW_TOKENS", 24000))
+        self.summary_map_concurrency = int(os.getenv("SUMMARY_MAP_CONCURRENCY", 4))
+        self.summary_page_size = int(os.getenv("SUMMARY_PAGE_SIZE", 500))
+        
+        # Prompt assembly (app/core/prompt_builder.py): total input budget per chat turn,
+        # and the share of what's left after persona/flags/message reserved for history
+        self.prompt_token_budget = int(os.getenv("PROMPT_TOKEN_BUDGET", 6000))
+        self.prompt_history_share = float(os.getenv("PROMPT_HISTORY_SHARE", 0.4))
+        self.tokenizer_path = os.getenv("TOKENIZER_PATH")  # optional tokenizer.json for exact counts
+        
+        # Timeline retrieval planner (app/core/timeline_planner.py): ranges at least this many
+        # days long are answered from yearly / monthly summaries; keyword hits in raw messages
+        # are read for short ranges (timeline_raw_limit) and, fewer, for wider ones
+        # (timeline_wide_raw_limit). Days no summary covers fall back to raw messages
+        # (up to timeline_gap_raw_limit rows in total)
+        self.timeline_year_days = int(os.getenv("TIMELINE_YEAR_DAYS", 180))
+        self.timeline_month_days = int(os.getenv("TIMELINE_MONTH_DAYS", 28))
+        self.timeline_raw_days = int(os.getenv("TIMELINE_RAW_DAYS", 14))
+        self.timeline_raw_limit = int(os.getenv("TIMELINE_RAW_LIMIT", 20))
+        self.timeline_wide_raw_limit = int(os.getenv("TIMELINE_WIDE_RAW_LIMIT", 8))
+        self.timeline_gap_raw_limit = int(os.getenv("TIMELINE_GAP_RAW_LIMIT", 20))
+        
+        # Memoized time-range parses, keyed by (normalized phrase, date)
+        self.time_parse_memo_size = int(os.getenv("TIME_PARSE_MEMO_SIZE", 1024))
+        
+        # Per-source retrieval deadlines in seconds (app/core/retrieval.py).
+        # A source that misses its deadline is dropped for this turn.
+        self.retrieval_deadlines = {
+            "history": 1.0,
+            "vector": 2.0,
+            "keyword": 1.0,
+            "sql": 2.0,
+            "time_parse": 3.0,
+            "timeline": 1.0,
+            "summaries": 1.0,
+            "entities": 0.5,
+        }
+        
         self.api_key = ""
         self.api_base = ""
         self.bot_name = "Yuki"  # Default
         self.system_prompt = ""
         self.memory_extraction_prompt = ""
+        self.persona_prompt = ""  # system_prompt with {name} substituted
+        self.prompt_version = 0
+        self.prompt_reload_interval = float(os.getenv("PROMPT_RELOAD_INTERVAL", 2.0))
+        self._prompt_lock = threading.Lock()
+        self._prompt_checked_at = 0.0
+        self._prompt_signature = None
+        self._prompt_hash = None
         
         self.load_api_config()
         self.load_prompts()
@@ -30,28 +147,56 @@ class Config:
                 self.api_base = data.get("api_base", "https://api.deepseek.com")
 
     def load_prompts(self):
-        # Try YAML first
-        if self.prompt_yaml_path.exists():
-            try:
-                with open(self.prompt_yaml_path, "r", encoding="utf-8") as f:
-                    data = yaml.safe_load(f)
-                    self.bot_name = data.get("name", "Yuki")
-                    self.system_prompt = data.get("system_prompt", "")
-                    self.memory_extraction_prompt = data.get("memory_extraction_prompt", "")
-                return
-            except Exception as e:
-                print(f"Error loading prompt.yaml: {e}")
-
-        # Fallback to JSON
-        if self.prompt_json_path.exists():
-            with open(self.prompt_json_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
+        """
+        Load prompt.yaml (falling back to prompt.json) and precompute the persona prompt.
+        Skips parsing when the file content hash matches the loaded version.
+        """
+        with self._prompt_lock:
+            self._prompt_signature = self._prompt_file_signature()
+            self._prompt_checked_at = time.monotonic()
+            for path, parse in ((self.prompt_yaml_path, yaml.safe_load), (self.prompt_json_path, json.loads)):
+                if not path.exists():
+                    continue
+                try:
+                    raw = path.read_bytes()
+                    digest = hashlib.sha1(raw).hexdigest()
+                    if digest == self._prompt_hash:
+                        return
+                    data = parse(raw.decode("utf-8"))
+                except Exception as e:
+                    print(f"Error loading {path.name}: {e}")
+                    continue
                 self.bot_name = data.get("name", "Yuki")
                 self.system_prompt = data.get("system_prompt", "")
                 self.memory_extraction_prompt = data.get("memory_extraction_prompt", "")
+                # Formatted once per version; the chat path uses it as-is (byte-stable prefix)
+                self.persona_prompt = self.system_prompt.replace("{name}", self.bot_name)
+                self._prompt_hash = digest
+                self.prompt_version += 1
+                if self.prompt_version > 1:
+                    print(f"Reloaded prompts from {path.name} (version {self.prompt_version})")
+                return
 
     def reload_prompts(self):
-        """Reload prompts from file dynamically"""
-        self.load_prompts()
+        """
+        Hot-reload check for the chat path. Stats the prompt files at most every
+        prompt_reload_interval seconds and only re-reads them when mtime/size changed.
+        """
+        now = time.monotonic()
+        if now - self._prompt_checked_at < self.prompt_reload_interval:
+            return
+        self._prompt_checked_at = now
+        if self._prompt_file_signature() != self._prompt_signature:
+            self.load_prompts()
+
+    def _prompt_file_signature(self) -> tuple:
+        signature = []
+        for path in (self.prompt_yaml_path, self.prompt_json_path):
+            try:
+                stat = path.stat()
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
 
 settings = Config()
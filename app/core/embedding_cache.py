@@ -0,0 +1,102 @@
+import base64
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+from app.config import settings
+from app.core.text import normalize_text
+from app.db.redis_client import redis_client
+
+def content_hash(text: str) -> str:
+    return hashlib.sha1(normalize_text(text).encode("utf-8")).hexdigest()
+
+def _encode_vector(vector: list) -> str:
+    return base64.b64encode(array("f", vector).tobytes()).decode("ascii")
+
+def _decode_vector(raw: str) -> list:
+    values = array("f")
+    values.frombytes(base64.b64decode(raw))
+    return values.tolist()
+
+class CachedEmbeddingFunction:
+    """
+    Embedding function wrapper keyed by normalized content hash.
+    Lookups go: in-process LRU -> Redis (shared across workers, with TTL) -> model.
+    Repeated lines ("晚安", "在吗") are embedded once. Redis errors only cost a cache miss.
+    """
+    def __init__(self, base_function, model_name: str = "all-MiniLM-L6-v2"):
+        self.base_function = base_function
+        self.key_prefix = f"emb:{model_name}:"
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"local_hits": 0, "redis_hits": 0, "misses": 0}
+
+    def __call__(self, texts: list) -> list:
+        keys = [content_hash(text) for text in texts]
+        vectors = {}
+
+        # 1. In-process LRU
+        with self._lock:
+            for key in keys:
+                if key in self._local and key not in vectors:
+                    self._local.move_to_end(key)
+                    vectors[key] = self._local[key]
+                    self._stats["local_hits"] += 1
+
+        # 2. Redis
+        missing = [key for key in dict.fromkeys(keys) if key not in vectors]
+        if missing:
+            try:
+                for key, raw in zip(missing, redis_client.mget([self.key_prefix + key for key in missing])):
+                    if raw:
+                        vectors[key] = _decode_vector(raw)
+                        self._remember(key, vectors[key])
+                        self._bump("redis_hits")
+            except Exception as e:
+                print(f"Embedding cache read error: {e}")
+
+        # 3. Model, one pass for everything still missing (first original text per key)
+        to_embed = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors and key not in to_embed:
+                to_embed[key] = text
+        if to_embed:
+            computed = self.base_function(list(to_embed.values()))
+            fresh = {}
+            for key, vector in zip(to_embed.keys(), computed):
+                vectors[key] = list(map(float, vector))
+                fresh[key] = vectors[key]
+                self._remember(key, vectors[key])
+            with self._lock:
+                self._stats["misses"] += len(fresh)
+            self._store(fresh)
+
+        return [vectors[key] for key in keys]
+
+    def _remember(self, key: str, vector: list):
+        with self._lock:
+            self._local[key] = vector
+            self._local.move_to_end(key)
+            while len(self._local) > settings.embedding_cache_local_size:
+                self._local.popitem(last=False)
+
+    def _store(self, fresh: dict):
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            for key, vector in fresh.items():
+                pipe.set(self.key_prefix + key, _encode_vector(vector), ex=settings.embedding_cache_ttl)
+            pipe.execute()
+        except Exception as e:
+            print(f"Embedding cache write error: {e}")
+
+    def _bump(self, key: str):
+        with self._lock:
+            self._stats[key] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["local_size"] = len(self._local)
+        lookups = stats["local_hits"] + stats["redis_hits"] + stats["misses"]
+        stats["hit_rate"] = ((stats["local_hits"] + stats["redis_hits"]) / lookups) if lookups else 0.0
+        return stats
@@ -0,0 +1,307 @@
+import glob
+import json
+import os
+import queue
+import threading
+import time
+from app.config import settings
+from app.core.memory import memory_service
+from app.db.user_tombstones import user_tombstones
+
+class EmbeddingIngestQueue:
+    """
+    Dedicated ingest pipeline for L0 vector memories.
+    Fragments from all turns and users are gathered into micro-batches, embedded in
+    one pass, and written with one collection.upsert() per user collection per flush.
+    The queue is bounded: producers wait briefly when it is full (backpressure) and
+    spill to the on-disk journal if it stays full. On shutdown the queue is drained
+    within a deadline and whatever is left is journaled and replayed on next start.
+    Deleting a user discards their fragments from the queue, the journal and the batch
+    being flushed (discard_user), so the deleted memories don't come back; fragments
+    queued in other workers are dropped at flush time by the user's tombstone.
+    """
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=settings.embedding_queue_max_depth)
+        self._thread = None
+        self._running = False
+        self._journal_lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # held while a batch is embedded and written
+        self._deleted_users = {}  # user_id -> time.time() of the deletion
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "submitted": 0,
+            "embedded": 0,
+            "batches": 0,
+            "blocked": 0,     # submit() found the queue full and had to wait
+            "journaled": 0,   # spilled to disk (queue full / flush failure / shutdown)
+            "discarded": 0,   # dropped because their user was deleted
+            "write_errors": 0,  # per-user collection writes that failed (fragments journaled)
+            "max_depth": 0,
+        }
+        memory_service.on_user_deleted(self.discard_user)
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._replay_journal()
+        self._thread = threading.Thread(target=self._run, name="embedding-ingest", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None):
+        """Stop the worker, drain what we can within `timeout`, journal the rest."""
+        timeout = settings.embedding_drain_timeout if timeout is None else timeout
+        self._running = False
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+        leftover = self._take_all()
+        if leftover:
+            try:
+                self._flush(leftover)
+                leftover = []
+            except Exception as e:
+                print(f"Embedding drain error: {e}")
+        if leftover:
+            self._journal(leftover)
+        print(f"Embedding ingest stopped: {self.stats()}")
+
+    def submit(self, user_id: str, content: str, metadata: dict = None) -> bool:
+        """Queue a memory fragment. Returns False if it had to be journaled instead."""
+        item = {
+            "user_id": user_id,
+            "content": content,
+            "metadata": metadata or {"timestamp": time.time()},
+            "id": f"{user_id}_{time.time_ns()}",
+            "submitted_at": time.time(),
+        }
+        self._bump("submitted")
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self._bump("blocked")
+            try:
+                self._queue.put(item, timeout=settings.embedding_queue_put_timeout)
+            except queue.Full:
+                self._journal([item])
+                return False
+        with self._stats_lock:
+            self._stats["max_depth"] = max(self._stats["max_depth"], self._queue.qsize())
+        return True
+
+    def _run(self):
+        while self._running:
+            batch = self._collect_batch()
+            if not batch:
+                continue
+            try:
+                self._flush(batch)
+            except Exception as e:
+                print(f"Embedding flush error ({len(batch)} fragments): {e}")
+                self._journal(batch)
+
+    def _collect_batch(self) -> list:
+        """Block for the first fragment, then gather more until batch size or window elapses."""
+        try:
+            batch = [self._queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + settings.embedding_batch_window
+        while len(batch) < settings.embedding_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _take_all(self) -> list:
+        items = []
+        while True:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                return items
+
+    def _flush(self, batch: list):
+        with self._flush_lock:
+            # Deleted here (discard_user) or by another worker (tombstone in Redis)
+            deleted = user_tombstones.deleted_at(item["user_id"] for item in batch)
+            batch = [
+                item for item in batch
+                if not self._is_discarded(item)
+                and not user_tombstones.is_stale(item.get("submitted_at", 0), deleted.get(item["user_id"]))
+            ]
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch: list):
+        # One embedding pass for the whole batch, across users
+        embeddings = memory_service.embed([item["content"] for item in batch])
+
+        by_user = {}
+        for item, embedding in zip(batch, embeddings):
+            by_user.setdefault(item["user_id"], []).append((item, embedding))
+
+        # One upsert per collection; a failing user only journals their own fragments
+        # (upsert by id, so replaying ones that did land is harmless)
+        embedded = 0
+        for user_id, entries in by_user.items():
+            try:
+                memory_service.add_memories(
+                    user_id,
+                    documents=[item["content"] for item, _ in entries],
+                    metadatas=[item["metadata"] for item, _ in entries],
+                    ids=[item["id"] for item, _ in entries],
+                    embeddings=[embedding for _, embedding in entries],
+                )
+            except Exception as e:
+                print(f"Embedding write error for {user_id} ({len(entries)} fragments): {e}")
+                self._bump("write_errors")
+                self._journal([item for item, _ in entries])
+                continue
+            embedded += len(entries)
+
+        with self._stats_lock:
+            self._stats["embedded"] += embedded
+            self._stats["batches"] += 1
+
+    # --- Journal (JSONL) ---
+
+    def _journal(self, items: list):
+        items = [item for item in items if not self._is_discarded(item)]
+        if not items:
+            return
+        with self._journal_lock:
+            with open(settings.embedding_journal_path, "a", encoding="utf-8") as f:
+                for item in items:
+                    f.write(json.dumps(item, ensure_ascii=False) + "\n")
+        with self._stats_lock:
+            self._stats["journaled"] += len(items)
+        print(f"Journaled {len(items)} pending memory fragments to {settings.embedding_journal_path}")
+
+    def _replay_journal(self):
+        """
+        Re-ingest fragments journaled by a previous run, and replay files orphaned by a
+        process that died mid-replay. Fragment ids are kept, so one replayed twice isn't duplicated.
+        """
+        path = str(settings.embedding_journal_path)
+        # Each file is claimed by renaming it to a per-process replay file: with several
+        # workers starting at once, exactly one wins each rename
+        claimed = []
+        with self._journal_lock:
+            for source in [path, *_replay_files(path)]:
+                if source != path and _replay_owner_running(path, source):
+                    continue
+                replay_path = f"{path}.{os.getpid()}.{len(claimed)}.replay"
+                try:
+                    os.replace(source, replay_path)
+                except FileNotFoundError:
+                    continue
+                claimed.append(replay_path)
+
+        for replay_path in claimed:
+            items = []
+            with open(replay_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        items.append(json.loads(line))
+            print(f"Replaying {len(items)} journaled memory fragments")
+            for start in range(0, len(items), settings.embedding_batch_size):
+                batch = items[start:start + settings.embedding_batch_size]
+                try:
+                    self._flush(batch)
+                except Exception as e:
+                    print(f"Embedding replay error: {e}")
+                    self._journal(batch)
+            os.remove(replay_path)
+
+    # --- User deletion ---
+
+    def discard_user(self, user_id: str):
+        """
+        Drop a deleted user's pending fragments: queued, journaled, and in the batch being
+        flushed (waits for it). Fragments submitted after this call are kept.
+        """
+        with self._flush_lock:
+            self._deleted_users[user_id] = time.time()
+            kept = []
+            discarded = 0
+            for item in self._take_all():
+                if item["user_id"] == user_id:
+                    discarded += 1
+                else:
+                    kept.append(item)
+            for item in kept:
+                try:
+                    self._queue.put_nowait(item)
+                except queue.Full:
+                    # Producers refilled the queue meanwhile
+                    self._journal([item])
+        discarded += self._discard_from_journal(user_id)
+        with self._stats_lock:
+            self._stats["discarded"] += discarded
+        print(f"Discarded {discarded} pending memory fragments of deleted user {user_id}")
+
+    def _is_discarded(self, item: dict) -> bool:
+        deleted_at = self._deleted_users.get(item["user_id"])
+        return deleted_at is not None and item.get("submitted_at", 0) <= deleted_at
+
+    def _discard_from_journal(self, user_id: str) -> int:
+        """Rewrite the journal and any replay files without the user's fragments."""
+        path = str(settings.embedding_journal_path)
+        discarded = 0
+        with self._journal_lock:
+            for journal_path in [path, *_replay_files(path)]:
+                try:
+                    with open(journal_path, "r", encoding="utf-8") as f:
+                        lines = [line for line in f if line.strip()]
+                except FileNotFoundError:
+                    continue
+                kept = [line for line in lines if json.loads(line)["user_id"] != user_id]
+                if len(kept) == len(lines):
+                    continue
+                tmp_path = f"{journal_path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.writelines(kept)
+                os.replace(tmp_path, journal_path)
+                discarded += len(lines) - len(kept)
+        return discarded
+
+    def _bump(self, key: str):
+        with self._stats_lock:
+            self._stats[key] += 1
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["depth"] = self._queue.qsize()
+        stats["capacity"] = settings.embedding_queue_max_depth
+        return stats
+
+def _replay_files(journal_path: str) -> list:
+    """Replay files next to the journal, including the pre-worker {journal}.replay name."""
+    legacy = f"{journal_path}.replay"
+    files = glob.glob(f"{glob.escape(journal_path)}.*.replay")
+    return files + [legacy] if os.path.exists(legacy) else files
+
+def _replay_owner_running(journal_path: str, replay_path: str) -> bool:
+    """
+    Whether the process that named a replay file ({journal}.{pid}[.n].replay) is still
+    running it. Only checked on POSIX; elsewhere the file is treated as orphaned.
+    """
+    pid = replay_path[len(journal_path) + 1:].split(".")[0]
+    if os.name != "posix" or not pid.isdigit() or int(pid) == os.getpid():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+embedding_queue = EmbeddingIngestQueue()
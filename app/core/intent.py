@@ -0,0 +1,118 @@
+import re
+import threading
+import time
+from app.config import settings
+
+# Lexicons for the local fast-path router. Matching is substring-based on the
+# lower-cased message, which is fine for Chinese (no word boundaries) and English cues.
+RECALL_CUES = [
+    "记得", "记不记得", "忘了吗", "忘记了吗", "上次", "那次", "那天", "之前", "以前",
+    "说过", "聊过", "提过", "讲过", "告诉过", "问过", "当时", "那个故事", "那件事",
+    "聊了什么", "说了什么", "聊了啥", "说了啥",
+    "remember", "last time", "you said", "we talked", "i told you", "mentioned",
+]
+TIME_CUES = [
+    "昨天", "前天", "大前天", "上周", "上星期", "上个星期", "上礼拜", "上个礼拜", "这周", "本周",
+    "上个月", "上月", "这个月", "本月", "去年", "前年", "今年", "最近", "前几天", "周末",
+    "yesterday", "last week", "last month", "last year", "this week", "this month", "ago",
+]
+STATS_CUES = [
+    "第一次", "多少条", "多少次", "多少句", "多少天", "几条", "几次", "几句", "一共", "总共",
+    "聊了多久", "认识多久", "几点", "什么时候开始", "最后一次", "最早",
+    "how many", "how often", "first time", "first message", "how long",
+]
+# Explicit dates and "N天前 / N周前 / N个月前 / N年前"
+TIME_PATTERNS = [
+    re.compile(r"\d{4}[-/.年]\d{1,2}"),
+    re.compile(r"\d{1,2}月\d{1,2}[日号]?"),
+    re.compile(r"[\d一二两三四五六七八九十几]+\s*(天|日|周|星期|礼拜|个月|月|年)前"),
+    re.compile(r"\b\d+\s+(days?|weeks?|months?|years?)\s+ago\b"),
+]
+
+def has_time_cue(text: str) -> bool:
+    """True if the message mentions a relative or absolute time expression."""
+    lowered = text.lower()
+    return any(cue in lowered for cue in TIME_CUES) or any(p.search(lowered) for p in TIME_PATTERNS)
+
+class LocalIntentClassifier:
+    """
+    Rule-based intent router that runs before the LLM router.
+    Returns an intent dict shaped like the LLM router's JSON plus "confidence" and "source".
+    Only decisions at or above settings.intent_local_confidence are used; anything
+    less confident falls back to the LLM router.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._total = 0
+        self._local = 0
+        self._fallback = 0
+        self._by_intent = {}
+
+    def classify(self, message: str) -> dict:
+        started = time.perf_counter()
+        text = message.strip().lower()
+
+        has_recall = any(cue in text for cue in RECALL_CUES)
+        has_time = has_time_cue(text)
+        has_stats = any(cue in text for cue in STATS_CUES)
+
+        if has_stats:
+            # Stats questions need generated SQL from the LLM router
+            intent_type, confidence, reason = "sql_query", 0.4, "stats cue"
+        elif has_recall and has_time:
+            # Time range + content: the LLM router extracts search keywords
+            intent_type, confidence, reason = "hybrid_timeline", 0.5, "recall + time cue"
+        elif has_recall:
+            # Pure recall ("还记得我们聊过的那部电影吗"): vector search on the message itself
+            intent_type, confidence, reason = "vector_search", 0.85, "recall cue"
+        elif has_time:
+            # "昨天好累" is usually chat, "昨天我们干嘛了" is not - let the LLM decide
+            intent_type, confidence, reason = "chat", 0.6, "time cue without recall"
+        elif len(text) <= 80:
+            intent_type, confidence, reason = "chat", 0.95, "no retrieval cue"
+        else:
+            # Long messages may reference past topics without an explicit cue
+            intent_type, confidence, reason = "chat", 0.75, "long message, no cue"
+
+        return {
+            "intent_type": intent_type,
+            "search_keywords": [],
+            "confidence": confidence,
+            "reason": reason,
+            "has_time_cue": has_time,
+            "source": "local",
+            "elapsed_us": int((time.perf_counter() - started) * 1_000_000),
+        }
+
+    def is_confident(self, decision: dict) -> bool:
+        return decision["confidence"] >= settings.intent_local_confidence
+
+    def record(self, decision: dict, used_local: bool, final_intent: str = None):
+        """Log the routing decision and update fallback-rate counters."""
+        final_intent = final_intent or decision["intent_type"]
+        with self._lock:
+            self._total += 1
+            if used_local:
+                self._local += 1
+            else:
+                self._fallback += 1
+            self._by_intent[final_intent] = self._by_intent.get(final_intent, 0) + 1
+            fallback_rate = self._fallback / self._total
+
+        print(
+            f"[intent] local={decision['intent_type']} conf={decision['confidence']:.2f} "
+            f"({decision['reason']}, {decision['elapsed_us']}us) -> "
+            f"{'local' if used_local else 'llm'}:{final_intent} | fallback_rate={fallback_rate:.1%}"
+        )
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "total": self._total,
+                "local": self._local,
+                "llm_fallback": self._fallback,
+                "fallback_rate": (self._fallback / self._total) if self._total else 0.0,
+                "by_intent": dict(self._by_intent),
+            }
+
+intent_classifier = LocalIntentClassifier()
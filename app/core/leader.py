@@ -0,0 +1,122 @@
+import os
+import socket
+import threading
+import uuid
+import redis
+from app.config import settings
+from app.db.redis_client import redis_client
+
+# Extend / release the lock only if we still hold it (another instance may own it by now)
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+class LeaderElection:
+    """
+    One leader among all workers and hosts, elected with a Redis lock
+    (SET key instance_id NX PX ttl). The leader renews the lock every
+    settings.leader_renew_interval; if it dies, the lock expires and another
+    instance takes over on its next attempt. Followers keep trying.
+    With settings.leader_election off (one process, no Redis) this instance is always leader.
+    on_elected callbacks run in the election thread each time leadership is gained.
+    """
+    def __init__(self):
+        self.instance_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._is_leader = False
+        self._callbacks = []
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {"elected": 0, "lost": 0, "errors": 0}
+        self._renew = redis_client.register_script(RENEW_SCRIPT)
+        self._release = redis_client.register_script(RELEASE_SCRIPT)
+
+    @property
+    def is_leader(self) -> bool:
+        return self._is_leader
+
+    def on_elected(self, callback):
+        self._callbacks.append(callback)
+
+    def start(self):
+        if self._thread:
+            return
+        if not settings.leader_election:
+            self._set_leader(True)
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="leader-election", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop campaigning and hand the lock over right away instead of waiting for it to expire."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
+        if settings.leader_election and self._is_leader:
+            try:
+                self._release(keys=[settings.leader_lock_key], args=[self.instance_id])
+            except redis.RedisError as e:
+                print(f"[leader] release failed: {e}")
+        self._is_leader = False
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._campaign()
+            self._stop.wait(settings.leader_renew_interval)
+
+    def _campaign(self):
+        key, ttl = settings.leader_lock_key, settings.leader_lock_ttl_ms
+        try:
+            # Renew first: also recovers a lock we still hold after stepping down on an error
+            held = bool(self._renew(keys=[key], args=[self.instance_id, ttl])) or \
+                bool(redis_client.set(key, self.instance_id, nx=True, px=ttl))
+        except redis.RedisError as e:
+            # Can't prove we still hold the lock: step down rather than risk two leaders
+            with self._lock:
+                self._stats["errors"] += 1
+            print(f"[leader] Redis error: {e}")
+            held = False
+        self._set_leader(held)
+
+    def _set_leader(self, held: bool):
+        if held == self._is_leader:
+            return
+        self._is_leader = held
+        with self._lock:
+            self._stats["elected" if held else "lost"] += 1
+        print(f"[leader] {self.instance_id} {'is now the leader' if held else 'lost leadership'}")
+        if held:
+            for callback in self._callbacks:
+                try:
+                    callback()
+                except Exception as e:
+                    print(f"[leader] on_elected callback error: {e}")
+
+    def guard(self, job):
+        """Wrap a scheduled job so it only runs on the leader."""
+        def run_if_leader(*args, **kwargs):
+            if not self._is_leader:
+                print(f"[leader] skipping {job.__name__}: not the leader")
+                return None
+            return job(*args, **kwargs)
+        run_if_leader.__name__ = job.__name__
+        return run_if_leader
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update({"instance_id": self.instance_id, "is_leader": self._is_leader, "enabled": settings.leader_election})
+        return stats
+
+leader_election = LeaderElection()
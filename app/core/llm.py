@@ -1,37 +1,21 @@
+import asyncio
+import json
 import openai
+from datetime import datetime
 from app.config import settings
+from app.core.intent import intent_classifier
 from app.core.memory import memory_service
+from app.core.retrieval import retrieval_orchestrator
 from app.core.sql_tool import sql_tool
+from app.core.time_parser import time_parser
+from app.core.timeline_planner import timeline_planner
+from app.core.prompt_builder import prompt_builder
+from app.core.usage import prompt_cache_telemetry
+from app.db.conversation_stats import conversation_stats
 
-class LLMService:
-    def __init__(self):
-        self.client = openai.OpenAI(
-            api_key=settings.api_key,
-            base_url=settings.api_base
-        )
+FALLBACK_REPLY = "哥哥，我现在有点头晕，想不起来了... (API Error)"
 
-    def generate_response(self, user_id: str, message: str, context_flags: dict = None):
-        """
-        Generate a response using DeepSeek-V3 with RAG and Persona.
-        Returns: (response_text, is_recalling)
-        """
-        # 1. Reload prompts to ensure latest configuration
-        settings.reload_prompts()
-        
-        # Handle Context Flags
-        extra_system_context = []
-        if context_flags:
-            if context_flags.get("interrupted_context"):
-                extra_system_context.append(f"（注意：用户在上一轮对话中打断了你的发言，你当时说到：'{context_flags['interrupted_context']}'，请根据用户的新消息自然接续或转换话题）")
-            if context_flags.get("network_error"):
-                extra_system_context.append("（注意：用户刚刚遇到了网络错误，可能刚才的消息没发出去或重复了，请安抚用户）")
-            if context_flags.get("memory_reset"):
-                extra_system_context.append("（系统提示：用户刚刚重置了记忆库，你已经忘记了之前的所有对话，请重新认识用户）")
-            if context_flags.get("chat_cleared"):
-                extra_system_context.append("（系统提示：用户刚刚清空了聊天界面，这是新的一轮对话）")
-
-        # 2. Intent Recognition & Smart Router
-        intent_prompt = """
+INTENT_PROMPT = """
 Analyze the user's message and determine the optimal retrieval strategy.
 Return a JSON object with the following fields:
 
@@ -44,6 +28,10 @@ Return a JSON object with the following fields:
 2. "sql_statement": (Only if sql_query) Generate a valid SQLite SELECT statement.
    - Table: conversations
    - Columns: id, user_id, role ('user'/'assistant'), message, timestamp (YYYY-MM-DD HH:MM:SS)
+   - Prefer these precomputed per-user rollups for counts and first/last/time-of-day questions:
+     - conversation_user_stats (user_id, role, messages, first_ts, last_ts)
+     - conversation_daily_stats (user_id, day (YYYY-MM-DD), role, messages)
+     - conversation_hourly_stats (user_id, hour (0-23), role, messages)
    - ALWAYS filter by user_id = '{user_id}' (placeholder, will be replaced in code, or just rely on code injection) -> actually, generate standard SQL, code will handle safety.
    - Example: "SELECT timestamp FROM conversations WHERE role='user' ORDER BY id ASC LIMIT 1"
 
@@ -51,171 +39,291 @@ Return a JSON object with the following fields:
 
 4. "time_range_hint": (Only if hybrid_timeline) Boolean to trigger time parser.
 """
-        # Inject current user_id into prompt context if needed for SQL generation guidance?
+
+class LLMService:
+    def __init__(self):
+        self.client = openai.AsyncOpenAI(
+            api_key=settings.api_key,
+            base_url=settings.api_base
+        )
+
+    async def generate_response(self, user_id: str, message: str, context_flags: dict = None):
+        """
+        Generate a response using DeepSeek-V3 with RAG and Persona.
+        Returns: (response_text, is_recalling)
+        """
+        intent_data, is_recalling, prefetch = await self._prepare_turn(user_id, message)
+        messages = await self._build_messages(user_id, message, context_flags, intent_data, prefetch)
+
+        # Call LLM
+        try:
+            response = await self.client.chat.completions.create(
+                model="deepseek-chat",
+                messages=messages,
+                temperature=1.3,
+                stream=False
+            )
+            await prompt_cache_telemetry.record(user_id, response.usage)
+            return response.choices[0].message.content, is_recalling
+        except Exception as e:
+            print(f"LLM Error: {e}")
+            return FALLBACK_REPLY, False
+
+    async def stream_response(self, user_id: str, message: str, context_flags: dict = None):
+        """
+        Streaming variant of generate_response.
+        Async generator yielding event dicts:
+          {"event": "recalling"}                      - router picked a retrieval route
+          {"event": "token", "content": str}          - incremental model output
+          {"event": "done", "response": str, "is_recalling": bool, "interrupted": bool}
+        "interrupted" means the model failed mid-reply and "response" is only what arrived.
+        """
+        intent_data, is_recalling, prefetch = await self._prepare_turn(user_id, message)
+        if is_recalling:
+            # Tell the client before retrieval starts, so it can show the recall state immediately
+            yield {"event": "recalling"}
+
+        messages = await self._build_messages(user_id, message, context_flags, intent_data, prefetch)
+
+        chunks = []
+        usage = None
+        interrupted = False
+        try:
+            stream = await self.client.chat.completions.create(
+                model="deepseek-chat",
+                messages=messages,
+                temperature=1.3,
+                stream=True,
+                stream_options={"include_usage": True}  # final chunk carries usage (incl. prompt cache hits)
+            )
+            async for chunk in stream:
+                if chunk.usage:
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    chunks.append(delta)
+                    yield {"event": "token", "content": delta}
+        except Exception as e:
+            print(f"LLM Stream Error: {e}")
+            if chunks:
+                interrupted = True
+            else:
+                is_recalling = False
+                chunks.append(FALLBACK_REPLY)
+                yield {"event": "token", "content": FALLBACK_REPLY}
+
+        yield {"event": "done", "response": "".join(chunks), "is_recalling": is_recalling, "interrupted": interrupted}
+        await prompt_cache_telemetry.record(user_id, usage)
+
+    async def _prepare_turn(self, user_id: str, message: str):
+        """
+        Reload prompts and run the intent router.
+        The local classifier answers confident cases (mostly casual chat) in microseconds;
+        only uncertain messages pay for the LLM router round trip.
+        Sources that don't depend on the intent are started first so they overlap the router.
+        Returns: (intent_data or None, is_recalling, prefetch tasks)
+        """
+        # Pick up prompt.yaml edits (cheap: a periodic stat, re-parsed only on change)
+        settings.reload_prompts()
+
+        # Short-term memory is needed on every route: fetch it while routing
+        prefetch = {
+            "history": asyncio.create_task(memory_service.get_recent_history(user_id, limit=10))
+        }
+
+        local_decision = intent_classifier.classify(message)
+        if intent_classifier.is_confident(local_decision):
+            intent_data = local_decision
+            intent_classifier.record(local_decision, used_local=True)
+        else:
+            if local_decision["has_time_cue"]:
+                # Likely hybrid_timeline: parse the time range while the LLM router runs
+                prefetch["time_range"] = asyncio.create_task(time_parser.parse_time_query(message))
+            intent_data = await self._detect_intent(message)
+            final_intent = intent_data.get("intent_type", "chat") if intent_data else "chat"
+            intent_classifier.record(local_decision, used_local=False, final_intent=final_intent)
+
+        is_recalling = bool(intent_data) and intent_data.get("intent_type", "chat") != "chat"
+        return intent_data, is_recalling, prefetch
+
+    async def _detect_intent(self, message: str):
+        """Intent Recognition & Smart Router. Returns parsed intent dict or None."""
         # Better to let LLM generate generic SQL and we validate/bind user_id.
-        # But for simplicity, let LLM generate valid SQL assuming it knows the schema.
-        
-        intent_check = self.complete(
+        intent_check = await self.complete(
             messages=[
-                {"role": "system", "content": intent_prompt},
+                {"role": "system", "content": INTENT_PROMPT},
                 {"role": "user", "content": message}
             ],
             temperature=0.1,
             json_mode=True
         )
-        
+        if not intent_check:
+            return None
+        try:
+            return json.loads(intent_check)
+        except Exception as e:
+            print(f"Intent processing error: {e}")
+            return None
+
+    async def _retrieve_context(self, user_id: str, message: str, intent_data: dict, prefetch: dict):
+        """
+        Run the retrieval route selected by the intent router, concurrently with the
+        (already running) history fetch. Every source has its own deadline.
+        Returns: (memories, recent_history)
+        """
+        deadlines = settings.retrieval_deadlines
+        intent_type = intent_data.get("intent_type", "chat") if intent_data else "chat"
+
+        sources = {"history": (prefetch["history"], deadlines["history"], [])}
+
+        # --- Route 1: SQL Engine (Need user_id injection) ---
+        if intent_type == "sql_query":
+            # Common stats (first/last message, counts, usual hours) straight from the rollups
+            sources["stats"] = (asyncio.to_thread(conversation_stats.digest, user_id), deadlines["sql"], [])
+            # Let's use placeholder '{user_id}' in prompt instruction.
+            raw_sql = intent_data.get("sql_statement", "")
+            if raw_sql:
+                final_sql = raw_sql.replace("{user_id}", user_id)
+                sources["sql"] = (asyncio.to_thread(sql_tool.execute_query, user_id, final_sql), deadlines["sql"], [])
+
+        # --- Route 2: Hybrid Engine (Vector + Keyword) ---
+        elif intent_type == "vector_search":
+            # Unified hybrid search (vector/keyword deadlines are applied inside)
+            sources["hybrid"] = (
+                memory_service.retrieve_relevant_memories(
+                    user_id,
+                    query=message,
+                    keywords=intent_data.get("search_keywords", []),
+                    n_results=10
+                ),
+                max(deadlines["vector"], deadlines["keyword"]),
+                []
+            )
+            # Key events from summaries tagged with the same entities (inverted index)
+            if intent_data.get("search_keywords"):
+                sources["entities"] = (
+                    asyncio.to_thread(memory_service.search_timeline_by_entities, user_id, intent_data["search_keywords"]),
+                    deadlines["entities"],
+                    []
+                )
+
+        # --- Route 3: Hybrid Timeline Engine ---
+        elif intent_type == "hybrid_timeline":
+            time_task = prefetch.get("time_range") or time_parser.parse_time_query(message)
+            sources["timeline"] = (
+                self._timeline_memories(user_id, intent_data, time_task),
+                deadlines["time_parse"] + deadlines["summaries"] + deadlines["timeline"],
+                []
+            )
+
+        # Drop speculative work the chosen route doesn't need
+        if intent_type != "hybrid_timeline" and "time_range" in prefetch:
+            prefetch["time_range"].cancel()
+
+        found = await retrieval_orchestrator.gather(sources)
+
         memories = []
-        is_recalling = False
-        is_time_query = False # Deprecated, merged into chat context via system prompt time
-        
-        if intent_check:
-            import json
-            try:
-                intent_data = json.loads(intent_check)
-                intent_type = intent_data.get("intent_type", "chat")
-                
-                if intent_type != "chat":
-                    is_recalling = True
-                    
-                    # --- Route 1: SQL Engine ---
-                    if intent_type == "sql_query":
-                        # Handled in Post-processing block below to allow shared logic if needed
-                        pass
-                            
-                    # --- Route 2: Hybrid Engine (Vector + Keyword) ---
-                    elif intent_type == "vector_search":
-                        keywords = intent_data.get("search_keywords", [])
-                        # Call unified hybrid search
-                        res = memory_service.retrieve_relevant_memories(
-                            user_id, 
-                            query=message,
-                            keywords=keywords,
-                            n_results=10
-                        )
-                        if isinstance(res, list): memories.extend(res)
-
-                    # --- Route 3: Hybrid Engine ---
-                    elif intent_type == "hybrid_timeline":
-                        # 1. Parse time
-                        time_range = time_parser.parse_time_query(message)
-                        if time_range and time_range.get('start_date'):
-                            # 2. Get raw logs from SQL
-                            raw_logs = memory_service.get_memories_by_date_range(
-                                user_id, 
-                                time_range['start_date'], 
-                                time_range['end_date'],
-                                limit=100
-                            )
-                            # 3. Filter by keywords in Python
-                            keywords = intent_data.get("search_keywords", [])
-                            matched = []
-                            for log in raw_logs:
-                                if any(k.lower() in log.lower() for k in keywords):
-                                    matched.append(log)
-                            if not matched and len(raw_logs) < 20: matched = raw_logs
-                            
-                            if matched:
-                                memories.append(f"【时间线混合检索 ({time_range['start_date']})】:\n" + "\n".join(matched[:20]))
-
-                else:
-                    is_recalling = False
-
-                # Post-processing for SQL (Need user_id injection)
-                if intent_type == "sql_query":
-                    # We need to re-generate SQL with correct user_id if we want to be safe, 
-                    # OR we just instruct LLM to use a placeholder and we replace it?
-                    # Let's use placeholder '{user_id}' in prompt instruction.
-                    raw_sql = intent_data.get("sql_statement", "")
-                    if raw_sql:
-                        # Replace placeholder if exists, or try to inject if missing (hard)
-                        # Let's assume LLM follows instruction to filter by user_id.
-                        # We will replace 'user_id_placeholder' if we asked for it.
-                        # Let's just update the PROMPT above to say: "Use user_id = '{user_id}'"
-                        # And here we format it.
-                        final_sql = raw_sql.replace("{user_id}", user_id)
-                        
-                        # Execute
-                        sql_results = sql_tool.execute_query(user_id, final_sql)
-                        if sql_results:
-                            memories.append(f"【结构化数据统计】:\n" + "\n".join(sql_results))
-
-            except Exception as e:
-                print(f"Intent processing error: {e}")
-                pass 
-        
-        # Deduplicate and Format Memories
-        unique_memories = list(set(memories))
-        memory_context = "\n\n".join(unique_memories)
-        
-        # 3. Get recent conversation history (Short-term memory)
-        recent_history = memory_service.get_recent_history(user_id, limit=10)
-        
-        # 4. Construct System Prompt
-        from datetime import datetime
-        
+        if found.get("stats") or found.get("sql"):
+            memories.append(f"【结构化数据统计】:\n" + "\n".join(found.get("stats", []) + found.get("sql", [])))
+        memories.extend(found.get("hybrid", []))
+        if found.get("entities"):
+            memories.append("【相关事件】:\n" + "\n".join(
+                f"[{event['date_key']}] {event['content_preview']}" for event in found["entities"]
+            ))
+        memories.extend(found.get("timeline", []))
+        return memories, found["history"]
+
+    async def _timeline_memories(self, user_id: str, intent_data: dict, time_task) -> list:
+        """
+        Hybrid timeline route: resolve the time range, then let the planner read the
+        summary layers that fit it plus raw messages (keyword hits, uncovered days).
+        """
+        deadlines = settings.retrieval_deadlines
+
+        # 1. Parse time (may already be running since the router call)
+        time_range = await asyncio.wait_for(time_task, timeout=deadlines["time_parse"])
+        if not time_range or not time_range.get('start_date'):
+            return []
+        start_date, end_date = time_range['start_date'], time_range['end_date']
+
+        # 2. L3/L2/L1 summaries, then L0 (depends on which days the summaries cover)
+        found = await retrieval_orchestrator.gather({
+            "timeline": (
+                asyncio.to_thread(
+                    timeline_planner.retrieve,
+                    user_id, start_date, end_date, intent_data.get("search_keywords", [])
+                ),
+                deadlines["summaries"] + deadlines["timeline"],
+                {"summaries": [], "raw": []}
+            ),
+        })
+        timeline = found["timeline"]
+
+        memories = []
+        if timeline["raw"]:
+            memories.append(f"【时间线混合检索 ({start_date})】:\n" + "\n".join(
+                f"[{hit['timestamp']}] {hit['role']}: {hit['message']}" for hit in timeline["raw"]
+            ))
+
+        if timeline["summaries"]:
+            memories.append("【阶段摘要】:\n" + timeline_planner.format_summaries(timeline["summaries"]))
+        return memories
+
+    async def _build_messages(self, user_id: str, message: str, context_flags: dict, intent_data: dict, prefetch: dict) -> list:
+        """
+        Retrieve memories and history, then construct the chat messages for this turn.
+        Only the persona system message is byte-stable across turns, so it is the only
+        prefix the provider can reliably cache; history is a sliding window (last N
+        messages, trimmed to the token budget) whose first message shifts between turns.
+        """
+        # Handle Context Flags
+        extra_system_context = []
+        if context_flags:
+            if context_flags.get("interrupted_context"):
+                extra_system_context.append(f"（注意：用户在上一轮对话中打断了你的发言，你当时说到：'{context_flags['interrupted_context']}'，请根据用户的新消息自然接续或转换话题）")
+            if context_flags.get("network_error"):
+                extra_system_context.append("（注意：用户刚刚遇到了网络错误，可能刚才的消息没发出去或重复了，请安抚用户）")
+            if context_flags.get("memory_reset"):
+                extra_system_context.append("（系统提示：用户刚刚重置了记忆库，你已经忘记了之前的所有对话，请重新认识用户）")
+            if context_flags.get("chat_cleared"):
+                extra_system_context.append("（系统提示：用户刚刚清空了聊天界面，这是新的一轮对话）")
+
+        memories, recent_history = await self._retrieve_context(user_id, message, intent_data, prefetch)
+
+        # Construct System Prompt
         now = datetime.now()
         current_time_str = now.strftime("%Y-%m-%d %H:%M:%S")
         weekday_map = {0:"周一", 1:"周二", 2:"周三", 3:"周四", 4:"周五", 5:"周六", 6:"周日"}
         weekday_str = weekday_map[now.weekday()]
-        
-        # Calculate specific time info if requested
-        # Even if is_time_query is false (deprecated), we always inject system time.
-        # But for specific time questions, we might want to emphasize it.
-        # Since we inject "Current System Time" at the top of prompt globally, 
-        # the AI should be aware of time. 
-        # Let's keep time_context simple or remove if redundant.
-        # However, user feedback "lost time perception" suggests global prompt isn't enough?
-        # Or maybe the "intent_type" logic bypassed some time handling?
-        # Actually, in the new prompt, we removed "time_query" output field.
-        # So is_time_query is always False.
-        # And time_context block relies on it. 
-        # FIX: Always inject detailed time context if it's a chat or time-related query?
-        # Better yet, just make the global time header very explicit.
-        
+
+        # Persona: the static, cacheable prefix of every request (formatted once per prompt version)
+        formatted_system_prompt = settings.persona_prompt
+
         # Enhanced Global Time Context
-        formatted_system_prompt = settings.system_prompt.replace("{name}", settings.bot_name)
-        
+        # User feedback "lost time perception": always make the global time header very explicit.
+        # It changes every second, so it goes after the cached prefix (see PromptBuilder).
+
         # Explicitly formatted time block
         time_header = f"""
 【系统时间广播】
 当前现实时间：{current_time_str} ({weekday_str})
 注意：请时刻感知此时间，如果用户问及时间，以此为准。
 """
-        formatted_system_prompt = f"{time_header}\n\n{formatted_system_prompt}"
-        
-        if extra_system_context:
-            formatted_system_prompt += "\n\n" + "\n".join(extra_system_context)
 
-        system_prompt = f"""{formatted_system_prompt}
-
-【相关记忆】
-{memory_context if memory_context else "（本轮无需回忆）"}
-
-请基于以上人设和记忆与用户对话。
-"""
-
-        # 5. Construct Messages
-        messages = [{"role": "system", "content": system_prompt}]
-        for msg in recent_history:
-            messages.append({"role": msg["role"], "content": msg["content"]})
-        
-        # Add current user message
-        messages.append({"role": "user", "content": message})
-
-        # 6. Call LLM
-        try:
-            response = self.client.chat.completions.create(
-                model="deepseek-chat",
-                messages=messages,
-                temperature=1.3,
-                stream=False
-            )
-            return response.choices[0].message.content, is_recalling
-        except Exception as e:
-            print(f"LLM Error: {e}")
-            return "哥哥，我现在有点头晕，想不起来了... (API Error)", False
+        # Fit persona, flags, memories (deduplicated, rank order) and history into the token budget
+        messages, _ = prompt_builder.build(
+            persona=formatted_system_prompt,
+            time_header=time_header,
+            extra_context=extra_system_context,
+            memories=memories,
+            history=recent_history,
+            message=message,
+        )
+        return messages
 
-    def complete(self, messages: list, temperature: float = 0.7, json_mode: bool = False):
+    async def complete(self, messages: list, temperature: float = 0.7, json_mode: bool = False):
         """
         Generic completion method for internal tasks (summarization, extraction).
         """
@@ -229,7 +337,7 @@ Return a JSON object with the following fields:
             if json_mode:
                 kwargs["response_format"] = {"type": "json_object"}
 
-            response = self.client.chat.completions.create(**kwargs)
+            response = await self.client.chat.completions.create(**kwargs)
             return response.choices[0].message.content
         except Exception as e:
             print(f"LLM Completion Error: {e}")
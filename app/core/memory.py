@@ -1,86 +1,329 @@
 import chromadb
 from chromadb.config import Settings
+from chromadb.utils import embedding_functions
 from app.config import settings
-from app.db.sqlite import get_db_connection
-from app.db.redis_client import redis_client
+from app.db.sqlite import get_db_connection, db_transaction, local_ts_to_epoch, table_exists, fts_match_expression, FTS_MIN_TERM_LENGTH
+from app.db.redis_client import async_redis_client
+from app.db.write_behind import write_behind
+from app.db.user_tombstones import user_tombstones
+from app.core.retrieval import retrieval_orchestrator
+from app.core.embedding_cache import CachedEmbeddingFunction, content_hash
+import asyncio
 import json
+import threading
 import time
+import weakref
+from collections import OrderedDict
+from datetime import datetime
+
+# Rebuild the cached session atomically, whichever worker/host does it:
+# KEYS[1] session list, KEYS[2] "session is complete" marker; ARGV[1] size, ARGV[2] ttl,
+# ARGV[3..] history read from SQLite (chronological). Without the marker the list only
+# holds messages appended since the cache was lost (possibly still unflushed in another
+# process's write-behind); they are kept after the SQLite rows, de-duplicated.
+# With the marker set, another process already rebuilt the session: leave it alone.
+HYDRATE_SESSION_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 0
+end
+local seen, merged = {}, {}
+for i = 3, #ARGV do
+    if not seen[ARGV[i]] then
+        seen[ARGV[i]] = true
+        merged[#merged + 1] = ARGV[i]
+    end
+end
+for _, entry in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+    if not seen[entry] and string.find(entry, '"timestamp"', 1, true) then
+        seen[entry] = true
+        merged[#merged + 1] = entry
+    end
+end
+local first = math.max(1, #merged - tonumber(ARGV[1]) + 1)
+redis.call('DEL', KEYS[1])
+if #merged > 0 then
+    redis.call('RPUSH', KEYS[1], unpack(merged, first, #merged))
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    redis.call('SET', KEYS[2], '1', 'EX', ARGV[2])
+end
+return 1
+"""
 
 class MemoryService:
     def __init__(self):
-        # Initialize ChromaDB persistent client
-        self.chroma_client = chromadb.PersistentClient(path=str(settings.chroma_path))
+        # Embedded ChromaDB store, or a Chroma server shared by every worker/host
+        if settings.chroma_mode == "http":
+            self.chroma_client = chromadb.HttpClient(host=settings.chroma_host, port=settings.chroma_port)
+        else:
+            self.chroma_client = chromadb.PersistentClient(path=str(settings.chroma_path))
+        # Embeddings are computed here rather than inside collection.add/query so that
+        # ingest can batch them across users (all-MiniLM-L6-v2, Chroma's default model)
+        self.embedding_function = CachedEmbeddingFunction(embedding_functions.DefaultEmbeddingFunction())
+        self._fts_available = None  # Resolved lazily after init_db() ran migrations
+        self._session_locks = weakref.WeakValueDictionary()
+        self._hydrate_session = async_redis_client.register_script(HYDRATE_SESSION_SCRIPT)
+        # Blocking callbacks run before a user's data is deleted (e.g. the embedding ingest
+        # queue dropping that user's pending fragments); see on_user_deleted()
+        self._user_deleted_callbacks = []
+
+        # Bounded LRU of Chroma collection handles, keyed by user_id
+        self._collection_cache = OrderedDict()
+        self._collection_cache_lock = threading.Lock()
+        self._collection_cache_hits = 0
+        self._collection_cache_misses = 0
+        self._collection_cache_evictions = 0
+
+        # Per-user retrieval result cache; entries are valid only for the user's current
+        # generation, which add_memories() / delete_user_memory() bump
+        self._retrieval_cache = OrderedDict()
+        self._retrieval_generation = {}
+        self._retrieval_cache_lock = threading.Lock()
+        self._retrieval_cache_hits = 0
+        self._retrieval_cache_misses = 0
         
-    def get_user_collection(self, user_id: str):
-        """Get or create a Chroma collection for a specific user."""
+    def get_user_collection(self, user_id: str, deleted_at: float = None):
+        """
+        Get or create a Chroma collection for a specific user.
+        Handles are cached (LRU) so a turn doesn't pay a sysdb metadata round trip per call.
+        A handle fetched before `deleted_at` (the user's tombstone) points at a deleted
+        collection and is fetched again.
+        """
+        with self._collection_cache_lock:
+            entry = self._collection_cache.get(user_id)
+            if entry is not None and not user_tombstones.is_stale(entry[1], deleted_at):
+                self._collection_cache.move_to_end(user_id)
+                self._collection_cache_hits += 1
+                return entry[0]
+            self._collection_cache_misses += 1
+
         collection_name = f"memories_{user_id}"
-        return self.chroma_client.get_or_create_collection(name=collection_name)
+        fetched_at = time.time()
+        collection = self.chroma_client.get_or_create_collection(name=collection_name)
+
+        with self._collection_cache_lock:
+            self._collection_cache[user_id] = (collection, fetched_at)
+            self._collection_cache.move_to_end(user_id)
+            while len(self._collection_cache) > settings.chroma_collection_cache_size:
+                self._collection_cache.popitem(last=False)
+                self._collection_cache_evictions += 1
+        return collection
+
+    def on_user_deleted(self, callback):
+        """Register callback(user_id), run (in a worker thread) at the start of delete_user_memory()."""
+        self._user_deleted_callbacks.append(callback)
+
+    def invalidate_user_collection(self, user_id: str):
+        """Drop a cached collection handle (e.g. after the collection was deleted)."""
+        with self._collection_cache_lock:
+            self._collection_cache.pop(user_id, None)
+
+    def collection_cache_stats(self) -> dict:
+        with self._collection_cache_lock:
+            lookups = self._collection_cache_hits + self._collection_cache_misses
+            return {
+                "size": len(self._collection_cache),
+                "capacity": settings.chroma_collection_cache_size,
+                "hits": self._collection_cache_hits,
+                "misses": self._collection_cache_misses,
+                "evictions": self._collection_cache_evictions,
+                "hit_rate": (self._collection_cache_hits / lookups) if lookups else 0.0,
+            }
+
+    def embed(self, texts: list) -> list:
+        """
+        Embed texts with the same model Chroma uses by default, so one pass can
+        serve fragments for many users (see app/core/embedding_queue.py).
+        """
+        return [list(map(float, vector)) for vector in self.embedding_function(texts)]
 
     def add_memory(self, user_id: str, content: str, metadata: dict = None):
         """Add a memory fragment to the vector database."""
-        collection = self.get_user_collection(user_id)
-        collection.add(
+        self.add_memories(
+            user_id,
             documents=[content],
             metadatas=[metadata or {"timestamp": time.time()}],
             ids=[f"{user_id}_{time.time()}"]
         )
 
-    def retrieve_relevant_memories(self, user_id: str, query: str, n_results: int = 5):
-        """Retrieve relevant memories from vector database."""
-        collection = self.get_user_collection(user_id)
-        results = collection.query(
-            query_texts=[query],
-            n_results=n_results
+    def add_memories(self, user_id: str, documents: list, metadatas: list, ids: list, embeddings: list = None):
+        """
+        Add several memory fragments to a user's collection with a single upsert(), so
+        writing the same ids again (a journal replay) doesn't duplicate them.
+        Checks the user's tombstone first: another worker may have deleted the collection
+        this process still holds a handle to.
+        """
+        deleted_at = user_tombstones.deleted_at([user_id]).get(user_id)
+        collection = self.get_user_collection(user_id, deleted_at)
+        collection.upsert(
+            documents=documents,
+            metadatas=metadatas,
+            ids=ids,
+            embeddings=embeddings if embeddings is not None else self.embed(documents)
         )
-        if results['documents']:
-            return results['documents'][0]
-        return []
+        self.invalidate_retrieval_cache(user_id)
 
-    def save_conversation(self, user_id: str, role: str, message: str):
-        """Save conversation to SQLite and update Redis session."""
-        # Save to SQLite
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Ensure user exists
-        cursor.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
-        
+    def invalidate_retrieval_cache(self, user_id: str):
+        """New generation for the user: every cached retrieval result becomes stale."""
+        with self._retrieval_cache_lock:
+            self._retrieval_generation[user_id] = self._retrieval_generation.get(user_id, 0) + 1
+
+    def _retrieval_cache_get(self, key: tuple, deleted_at: float = None):
+        """Cached results, unless the user's generation moved, the entry expired, or it predates deleted_at."""
+        user_id = key[0]
+        with self._retrieval_cache_lock:
+            entry = self._retrieval_cache.get(key)
+            generation = self._retrieval_generation.get(user_id, 0)
+            if entry and entry[0] == generation and entry[1] > time.monotonic() \
+                    and not user_tombstones.is_stale(entry[3], deleted_at):
+                self._retrieval_cache.move_to_end(key)
+                self._retrieval_cache_hits += 1
+                return list(entry[2])
+            if entry:
+                del self._retrieval_cache[key]
+            self._retrieval_cache_misses += 1
+            return None
+
+    def _retrieval_cache_put(self, key: tuple, generation: int, results: list):
+        with self._retrieval_cache_lock:
+            self._retrieval_cache[key] = (generation, time.monotonic() + settings.retrieval_cache_ttl, list(results), time.time())
+            self._retrieval_cache.move_to_end(key)
+            while len(self._retrieval_cache) > settings.retrieval_cache_size:
+                self._retrieval_cache.popitem(last=False)
+
+    def retrieval_cache_stats(self) -> dict:
+        with self._retrieval_cache_lock:
+            lookups = self._retrieval_cache_hits + self._retrieval_cache_misses
+            return {
+                "size": len(self._retrieval_cache),
+                "hits": self._retrieval_cache_hits,
+                "misses": self._retrieval_cache_misses,
+                "hit_rate": (self._retrieval_cache_hits / lookups) if lookups else 0.0,
+            }
+
+    async def save_conversation(self, user_id: str, role: str, message: str):
+        """
+        Save conversation to SQLite (write-behind) and update Redis session.
+        The SQLite insert is queued and committed in a batch by the write-behind thread;
+        the Redis session and pending_conversations() keep the message readable meanwhile.
+        """
         # Insert with explicit LOCAL timestamp from Python to ensure consistency
         # This overrides SQLite's default, making it independent of DB timezone settings
-        from datetime import datetime
         now_local = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        cursor.execute(
-            "INSERT INTO conversations (user_id, message, role, timestamp) VALUES (?, ?, ?, ?)",
-            (user_id, message, role, now_local)
-        )
-        conn.commit()
-        conn.close()
-        
-        # Update Redis
-        self._update_redis_session(user_id, role, message)
 
-    def _update_redis_session(self, user_id: str, role: str, message: str):
-        """Update session context and last active time in Redis."""
+        async with self._session_lock(user_id):
+            write_behind.enqueue_conversation(user_id, role, message, now_local)
+            
+            # Update Redis
+            await self._update_redis_session(user_id, role, message, now_local)
+
+    def _session_lock(self, user_id: str) -> asyncio.Lock:
+        """
+        Per-user lock serializing session writes and cache rehydration in this process.
+        Across workers, HYDRATE_SESSION_SCRIPT keeps the rebuild atomic in Redis.
+        """
+        lock = self._session_locks.get(user_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._session_locks[user_id] = lock
+        return lock
+
+    async def _update_redis_session(self, user_id: str, role: str, message: str, timestamp: str):
+        """
+        Append to the cached session and bump last active time in one pipelined round trip.
+        The list is only served while its session_ready marker exists; after a cache miss the
+        appends collect there until the next read rebuilds the session from SQLite and merges
+        them in (they may still sit unflushed in the writer's write-behind).
+        """
         key_active = f"chat:{user_id}:last_active"
         key_context = f"chat:{user_id}:session_context"
+        new_entry = json.dumps({"role": role, "content": message, "timestamp": timestamp}, ensure_ascii=False)
         
-        # Update last active time
-        redis_client.set(key_active, int(time.time()))
-        
-        # Update session context (keep last 10 messages for short-term memory)
-        context = redis_client.lrange(key_context, 0, -1)
-        if not context:
-            context = []
-        
-        new_entry = json.dumps({"role": role, "content": message})
-        redis_client.rpush(key_context, new_entry)
-        
-        # Trim to keep only last 20 messages
-        if redis_client.llen(key_context) > 20:
-            redis_client.lpop(key_context)
+        try:
+            pipe = async_redis_client.pipeline(transaction=True)
+            pipe.rpush(key_context, new_entry)
+            # Keep only the last N messages for short-term memory
+            pipe.ltrim(key_context, -settings.redis_session_size, -1)
+            pipe.expire(key_context, settings.redis_session_ttl)
+            pipe.expire(f"chat:{user_id}:session_ready", settings.redis_session_ttl)
+            pipe.set(key_active, int(time.time()))
+            await pipe.execute()
+        except Exception as e:
+            print(f"Redis session update error for {user_id}: {e}")
+
+    async def get_recent_history(self, user_id: str, limit: int = 20):
+        """
+        Get recent conversation history (chronological, with timestamps).
+        Read-through cache: served from the Redis session list; on a miss the history
+        is loaded from SQLite and the session is rehydrated.
+        """
+        cacheable = limit <= settings.redis_session_size
+        if cacheable:
+            cached = await self._read_redis_session(user_id, limit)
+            if cached is not None:
+                return cached
+
+        async with self._session_lock(user_id):
+            # Snapshot unflushed rows before reading SQLite: a row flushed in between
+            # shows up in both and is de-duplicated, never in neither
+            pending = write_behind.pending_conversations(user_id)
+            fetch_limit = max(limit, settings.redis_session_size)
+            history = await asyncio.to_thread(self._fetch_recent_history, user_id, fetch_limit)
+            history = self._merge_pending(history, pending)[-fetch_limit:]
+            if cacheable and history:
+                await self._hydrate_redis_session(user_id, history)
+        return history[-limit:]
 
-    def get_recent_history(self, user_id: str, limit: int = 20):
+    @staticmethod
+    def _merge_pending(history: list, pending: list) -> list:
+        """Append write-behind rows not yet visible in SQLite to a chronological history."""
+        seen = {(h["role"], h["content"], str(h["timestamp"])) for h in history}
+        merged = list(history)
+        for entry in pending:
+            if (entry["role"], entry["content"], entry["timestamp"]) not in seen:
+                merged.append(entry)
+        return merged
+
+    async def _read_redis_session(self, user_id: str, limit: int):
+        """Return the last `limit` cached messages, or None on a cache miss."""
+        key_context = f"chat:{user_id}:session_context"
+        key_ready = f"chat:{user_id}:session_ready"
+        try:
+            pipe = async_redis_client.pipeline(transaction=True)
+            pipe.exists(key_ready)
+            pipe.lrange(key_context, -limit, -1)
+            ready, raw_entries = await pipe.execute()
+        except Exception as e:
+            print(f"Redis session read error for {user_id}: {e}")
+            return None
+        if not ready or not raw_entries:
+            return None
+
+        history = []
+        for raw in raw_entries:
+            entry = json.loads(raw)
+            if "timestamp" not in entry:
+                # Entry written before timestamps were cached: rebuild the session
+                return None
+            history.append(entry)
+        return history
+
+    async def _hydrate_redis_session(self, user_id: str, history: list):
+        """Rebuild the cached session from `history` (chronological dicts) with HYDRATE_SESSION_SCRIPT."""
+        key_context = f"chat:{user_id}:session_context"
+        key_ready = f"chat:{user_id}:session_ready"
+        entries = [
+            json.dumps({"role": h["role"], "content": h["content"], "timestamp": str(h["timestamp"])}, ensure_ascii=False)
+            for h in history[-settings.redis_session_size:]
+        ]
+        try:
+            await self._hydrate_session(
+                keys=[key_context, key_ready],
+                args=[settings.redis_session_size, settings.redis_session_ttl, *entries]
+            )
+        except Exception as e:
+            print(f"Redis session hydrate error for {user_id}: {e}")
+
+    def _fetch_recent_history(self, user_id: str, limit: int = 20):
         """Get recent conversation history from SQLite."""
         conn = get_db_connection()
         cursor = conn.cursor()
@@ -89,25 +332,69 @@ class MemoryService:
             (user_id, limit)
         )
         rows = cursor.fetchall()
-        conn.close()
         return [dict(row) for row in rows][::-1]  # Reverse to chronological order
 
     # --- Phase 2: Hierarchical Memory & Hybrid Retrieval ---
 
     def add_timeline_entry(self, user_id: str, date_key: str, memory_id: str, layer: int, importance: float, entities: list, content_preview: str = None):
-        """Add entry to memory timeline index."""
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        """Add entry to memory timeline index (batched by the write-behind queue)."""
+        write_behind.enqueue_timeline(user_id, date_key, memory_id, layer, importance, entities, content_preview)
+
+    def replace_timeline_entries(self, user_id: str, memory_id: str, entries: list):
+        """
+        Replace every timeline row of one memory (e.g. a regenerated summary) in one transaction.
+        entries: [{"date_key", "layer", "importance", "entities", "content_preview"}]
+        """
+        with db_transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM memory_timeline WHERE user_id = ? AND memory_id = ?", (user_id, memory_id))
+            cursor.executemany(
+                """
+                INSERT INTO memory_timeline
+                (user_id, date_key, memory_id, layer, importance, entities, content_preview)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                [
+                    (user_id, entry["date_key"], memory_id, entry["layer"], entry["importance"],
+                     json.dumps(entry["entities"]), entry.get("content_preview"))
+                    for entry in entries
+                ]
+            )
+
+    def search_timeline_by_entities(self, user_id: str, entities: list, limit: int = 5) -> list:
+        """
+        Timeline entries (key events from summaries) tagged with any of the entities, via
+        the timeline_entities inverted index. Ranked by number of matching entities, then
+        importance, then recency.
+        Returns [{"date_key", "layer", "importance", "memory_id", "content_preview"}].
+        """
+        entities = [entity for entity in (entities or []) if entity and entity.strip()]
+        if not entities:
+            return []
+        cursor = get_db_connection().cursor()
         cursor.execute(
-            """
-            INSERT INTO memory_timeline 
-            (user_id, date_key, memory_id, layer, importance, entities, content_preview) 
-            VALUES (?, ?, ?, ?, ?, ?, ?)
+            f"""
+            SELECT t.date_key, t.layer, t.importance, t.memory_id, t.content_preview, COUNT(*) AS matched
+            FROM timeline_entities e
+            JOIN memory_timeline t ON t.id = e.timeline_id
+            WHERE e.user_id = ? AND e.entity IN ({','.join('lower(trim(?))' for _ in entities)})
+            GROUP BY t.id
+            ORDER BY matched DESC, t.importance DESC, t.date_key DESC
+            LIMIT ?
             """,
-            (user_id, date_key, memory_id, layer, importance, json.dumps(entities), content_preview)
+            (user_id, *entities, limit)
         )
-        conn.commit()
-        conn.close()
+        return [
+            {key: row[key] for key in ("date_key", "layer", "importance", "memory_id", "content_preview")}
+            for row in cursor.fetchall()
+        ]
+
+    def get_first_message_dates(self) -> dict:
+        """{user_id: date of the user's first conversation (YYYY-MM-DD)}"""
+        cursor = get_db_connection().cursor()
+        # ts_epoch is local wall-clock time read as UTC, so 'unixepoch' gives the local date
+        cursor.execute("SELECT user_id, date(MIN(ts_epoch), 'unixepoch') AS first_date FROM conversations GROUP BY user_id")
+        return {row["user_id"]: row["first_date"] for row in cursor.fetchall() if row["first_date"]}
 
     def get_weekly_summaries_by_range(self, user_id: str, start_date: str, end_date: str):
         """Get L1 weekly summaries within a date range."""
@@ -122,7 +409,6 @@ class MemoryService:
             (user_id, start_date, end_date)
         )
         rows = cursor.fetchall()
-        conn.close()
         return [dict(row) for row in rows]
 
     def get_monthly_summaries_by_range(self, user_id: str, start_date: str, end_date: str):
@@ -138,57 +424,105 @@ class MemoryService:
             (user_id, start_date, end_date)
         )
         rows = cursor.fetchall()
-        conn.close()
         return [dict(row) for row in rows]
 
-    def add_weekly_summary(self, user_id: str, week_start: str, summary: str, key_events: list, emotional_trend: str):
-        """Add L1 weekly summary."""
+    def get_yearly_summaries_by_range(self, user_id: str, start_date: str, end_date: str):
+        """Get L3 yearly summaries within a date range."""
         conn = get_db_connection()
         cursor = conn.cursor()
         cursor.execute(
             """
-            INSERT INTO weekly_summaries (user_id, week_start, summary, key_events, emotional_trend)
-            VALUES (?, ?, ?, ?, ?)
+            SELECT summary, key_events, emotional_trend, relationship_milestone, year_start FROM yearly_summaries
+            WHERE user_id = ? AND year_start BETWEEN ? AND ?
+            ORDER BY year_start ASC
             """,
-            (user_id, week_start, summary, json.dumps(key_events), emotional_trend)
+            (user_id, start_date, end_date)
         )
-        summary_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        rows = cursor.fetchall()
+        return [dict(row) for row in rows]
+
+    def add_weekly_summary(self, user_id: str, week_start: str, summary: str, key_events: list, emotional_trend: str):
+        """Add or replace the L1 weekly summary for a period. Returns its id (stable across reruns)."""
+        with db_transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                INSERT INTO weekly_summaries (user_id, week_start, summary, key_events, emotional_trend)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (user_id, week_start) DO UPDATE SET
+                    summary = excluded.summary, key_events = excluded.key_events, emotional_trend = excluded.emotional_trend, created_at = CURRENT_TIMESTAMP
+                """,
+                (user_id, week_start, summary, json.dumps(key_events), emotional_trend)
+            )
+            cursor.execute("SELECT id FROM weekly_summaries WHERE user_id = ? AND week_start = ?", (user_id, week_start))
+            summary_id = cursor.fetchone()["id"]
         return summary_id
 
     def add_monthly_summary(self, user_id: str, month_start: str, summary: str, key_events: list, emotional_trend: str, relationship_milestone: str):
-        """Add L2 monthly summary."""
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-            INSERT INTO monthly_summaries (user_id, month_start, summary, key_events, emotional_trend, relationship_milestone)
-            VALUES (?, ?, ?, ?, ?, ?)
-            """,
-            (user_id, month_start, summary, json.dumps(key_events), emotional_trend, relationship_milestone)
-        )
-        summary_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        """Add or replace the L2 monthly summary for a period. Returns its id (stable across reruns)."""
+        with db_transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                INSERT INTO monthly_summaries (user_id, month_start, summary, key_events, emotional_trend, relationship_milestone)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (user_id, month_start) DO UPDATE SET
+                    summary = excluded.summary, key_events = excluded.key_events, emotional_trend = excluded.emotional_trend, relationship_milestone = excluded.relationship_milestone, created_at = CURRENT_TIMESTAMP
+                """,
+                (user_id, month_start, summary, json.dumps(key_events), emotional_trend, relationship_milestone)
+            )
+            cursor.execute("SELECT id FROM monthly_summaries WHERE user_id = ? AND month_start = ?", (user_id, month_start))
+            summary_id = cursor.fetchone()["id"]
         return summary_id
 
     def add_yearly_summary(self, user_id: str, year_start: str, summary: str, key_events: list, emotional_trend: str, relationship_milestone: str):
-        """Add L3 yearly summary."""
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-            INSERT INTO yearly_summaries (user_id, year_start, summary, key_events, emotional_trend, relationship_milestone)
-            VALUES (?, ?, ?, ?, ?, ?)
-            """,
-            (user_id, year_start, summary, json.dumps(key_events), emotional_trend, relationship_milestone)
-        )
-        summary_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        """Add or replace the L3 yearly summary for a period. Returns its id (stable across reruns)."""
+        with db_transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                INSERT INTO yearly_summaries (user_id, year_start, summary, key_events, emotional_trend, relationship_milestone)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (user_id, year_start) DO UPDATE SET
+                    summary = excluded.summary, key_events = excluded.key_events, emotional_trend = excluded.emotional_trend, relationship_milestone = excluded.relationship_milestone, created_at = CURRENT_TIMESTAMP
+                """,
+                (user_id, year_start, summary, json.dumps(key_events), emotional_trend, relationship_milestone)
+            )
+            cursor.execute("SELECT id FROM yearly_summaries WHERE user_id = ? AND year_start = ?", (user_id, year_start))
+            summary_id = cursor.fetchone()["id"]
         return summary_id
 
+    def iter_memories_by_date_range(self, user_id: str, start_date: str, end_date: str, page_size: int = None):
+        """
+        Yield every conversation row ({role, message, timestamp}) in the date range, oldest first.
+        Pages with a keyset on (ts_epoch, id) instead of OFFSET, so each page is an index
+        range seek and memory stays bounded however large the period is.
+        """
+        page_size = page_size or settings.summary_page_size
+        cursor = get_db_connection().cursor()
+        last_epoch = local_ts_to_epoch(f"{start_date} 00:00:00") - 1
+        last_id = 0
+        end_epoch = local_ts_to_epoch(f"{end_date} 23:59:59")
+        while True:
+            cursor.execute(
+                """
+                SELECT id, ts_epoch, role, message, timestamp
+                FROM conversations
+                WHERE user_id = ?
+                AND (ts_epoch, id) > (?, ?)
+                AND ts_epoch <= ?
+                ORDER BY ts_epoch ASC, id ASC
+                LIMIT ?
+                """,
+                (user_id, last_epoch, last_id, end_epoch, page_size)
+            )
+            rows = cursor.fetchall()
+            for row in rows:
+                yield {"role": row["role"], "message": row["message"], "timestamp": row["timestamp"]}
+            if len(rows) < page_size:
+                return
+            last_epoch, last_id = rows[-1]["ts_epoch"], rows[-1]["id"]
+
     def get_memories_by_date_range(self, user_id: str, start_date: str, end_date: str, limit: int = 50, format_result: bool = True):
         """
         Retrieve raw conversation history within a specific date range from SQLite.
@@ -203,23 +537,22 @@ class MemoryService:
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        # Ensure range covers full days
-        start_ts = f"{start_date} 00:00:00"
-        end_ts = f"{end_date} 23:59:59"
+        # Ensure range covers full days (integer epoch -> index range seek on (user_id, ts_epoch))
+        start_epoch = local_ts_to_epoch(f"{start_date} 00:00:00")
+        end_epoch = local_ts_to_epoch(f"{end_date} 23:59:59")
         
         cursor.execute(
             """
             SELECT role, message, timestamp 
             FROM conversations 
             WHERE user_id = ? 
-            AND timestamp BETWEEN ? AND ?
-            ORDER BY timestamp ASC
+            AND ts_epoch BETWEEN ? AND ?
+            ORDER BY ts_epoch ASC
             LIMIT ?
             """,
-            (user_id, start_ts, end_ts, limit)
+            (user_id, start_epoch, end_epoch, limit)
         )
         rows = cursor.fetchall()
-        conn.close()
         
         if not format_result:
             # Return raw dicts for summarizer
@@ -237,66 +570,197 @@ class MemoryService:
 
     def search_by_keyword(self, user_id: str, keywords: list, limit: int = 5):
         """
-        Retrieve memories using keyword matching (SQLite LIKE).
+        Retrieve memories using keyword matching.
+        Keywords of 3+ characters use the trigram FTS5 index (ranked by bm25);
+        shorter ones (common for Chinese, e.g. "小明") can't be expressed as trigrams
+        and fall back to LIKE over this user's rows only.
         Returns list of strings.
         """
+        keywords = [kw.strip() for kw in (keywords or []) if kw and kw.strip()]
         if not keywords:
             return []
             
         conn = get_db_connection()
         cursor = conn.cursor()
-        
-        # Build dynamic query for multiple keywords (OR logic)
-        # We want to find messages containing ANY of the keywords
-        conditions = []
-        params = [user_id]
-        
-        for kw in keywords:
-            conditions.append("message LIKE ?")
-            params.append(f"%{kw}%")
+
+        fts_terms = [kw for kw in keywords if len(kw) >= FTS_MIN_TERM_LENGTH]
+        like_terms = [kw for kw in keywords if len(kw) < FTS_MIN_TERM_LENGTH]
+        if not self._fts_enabled():
+            fts_terms, like_terms = [], keywords
+
+        rows = []
+        if fts_terms:
+            # Ranked full-text match (ANY of the keywords)
+            cursor.execute(
+                """
+                SELECT c.id, c.role, c.message, c.timestamp
+                FROM conversations_fts f
+                JOIN conversations c ON c.id = f.rowid
+                WHERE conversations_fts MATCH ? AND c.user_id = ?
+                ORDER BY bm25(conversations_fts)
+                LIMIT ?
+                """,
+                (fts_match_expression(fts_terms), user_id, limit)
+            )
+            rows.extend(cursor.fetchall())
+
+        if like_terms and len(rows) < limit:
+            # Build dynamic query for short keywords (OR logic)
+            conditions = []
+            params = [user_id]
+            for kw in like_terms:
+                conditions.append("message LIKE ?")
+                params.append(f"%{kw}%")
+            where_clause = " OR ".join(conditions)
+            params.append(limit)
             
-        where_clause = " OR ".join(conditions)
-        
-        query = f"""
-            SELECT role, message, timestamp 
-            FROM conversations 
-            WHERE user_id = ? AND ({where_clause})
-            ORDER BY id DESC
-            LIMIT ?
-        """
-        params.append(limit)
-        
-        cursor.execute(query, tuple(params))
-        rows = cursor.fetchall()
-        conn.close()
+            cursor.execute(
+                f"""
+                SELECT id, role, message, timestamp 
+                FROM conversations 
+                WHERE user_id = ? AND ({where_clause})
+                ORDER BY id DESC
+                LIMIT ?
+                """,
+                tuple(params)
+            )
+            seen = {row['id'] for row in rows}
+            rows.extend(row for row in cursor.fetchall() if row['id'] not in seen)
         
         results = []
-        for row in rows:
+        for row in rows[:limit]:
             results.append(f"[{row['timestamp']}] {row['role']}: {row['message']}")
             
         return results
 
-    def retrieve_relevant_memories(self, user_id: str, query: str, keywords: list = None, n_results: int = 5):
+    def search_memories_in_range(self, user_id: str, start_date: str, end_date: str, keywords: list = None, limit: int = 20) -> list:
         """
-        Retrieve relevant memories using Hybrid Search (Vector + Keyword) with RRF Fusion.
+        Keyword hits inside a date range, with both predicates applied in SQLite.
+        Keywords of 3+ characters go through the FTS index (bm25-ranked), restricted to the
+        rowid span of the user's rows in the range; shorter ones use LIKE over the
+        (user_id, ts_epoch) index range only, ranked by how many keywords match.
+        If nothing matches (or there are no keywords) and the whole period has at most
+        `limit` messages, all of them are returned - a quiet period is cheap to show in full.
+        Returns [{"timestamp", "role", "message"}], best first.
         """
-        # 1. Vector Search (Semantic)
-        collection = self.get_user_collection(user_id)
-        vector_docs = []
-        try:
-            vector_results = collection.query(
-                query_texts=[query],
-                n_results=n_results
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        start_epoch = local_ts_to_epoch(f"{start_date} 00:00:00")
+        end_epoch = local_ts_to_epoch(f"{end_date} 23:59:59")
+
+        # Range bounds from the epoch index (covering: no table reads)
+        cursor.execute(
+            """
+            SELECT MIN(id) AS lo, MAX(id) AS hi, COUNT(*) AS n
+            FROM conversations INDEXED BY idx_conversations_user_epoch
+            WHERE user_id = ? AND ts_epoch BETWEEN ? AND ?
+            """,
+            (user_id, start_epoch, end_epoch)
+        )
+        bounds = cursor.fetchone()
+        if not bounds["n"]:
+            return []
+
+        keywords = [kw.strip() for kw in (keywords or []) if kw and kw.strip()]
+        fts_terms = [kw for kw in keywords if len(kw) >= FTS_MIN_TERM_LENGTH]
+        like_terms = [kw for kw in keywords if len(kw) < FTS_MIN_TERM_LENGTH]
+        if not self._fts_enabled():
+            fts_terms, like_terms = [], keywords
+
+        rows = []
+        if fts_terms:
+            cursor.execute(
+                """
+                SELECT c.id, c.role, c.message, c.timestamp
+                FROM conversations_fts f
+                JOIN conversations c ON c.id = f.rowid
+                WHERE conversations_fts MATCH ?
+                AND f.rowid BETWEEN ? AND ?
+                AND c.user_id = ? AND c.ts_epoch BETWEEN ? AND ?
+                ORDER BY bm25(conversations_fts)
+                LIMIT ?
+                """,
+                (fts_match_expression(fts_terms), bounds["lo"], bounds["hi"], user_id, start_epoch, end_epoch, limit)
             )
-            if vector_results['documents']:
-                vector_docs = vector_results['documents'][0]
-        except Exception as e:
-            print(f"Vector search error: {e}")
+            rows.extend(cursor.fetchall())
+
+        if like_terms and len(rows) < limit:
+            matches = " + ".join("(message LIKE ?)" for _ in like_terms)
+            cursor.execute(
+                f"""
+                SELECT id, role, message, timestamp, {matches} AS hits
+                FROM conversations
+                WHERE user_id = ? AND ts_epoch BETWEEN ? AND ? AND hits > 0
+                ORDER BY hits DESC, ts_epoch DESC
+                LIMIT ?
+                """,
+                (*[f"%{kw}%" for kw in like_terms], user_id, start_epoch, end_epoch, limit)
+            )
+            seen = {row["id"] for row in rows}
+            rows.extend(row for row in cursor.fetchall() if row["id"] not in seen)
+
+        if not rows and bounds["n"] <= limit:
+            cursor.execute(
+                """
+                SELECT id, role, message, timestamp FROM conversations
+                WHERE user_id = ? AND ts_epoch BETWEEN ? AND ?
+                ORDER BY ts_epoch ASC
+                """,
+                (user_id, start_epoch, end_epoch)
+            )
+            rows = cursor.fetchall()
+
+        return [
+            {"timestamp": row["timestamp"], "role": row["role"], "message": row["message"]}
+            for row in rows[:limit]
+        ]
 
+    def _fts_enabled(self) -> bool:
+        """Whether the conversations_fts index exists (migration 003 skips it if FTS5/trigram is unavailable)."""
+        if self._fts_available is None:
+            self._fts_available = table_exists("conversations_fts")
+        return self._fts_available
+
+    def vector_search(self, user_id: str, query: str, n_results: int = 5):
+        """Semantic search against the user's Chroma collection (blocking)."""
+        collection = self.get_user_collection(user_id)
+        vector_results = collection.query(
+            query_embeddings=self.embed([query]),
+            n_results=n_results
+        )
+        if vector_results['documents']:
+            return vector_results['documents'][0]
+        return []
+
+    async def retrieve_relevant_memories(self, user_id: str, query: str, keywords: list = None, n_results: int = 5):
+        """
+        Retrieve relevant memories using Hybrid Search (Vector + Keyword) with RRF Fusion.
+        Vector and keyword searches run concurrently in worker threads, each under its
+        own deadline; a late source is dropped and fusion uses what arrived.
+        Complete results are cached per user by (query hash, n_results, keywords) until
+        the user's collection changes, so repeated queries skip embedding and ANN search.
+        """
+        cache_key = (user_id, content_hash(query), n_results, tuple(sorted(keywords or [])))
+        # A delete handled by another worker only shows up as the user's tombstone
+        deleted_at = await user_tombstones.deleted_at_async(user_id)
+        cached = self._retrieval_cache_get(cache_key, deleted_at)
+        if cached is not None:
+            return cached
+        with self._retrieval_cache_lock:
+            generation = self._retrieval_generation.get(user_id, 0)
+
+        deadlines = settings.retrieval_deadlines
+        # 1. Vector Search (Semantic)
+        sources = {
+            "vector": (asyncio.to_thread(self.vector_search, user_id, query, n_results), deadlines["vector"], [])
+        }
         # 2. Keyword Search (Exact)
-        keyword_docs = []
         if keywords:
-            keyword_docs = self.search_by_keyword(user_id, keywords, limit=n_results)
+            sources["keyword"] = (asyncio.to_thread(self.search_by_keyword, user_id, keywords, n_results), deadlines["keyword"], [])
+
+        found, statuses = await retrieval_orchestrator.gather_with_status(sources)
+        vector_docs = found["vector"]
+        keyword_docs = found.get("keyword", [])
 
         # 3. RRF Fusion (Reciprocal Rank Fusion)
         # Score = 1 / (k + rank)
@@ -332,41 +796,62 @@ class MemoryService:
         # Vector search result might not have timestamp in content (it stores raw text).
         # We should probably format vector results too if possible, but metadata is separate.
         # For now, let's just return the strings.
+
+        # Only cache complete results; a timed-out source would pin a partial answer
+        if all(status == "ok" for status in statuses.values()):
+            self._retrieval_cache_put(cache_key, generation, final_memories)
         
         return final_memories
 
-    def delete_user_memory(self, user_id: str):
-        """Delete all memories for a specific user from Chroma, Redis, and SQLite."""
+    async def delete_user_memory(self, user_id: str):
+        """
+        Delete all memories for a specific user from Chroma, Redis, and SQLite.
+        The tombstone makes the other workers drop their queued writes and cached reads for the user.
+        """
+        # 0. Drop pending writes for the user first, so none land after (or re-create) the deleted data:
+        # everywhere through the tombstone, and right away in this process through the callbacks
+        await user_tombstones.mark(user_id)
+        for callback in self._user_deleted_callbacks:
+            await asyncio.to_thread(callback, user_id)
+
         # 1. Delete from ChromaDB
         try:
-            self.chroma_client.delete_collection(name=f"memories_{user_id}")
+            await asyncio.to_thread(self.chroma_client.delete_collection, name=f"memories_{user_id}")
         except Exception as e:
             print(f"Error deleting Chroma collection for {user_id}: {e}")
             # Collection might not exist or other error, continue to delete other data
+        finally:
+            # The cached handle points at a deleted collection either way
+            self.invalidate_user_collection(user_id)
+            self.invalidate_retrieval_cache(user_id)
 
         # 2. Delete from Redis
         try:
-            keys = redis_client.keys(f"chat:{user_id}:*")
+            keys = [key async for key in async_redis_client.scan_iter(match=f"chat:{user_id}:*")]
             if keys:
-                redis_client.delete(*keys)
+                await async_redis_client.delete(*keys)
         except Exception as e:
             print(f"Error deleting Redis keys for {user_id}: {e}")
             # Redis might be down, continue to delete SQLite data
 
-        # 3. Delete from SQLite
+        # 3. Delete from SQLite (flush queued rows first so none are written after the delete)
+        await asyncio.to_thread(write_behind.flush)
+        await asyncio.to_thread(self._delete_user_rows, user_id)
+
+    def _delete_user_rows(self, user_id: str):
+        """Delete all SQLite rows belonging to a user (blocking)."""
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
-            cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
-            # Phase 2: Delete summaries and timeline
-            cursor.execute("DELETE FROM weekly_summaries WHERE user_id = ?", (user_id,))
-            cursor.execute("DELETE FROM monthly_summaries WHERE user_id = ?", (user_id,))
-            cursor.execute("DELETE FROM yearly_summaries WHERE user_id = ?", (user_id,))
-            cursor.execute("DELETE FROM memory_timeline WHERE user_id = ?", (user_id,))
-            
-            conn.commit()
-            conn.close()
+            with db_transaction() as conn:
+                cursor = conn.cursor()
+                cursor.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
+                cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+                # Phase 2: Delete summaries and timeline
+                cursor.execute("DELETE FROM weekly_summaries WHERE user_id = ?", (user_id,))
+                cursor.execute("DELETE FROM monthly_summaries WHERE user_id = ?", (user_id,))
+                cursor.execute("DELETE FROM yearly_summaries WHERE user_id = ?", (user_id,))
+                cursor.execute("DELETE FROM memory_timeline WHERE user_id = ?", (user_id,))
+                # Summary ledger: otherwise catch-up sees the user's periods as already done
+                cursor.execute("DELETE FROM summary_jobs WHERE user_id = ?", (user_id,))
         except Exception as e:
             print(f"Error deleting SQLite data for {user_id}: {e}")
             raise e # Re-raise for SQLite as it is critical
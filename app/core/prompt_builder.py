@@ -0,0 +1,144 @@
+import re
+from app.config import settings
+from app.core.tokens import count_tokens, truncate_to_tokens
+
+# "User: ...", "Aveline: ...", "[2026-02-16 10:00] user: ..." -> the message body
+_SPEAKER_PREFIX = re.compile(r"^(?:\[[^\]]*\]\s*)?[^:：\n]{1,20}[:：]\s*")
+_WHITESPACE = re.compile(r"\s+")
+
+NO_MEMORY_TEXT = "（本轮无需回忆）"
+CLOSING_TEXT = "请基于以上人设和记忆与用户对话。"
+
+def _dedupe_key(text: str) -> str:
+    return _WHITESPACE.sub(" ", text).strip()
+
+def _body(text: str) -> str:
+    return _dedupe_key(_SPEAKER_PREFIX.sub("", text, count=1))
+
+class PromptBuilder:
+    """
+    Assembles the chat messages for a turn under settings.prompt_token_budget.
+    Persona, time header, context flags and the user message are always kept. What's
+    left is shared between history (newest first, at least prompt_history_share of it
+    when there is that much) and memory blocks (kept in rank order, deduplicated,
+    the last one truncated by lines to fit); history then takes any unused remainder.
+    Token counts come from tokens.count_tokens (local tokenizer or offline estimate).
+
+    Layout is prefix-cache friendly: the persona is the first system message, byte for
+    byte the same every turn, and is the cacheable prefix. History follows it but is
+    not stable: it is a sliding window trimmed from the oldest end, so its start moves
+    as the conversation grows. The volatile parts (time header, flags, memories) go in
+    a second system message just before the user message.
+    """
+    def build(self, persona: str, time_header: str, extra_context: list, memories: list, history: list, message: str):
+        """Returns (messages, report) where report holds per-section token counts."""
+        budget = settings.prompt_token_budget
+        extra_text = "\n".join(extra_context)
+        fixed = {
+            "time": count_tokens(time_header),
+            "persona": count_tokens(persona),
+            "extra": count_tokens(extra_text),
+            "message": count_tokens(message),
+        }
+        framing = count_tokens(f"【相关记忆】\n{NO_MEMORY_TEXT}\n{CLOSING_TEXT}")
+        available = max(0, budget - sum(fixed.values()) - framing)
+
+        # 1. History: newest messages first, up to the reserved share
+        history_costs = [count_tokens(msg["content"]) + 4 for msg in history]  # + role/formatting overhead
+        reserve = min(sum(history_costs), int(available * settings.prompt_history_share))
+        kept_from = self._fit_history(history_costs, reserve, len(history))
+        history_used = sum(history_costs[kept_from:])
+
+        # 2. Memories: rank order, skip duplicates (of each other, of kept history, of the message)
+        seen = {_dedupe_key(msg["content"]) for msg in history[kept_from:]}
+        seen.add(_dedupe_key(message))
+        memory_blocks, memory_used, dropped = self._fit_memories(memories, available - history_used, seen)
+
+        # 3. Hand any unused budget back to older history
+        kept_from = self._fit_history(history_costs, available - memory_used, len(history))
+        history_used = sum(history_costs[kept_from:])
+        kept_history = history[kept_from:]
+
+        memory_context = "\n\n".join(memory_blocks)
+        turn_context = time_header.strip()
+        if extra_text:
+            turn_context += "\n\n" + extra_text
+        turn_context += f"""
+
+【相关记忆】
+{memory_context if memory_context else NO_MEMORY_TEXT}
+
+{CLOSING_TEXT}
+"""
+        messages = [{"role": "system", "content": persona}]
+        for msg in kept_history:
+            messages.append({"role": msg["role"], "content": msg["content"]})
+        messages.append({"role": "system", "content": turn_context})
+        messages.append({"role": "user", "content": message})
+
+        report = dict(fixed)
+        report.update({
+            "memories": memory_used,
+            "memory_blocks": f"{len(memory_blocks)}/{len(memories)}",
+            "memory_dropped": dropped,
+            "history": history_used,
+            "history_messages": f"{len(kept_history)}/{len(history)}",
+            "total": sum(fixed.values()) + framing + memory_used + history_used,
+            "budget": budget,
+        })
+        print("[prompt] " + " ".join(f"{key}={value}" for key, value in report.items()))
+        return messages, report
+
+    @staticmethod
+    def _fit_history(costs: list, budget: int, count: int) -> int:
+        """Index of the oldest message kept when taking the newest ones that fit in budget."""
+        used = 0
+        kept_from = count
+        for index in range(count - 1, -1, -1):
+            if used + costs[index] > budget:
+                break
+            used += costs[index]
+            kept_from = index
+        return kept_from
+
+    def _fit_memories(self, memories: list, budget: int, seen: set):
+        """Returns (kept blocks, tokens used, number of duplicate/overflow blocks dropped)."""
+        kept, used, dropped = [], 0, 0
+        for position, block in enumerate(memories):
+            key = _dedupe_key(block)
+            if not key or key in seen or _body(block) in seen:
+                dropped += 1
+                continue
+            seen.add(key)
+            cost = count_tokens(block) + 2  # blank line between blocks
+            if used + cost <= budget:
+                kept.append(block)
+                used += cost
+                continue
+            # Doesn't fit: keep as much of it as we can, then stop
+            truncated = self._truncate_block(block, budget - used - 2)
+            if truncated:
+                kept.append(truncated)
+                used += count_tokens(truncated) + 2
+            dropped += len(memories) - position - (1 if truncated else 0)
+            break
+        return kept, used, dropped
+
+    @staticmethod
+    def _truncate_block(block: str, budget: int) -> str:
+        """Keep whole lines (a block's header line is useless alone); a one-line block is cut mid-text."""
+        if budget <= 0:
+            return ""
+        lines = block.split("\n")
+        if len(lines) == 1:
+            text = truncate_to_tokens(block, budget - 1, count_tokens)
+            return text + "…" if text else ""
+        kept = []
+        for line in lines:
+            candidate = "\n".join(kept + [line])
+            if count_tokens(candidate) > budget:
+                break
+            kept.append(line)
+        return "\n".join(kept) if len(kept) > 1 else ""
+
+prompt_builder = PromptBuilder()
@@ -0,0 +1,42 @@
+import threading
+import time
+
+class RateLimiter:
+    """
+    Blocking token-bucket limiter for an upstream API, shared by worker threads.
+    Two buckets refill continuously: requests per minute and (optionally) tokens per minute.
+    acquire() waits until both have room, so bursts are smoothed instead of hitting 429s.
+    """
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int = 0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = float(requests_per_minute)
+        self._tokens = float(tokens_per_minute)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.waited_seconds = 0.0
+
+    def acquire(self, tokens: int = 0):
+        # A single call larger than the whole bucket would wait forever
+        tokens = min(tokens, self.tokens_per_minute) if self.tokens_per_minute else 0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+                wait = max(
+                    (1 - self._requests) * 60.0 / self.requests_per_minute,
+                    (tokens - self._tokens) * 60.0 / self.tokens_per_minute if tokens else 0.0,
+                )
+                self.waited_seconds += wait
+            time.sleep(wait)
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60.0)
+        if self.tokens_per_minute:
+            self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60.0)
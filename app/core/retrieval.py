@@ -0,0 +1,53 @@
+import asyncio
+import time
+
+class RetrievalOrchestrator:
+    """
+    Runs independent retrieval sources concurrently, each under its own deadline.
+    A source that misses its deadline (or fails) yields its default instead of
+    holding up the turn, so tail latency is bounded by the slowest deadline.
+    """
+    async def gather(self, sources: dict) -> dict:
+        """
+        sources: {name: (awaitable, deadline_seconds, default)}
+        Awaitables may be coroutines or already-running tasks (prefetched sources).
+        Returns: {name: result or default}
+        """
+        results, _ = await self.gather_with_status(sources)
+        return results
+
+    async def gather_with_status(self, sources: dict):
+        """Like gather(), also returning {name: "ok" | "timeout" | "error"} so callers can tell partial results apart."""
+        names = list(sources.keys())
+        outcomes = await asyncio.gather(*[
+            self._run_source(name, awaitable, deadline)
+            for name, (awaitable, deadline, _) in sources.items()
+        ])
+
+        results = {}
+        statuses = {}
+        report = []
+        for name, (ok, value, elapsed_ms, status) in zip(names, outcomes):
+            results[name] = value if ok else sources[name][2]
+            statuses[name] = status
+            report.append(f"{name}={status}:{elapsed_ms}ms")
+        if report:
+            print(f"[retrieval] {' '.join(report)}")
+        return results, statuses
+
+    async def _run_source(self, name: str, awaitable, deadline: float):
+        started = time.perf_counter()
+        try:
+            value = await asyncio.wait_for(awaitable, timeout=deadline)
+            return True, value, self._elapsed_ms(started), "ok"
+        except asyncio.TimeoutError:
+            return False, None, self._elapsed_ms(started), "timeout"
+        except Exception as e:
+            print(f"Retrieval source '{name}' failed: {e}")
+            return False, None, self._elapsed_ms(started), "error"
+
+    @staticmethod
+    def _elapsed_ms(started: float) -> int:
+        return int((time.perf_counter() - started) * 1000)
+
+retrieval_orchestrator = RetrievalOrchestrator()
@@ -1,61 +1,178 @@
+import re
 import sqlite3
-from app.db.sqlite import get_db_connection
+import threading
+import time
+from collections import OrderedDict
+from app.config import settings
+
+# String literals and comments, blanked out before structural checks
+_LITERALS = re.compile(r"'(?:[^']|'')*'|--[^\n]*|/\*.*?(?:\*/|$)", re.DOTALL)
+# Schema-qualified names (main.x, "temp".x, [main].x) would bypass the per-user CTEs
+_SCHEMA_QUALIFIER = re.compile(r"""(?:\b|["`\[])(?:main|temp|temporary)(?:\b|["`\]])\s*\.""", re.IGNORECASE)
+_WHITESPACE = re.compile(r"\s+")
+
+# Never callable from generated SQL, whatever the build enables
+_FORBIDDEN_FUNCTIONS = {"load_extension", "readfile", "writefile", "edit", "fts3_tokenizer"}
+
+class SQLRejected(Exception):
+    """Generated SQL that the sandbox refuses to run."""
 
 class SQLQueryTool:
+    """
+    Sandboxed execution of intent-generated SELECTs.
+    - Read-only URI connection (one per thread) with query_only on.
+    - Every allowed table is shadowed by a CTE of the same name holding only the current
+      user's rows, so scoping doesn't depend on what the model wrote; schema-qualified
+      names (main.conversations) that would bypass it are rejected.
+    - An authorizer allows only SELECT, reads of allowed tables and safe functions.
+    - EXPLAIN QUERY PLAN rejects full-table scans and unindexed nested-loop joins.
+    - A progress-handler deadline (settings.sql_tool_timeout) and a row cap
+      (settings.sql_tool_max_rows) bound every run.
+    - Results are cached per (user, normalized SQL) for settings.sql_tool_cache_ttl.
+    """
     def __init__(self):
-        self.allowed_tables = ["conversations", "weekly_summaries", "monthly_summaries", "yearly_summaries"]
-        
+        self.allowed_tables = [
+            "conversations", "weekly_summaries", "monthly_summaries", "yearly_summaries",
+            # Rollups maintained by triggers (migration 6): constant-time answers for stats questions
+            "conversation_user_stats", "conversation_daily_stats", "conversation_hourly_stats",
+        ]
+        self._local = threading.local()
+        self._cache = OrderedDict()  # (user_id, normalized sql) -> (expires_at, results)
+        self._cache_lock = threading.Lock()
+        self._stats = {"queries": 0, "cache_hits": 0, "rejected": 0, "timeouts": 0, "errors": 0, "truncated": 0}
+
+    def _connection(self) -> sqlite3.Connection:
+        """This thread's read-only connection, opened on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                f"file:{settings.sqlite_path}?mode=ro",
+                uri=True,
+                timeout=settings.sqlite_busy_timeout_ms / 1000,
+                check_same_thread=False
+            )
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA query_only=ON")
+            conn.set_authorizer(self._authorize)
+            self._local.conn = conn
+        return conn
+
+    def _authorize(self, action, arg1, arg2, db_name, trigger):
+        if action == sqlite3.SQLITE_SELECT:
+            return sqlite3.SQLITE_OK
+        if action == sqlite3.SQLITE_READ:
+            return sqlite3.SQLITE_OK if arg1 in self.allowed_tables else sqlite3.SQLITE_DENY
+        if action == sqlite3.SQLITE_FUNCTION:
+            return sqlite3.SQLITE_DENY if (arg2 or "").lower() in _FORBIDDEN_FUNCTIONS else sqlite3.SQLITE_OK
+        # Writes, PRAGMA, ATTACH, recursive CTEs, ...
+        return sqlite3.SQLITE_DENY
+
+    @staticmethod
+    def normalize_sql(sql: str) -> str:
+        return _WHITESPACE.sub(" ", sql).strip().rstrip(";").strip()
+
     def validate_sql(self, sql: str) -> bool:
         """
-        Basic safety check for generated SQL.
-        Only allow SELECT statements on specific tables.
+        Structural checks before planning: a single SELECT (or WITH ... SELECT) without
+        schema-qualified names. Everything else is enforced by the authorizer.
         """
-        sql_upper = sql.upper().strip()
-        
-        # 1. Must be SELECT
-        if not sql_upper.startswith("SELECT"):
+        code = _LITERALS.sub(" ", sql)
+        if not re.match(r"\s*(SELECT|WITH)\b", code, re.IGNORECASE):
             return False
-            
-        # 2. No modification keywords
-        forbidden_keywords = ["INSERT", "UPDATE", "DELETE", "DROP", "ALTER", "TRUNCATE", "REPLACE", "GRANT", "REVOKE"]
-        for keyword in forbidden_keywords:
-            if keyword in sql_upper:
-                return False
-                
-        # 3. Must not query system tables (basic check)
-        if "SQLITE_MASTER" in sql_upper or "SYSTEM_STATE" in sql_upper:
+        if ";" in code:
+            return False
+        if _SCHEMA_QUALIFIER.search(code):
             return False
-            
         return True
 
+    def _scoped(self, sql: str) -> str:
+        """Wrap the query so each allowed table name resolves to the user's rows only, and cap rows."""
+        scopes = ",\n".join(
+            f"{table} AS (SELECT * FROM main.{table} WHERE user_id = :user_id)" for table in self.allowed_tables
+        )
+        return f"WITH {scopes}\nSELECT * FROM (\n{sql}\n) LIMIT {settings.sql_tool_max_rows + 1}"
+
+    def _check_plan(self, conn: sqlite3.Connection, scoped_sql: str, user_id: str):
+        """Raise SQLRejected for plans that scan a whole table or nest unindexed scans."""
+        plan = conn.execute(f"EXPLAIN QUERY PLAN {scoped_sql}", {"user_id": user_id}).fetchall()
+        scans_by_parent = {}
+        for node_id, parent, _, detail in plan:
+            if detail.startswith("SCAN main."):
+                raise SQLRejected(f"full table scan ({detail})")
+            if detail.startswith("SCAN ") and not detail.startswith(("SCAN (subquery", "SCAN CONSTANT ROW")):
+                scans_by_parent[parent] = scans_by_parent.get(parent, 0) + 1
+        if any(count > 1 for count in scans_by_parent.values()):
+            raise SQLRejected("join without a usable index")
+
+    def _run(self, conn: sqlite3.Connection, scoped_sql: str, user_id: str) -> list:
+        deadline = time.monotonic() + settings.sql_tool_timeout
+        conn.set_progress_handler(lambda: 1 if time.monotonic() > deadline else 0, 1000)
+        try:
+            return conn.execute(scoped_sql, {"user_id": user_id}).fetchall()
+        finally:
+            conn.set_progress_handler(None, 0)
+
     def execute_query(self, user_id: str, sql: str) -> list:
         """
-        Execute a safe SELECT query.
-        Forces user_id check to prevent data leaks.
+        Execute a generated SELECT scoped to user_id.
+        Returns result rows as strings, or a single "Error: ..." line.
         """
-        if not self.validate_sql(sql):
-            return ["Error: Invalid or unsafe SQL query."]
-            
-        # Safety: Enforce user_id filtering
-        # Check if user_id literal is present in SQL
-        if user_id not in sql:
-             return ["Error: Query must be scoped to the current user_id."]
+        sql = sql.strip().rstrip(";")
+        normalized = self.normalize_sql(sql)
+        cache_key = (user_id, normalized)
+        now = time.monotonic()
+        with self._cache_lock:
+            self._stats["queries"] += 1
+            entry = self._cache.get(cache_key)
+            if entry is not None and entry[0] > now:
+                self._cache.move_to_end(cache_key)
+                self._stats["cache_hits"] += 1
+                return list(entry[1])
 
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            conn.close()
-            
-            # Format results as string list
-            results = []
-            for row in rows:
-                # Convert row object to dict then string
-                results.append(str(dict(row)))
-            return results
-            
-        except Exception as e:
+            if not self.validate_sql(sql):
+                raise SQLRejected("only a single SELECT on the allowed tables is permitted")
+            conn = self._connection()
+            scoped_sql = self._scoped(sql)
+            self._check_plan(conn, scoped_sql, user_id)
+            rows = self._run(conn, scoped_sql, user_id)
+        except SQLRejected as e:
+            self._count("rejected")
+            print(f"[sql] rejected: {e} | {normalized}")
+            return [f"Error: Invalid or unsafe SQL query ({e})."]
+        except sqlite3.OperationalError as e:
+            if "interrupted" in str(e):
+                self._count("timeouts")
+                print(f"[sql] timed out after {settings.sql_tool_timeout}s | {normalized}")
+                return ["Error: Query took too long."]
+            self._count("errors")
+            return [f"SQL Execution Error: {str(e)}"]
+        except sqlite3.DatabaseError as e:
+            # Includes authorizer denials ("not authorized")
+            self._count("errors")
             return [f"SQL Execution Error: {str(e)}"]
 
-sql_tool = SQLQueryTool()
\ No newline at end of file
+        # Format results as string list
+        results = [str(dict(row)) for row in rows[:settings.sql_tool_max_rows]]
+        if len(rows) > settings.sql_tool_max_rows:
+            self._count("truncated")
+            results.append(f"(only the first {settings.sql_tool_max_rows} rows are shown)")
+
+        with self._cache_lock:
+            self._cache[cache_key] = (time.monotonic() + settings.sql_tool_cache_ttl, results)
+            self._cache.move_to_end(cache_key)
+            while len(self._cache) > settings.sql_tool_cache_size:
+                self._cache.popitem(last=False)
+        return list(results)
+
+    def _count(self, key: str):
+        with self._cache_lock:
+            self._stats[key] += 1
+
+    def stats(self) -> dict:
+        with self._cache_lock:
+            stats = dict(self._stats)
+            stats["cache_size"] = len(self._cache)
+        return stats
+
+sql_tool = SQLQueryTool()
@@ -1,9 +1,47 @@
+import itertools
 import json
-from datetime import datetime, timedelta
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
 import openai
 from app.config import settings
 from app.core.memory import memory_service
+from app.core.rate_limit import RateLimiter
+from app.core.tokens import estimate_tokens, token_windows
 from app.db.sqlite import get_db_connection
+from app.db.summary_ledger import summary_ledger
+
+# Worth retrying: throttling, timeouts, dropped connections and 5xx
+TRANSIENT_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+def period_start_of(level: str, day: date) -> date:
+    """First day of the week (Monday) / month / year containing day."""
+    if level == "week":
+        return day - timedelta(days=day.weekday())
+    if level == "month":
+        return day.replace(day=1)
+    return day.replace(month=1, day=1)
+
+def next_period_start(level: str, start: date) -> date:
+    if level == "week":
+        return start + timedelta(days=7)
+    if level == "month":
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return start.replace(year=start.year + 1)
+
+def period_end(level: str, start: date) -> date:
+    return next_period_start(level, start) - timedelta(days=1)
+
+def last_closed_period(level: str, today: date) -> date:
+    """Start of the most recent period that has fully ended (last week / month / year)."""
+    return period_start_of(level, period_start_of(level, today) - timedelta(days=1))
 
 class Summarizer:
     def __init__(self):
@@ -11,19 +49,34 @@ class Summarizer:
             api_key=settings.api_key,
             base_url=settings.api_base
         )
+        # Shared by all summary workers so the whole run stays under the provider limits
+        self.rate_limiter = RateLimiter(settings.summary_rpm, settings.summary_tpm)
+        self._stats_lock = threading.Lock()
+        self._job_context = threading.local()  # counters of the run the current worker belongs to
+        self.last_runs = {}
+        # Map step of map-reduce summaries (windows of one period); separate from the job
+        # pool so a job waiting on its windows can't starve them of workers
+        self._map_pool = ThreadPoolExecutor(max_workers=settings.summary_map_concurrency, thread_name_prefix="summary-map")
+        self._processors = {
+            "week": self.process_weekly_for_user,
+            "month": self.process_monthly_for_user,
+            "year": self.process_yearly_for_user,
+        }
 
-    def _generate_llm_summary(self, context_text: str, level: str) -> dict:
+    def _generate_llm_summary(self, context_text: str, level: str, partial: bool = False) -> dict:
         """
         Generate structured summary using LLM.
         level: 'week', 'month', 'year'
+        partial: summarizing one slice of the period (map step); the reduce step combines them
         """
         # Use deepseek-reasoner for higher-level abstractions (Month/Year)
-        # Use deepseek-chat for basic summarization (Week)
-        model_name = "deepseek-reasoner" if level in ["month", "year"] else "deepseek-chat"
+        # Use deepseek-chat for basic summarization (Week) and for partial slices
+        model_name = "deepseek-reasoner" if level in ["month", "year"] and not partial else "deepseek-chat"
+        level_label = f"{level.upper()} SUMMARY" + (" (PARTIAL: one chronological slice of the period)" if partial else "")
         
         system_prompt = f"""
 You are a professional memory architect. Your job is to distill conversation logs into high-level summaries.
-Level: {level.upper()} SUMMARY
+Level: {level_label}
 
 Input: Chronological conversation logs or lower-level summaries.
 Output: A JSON object with the following fields:
@@ -35,45 +88,101 @@ Output: A JSON object with the following fields:
 Ensure "key_events" contains 3-5 most significant items.
 Ensure "importance" is a float between 0.1 and 1.0.
 """
-        try:
-            response = self.client.chat.completions.create(
-                model=model_name,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": f"Context:\n{context_text}"}
-                ],
-                temperature=0.2,
-                response_format={"type": "json_object"}
-            )
-            return json.loads(response.choices[0].message.content)
-        except Exception as e:
-            print(f"Summary generation error ({model_name}): {e}")
+        estimated_tokens = estimate_tokens(system_prompt) + estimate_tokens(context_text)
+        for attempt in range(settings.summary_max_retries + 1):
+            self.rate_limiter.acquire(estimated_tokens)
+            self._count("llm_calls")
+            try:
+                response = self.client.chat.completions.create(
+                    model=model_name,
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": f"Context:\n{context_text}"}
+                    ],
+                    temperature=0.2,
+                    response_format={"type": "json_object"}
+                )
+                return json.loads(response.choices[0].message.content)
+            except TRANSIENT_ERRORS as e:
+                if attempt == settings.summary_max_retries:
+                    print(f"Summary generation error ({model_name}), giving up after {attempt + 1} attempts: {e}")
+                    return None
+                # Exponential backoff with full jitter so retries from all workers don't line up
+                delay = random.uniform(0, settings.summary_retry_base_delay * (2 ** attempt))
+                self._count("retries")
+                print(f"Summary generation transient error ({model_name}): {e}; retrying in {delay:.1f}s")
+                time.sleep(delay)
+            except Exception as e:
+                print(f"Summary generation error ({model_name}): {e}")
+                return None
+
+    def _summarize_lines(self, lines, level: str) -> dict:
+        """
+        Map-reduce summary over an iterable of context lines, with no truncation.
+        Lines are grouped into windows of at most settings.summary_window_tokens. One window
+        is summarized directly; otherwise each window is summarized in parallel (map) and
+        the partial summaries are summarized again (reduce, recursively if they still
+        don't fit one window) into the final JSON. Returns None if there are no lines.
+        """
+        windows = token_windows(lines, settings.summary_window_tokens)
+        first = next(windows, None)
+        if first is None:
             return None
+        second = next(windows, None)
+        if second is None:
+            result = self._generate_llm_summary("\n".join(first), level)
+            if not result:
+                raise RuntimeError("summary generation failed")
+            return result
 
-    def process_weekly_for_user(self, user_id: str):
-        """Generate weekly summary for last week (L1)."""
-        # ... (logic same as before) ...
-        # Calculate last week's range
-        today = datetime.now()
-        last_monday = today - timedelta(days=today.weekday() + 7)
-        last_sunday = last_monday + timedelta(days=6)
-        
-        start_date = last_monday.strftime("%Y-%m-%d")
-        end_date = last_sunday.strftime("%Y-%m-%d")
+        # Windows are submitted as the input is read, so the map step overlaps paging
+        counters = getattr(self._job_context, "counters", None)
+        futures = [
+            self._map_pool.submit(self._summarize_window, window, level, counters)
+            for window in itertools.chain([first, second], windows)
+        ]
+        partials = [future.result() for future in futures]
+        if any(partial is None for partial in partials):
+            raise RuntimeError("partial summary generation failed")
+
+        print(f"Reducing {len(partials)} partial {level} summaries")
+        return self._summarize_lines(
+            (self._format_partial(index, partial) for index, partial in enumerate(partials, 1)),
+            level
+        )
+
+    def _summarize_window(self, window: list, level: str, counters: dict):
+        self._job_context.counters = counters  # count map calls against the submitting run
+        return self._generate_llm_summary("\n".join(window), level, partial=True)
+
+    @staticmethod
+    def _format_partial(index: int, partial: dict) -> str:
+        return (
+            f"[Part {index}] Summary: {partial.get('summary', '')}\n"
+            f"Events: {json.dumps(partial.get('key_events', []), ensure_ascii=False)}\n"
+            f"Mood: {partial.get('emotional_trend', '')}\n"
+            f"Milestones: {partial.get('relationship_milestone')}"
+        )
+
+    def process_weekly_for_user(self, user_id: str, week_start: str = None):
+        """
+        Generate the weekly summary (L1) for the week starting week_start (default: last week).
+        Returns the summary id, or None if the week has no conversations.
+        """
+        start = date.fromisoformat(week_start) if week_start else last_closed_period("week", date.today())
+        start_date = start.isoformat()
+        end_date = period_end("week", start).isoformat()
         
-        # 1. Get L0 Memories
-        memories = memory_service.get_memories_by_date_range(user_id, start_date, end_date, format_result=False)
-        if not memories:
-            return 
-            
-        context_text = "\n".join([f"[{m['timestamp']}] {m['role']}: {m['message']}" for m in memories])
+        # 1. Stream every L0 message of the week (paged, no row limit)
+        memories = memory_service.iter_memories_by_date_range(user_id, start_date, end_date)
+        lines = (f"[{m['timestamp']}] {m['role']}: {m['message']}" for m in memories)
         
-        # 2. Generate Summary (v3)
-        result = self._generate_llm_summary(context_text, "week")
-        if not result:
-            return
+        # 2. Generate Summary (v3), map-reduced over token windows for heavy weeks
+        result = self._summarize_lines(lines, "week")
+        if result is None:
+            return None
 
-        # 3. Save L1 Summary
+        # 3. Save L1 Summary (upsert: one row per user and week)
         summary_id = memory_service.add_weekly_summary(
             user_id, 
             start_date, 
@@ -83,46 +192,32 @@ Ensure "importance" is a float between 0.1 and 1.0.
         )
         
         # 4. Update Timeline (L1)
-        for event in result.get("key_events", []):
-            memory_service.add_timeline_entry(
-                user_id=user_id,
-                date_key=event.get("date", start_date),
-                memory_id=f"summary_week_{summary_id}",
-                layer=1,
-                importance=event.get("importance", 0.5),
-                entities=event.get("entities", []),
-                content_preview=event.get("event", "")
-            )
+        self._replace_timeline(user_id, f"summary_week_{summary_id}", 1, result.get("key_events", []), start_date, 0.5)
         
-        print(f"Generated weekly summary for {user_id}")
-
-    def process_monthly_for_user(self, user_id: str):
-        """Generate monthly summary for last month (L2)."""
-        today = datetime.now()
-        # First day of current month
-        first_day_curr_month = today.replace(day=1)
-        # Last day of prev month
-        last_day_prev_month = first_day_curr_month - timedelta(days=1)
-        # First day of prev month
-        first_day_prev_month = last_day_prev_month.replace(day=1)
-        
-        start_date = first_day_prev_month.strftime("%Y-%m-%d")
-        end_date = last_day_prev_month.strftime("%Y-%m-%d")
+        print(f"Generated weekly summary for {user_id} ({start_date})")
+        return summary_id
+
+    def process_monthly_for_user(self, user_id: str, month_start: str = None):
+        """
+        Generate the monthly summary (L2) for the month starting month_start (default: last month).
+        Returns the summary id, or None if the month has no weekly summaries.
+        """
+        start = date.fromisoformat(month_start) if month_start else last_closed_period("month", date.today())
+        start_date = start.isoformat()
+        end_date = period_end("month", start).isoformat()
         
         # 1. Get L1 Weekly Summaries for this month range
         weekly_summaries = memory_service.get_weekly_summaries_by_range(user_id, start_date, end_date)
         if not weekly_summaries:
-            return # No weekly summaries to aggregate
+            return None # No weekly summaries to aggregate
             
-        context_text = "\n".join([
+        lines = [
             f"[Week {w['week_start']}] Summary: {w['summary']}\nEvents: {w['key_events']}\nMood: {w['emotional_trend']}" 
             for w in weekly_summaries
-        ])
+        ]
         
-        # 2. Generate Summary (Reasoning Model)
-        result = self._generate_llm_summary(context_text, "month")
-        if not result:
-            return
+        # 2. Generate Summary (Reasoning Model), map-reduced if it exceeds one window
+        result = self._summarize_lines(lines, "month")
             
         # 3. Save L2 Summary
         summary_id = memory_service.add_monthly_summary(
@@ -134,40 +229,32 @@ Ensure "importance" is a float between 0.1 and 1.0.
             result.get("relationship_milestone", "")
         )
         
-        # 4. Update Timeline (L2)
-        for event in result.get("key_events", []):
-            memory_service.add_timeline_entry(
-                user_id=user_id,
-                date_key=event.get("date", start_date),
-                memory_id=f"summary_month_{summary_id}",
-                layer=2,
-                importance=event.get("importance", 0.7), # Higher base importance
-                entities=event.get("entities", []),
-                content_preview=event.get("event", "")
-            )
-        print(f"Generated monthly summary for {user_id}")
-
-    def process_yearly_for_user(self, user_id: str):
-        """Generate yearly summary for last year (L3)."""
-        today = datetime.now()
-        prev_year = today.year - 1
-        start_date = f"{prev_year}-01-01"
-        end_date = f"{prev_year}-12-31"
+        # 4. Update Timeline (L2, higher base importance)
+        self._replace_timeline(user_id, f"summary_month_{summary_id}", 2, result.get("key_events", []), start_date, 0.7)
+        print(f"Generated monthly summary for {user_id} ({start_date})")
+        return summary_id
+
+    def process_yearly_for_user(self, user_id: str, year_start: str = None):
+        """
+        Generate the yearly summary (L3) for the year starting year_start (default: last year).
+        Returns the summary id, or None if the year has no monthly summaries.
+        """
+        start = date.fromisoformat(year_start) if year_start else last_closed_period("year", date.today())
+        start_date = start.isoformat()
+        end_date = period_end("year", start).isoformat()
         
         # 1. Get L2 Monthly Summaries
         monthly_summaries = memory_service.get_monthly_summaries_by_range(user_id, start_date, end_date)
         if not monthly_summaries:
-            return
+            return None
             
-        context_text = "\n".join([
+        lines = [
             f"[Month {m['month_start']}] Summary: {m['summary']}\nEvents: {m['key_events']}\nMilestones: {m['relationship_milestone']}" 
             for m in monthly_summaries
-        ])
+        ]
         
-        # 2. Generate Summary (Reasoning Model)
-        result = self._generate_llm_summary(context_text, "year")
-        if not result:
-            return
+        # 2. Generate Summary (Reasoning Model), map-reduced if it exceeds one window
+        result = self._summarize_lines(lines, "year")
             
         # 3. Save L3 Summary
         summary_id = memory_service.add_yearly_summary(
@@ -179,44 +266,135 @@ Ensure "importance" is a float between 0.1 and 1.0.
             result.get("relationship_milestone", "")
         )
         
-        # 4. Update Timeline (L3)
-        for event in result.get("key_events", []):
-            memory_service.add_timeline_entry(
-                user_id=user_id,
-                date_key=event.get("date", start_date),
-                memory_id=f"summary_year_{summary_id}",
-                layer=3,
-                importance=event.get("importance", 0.9), # Highest base importance
-                entities=event.get("entities", []),
-                content_preview=event.get("event", "")
-            )
-        print(f"Generated yearly summary for {user_id}")
+        # 4. Update Timeline (L3, highest base importance)
+        self._replace_timeline(user_id, f"summary_year_{summary_id}", 3, result.get("key_events", []), start_date, 0.9)
+        print(f"Generated yearly summary for {user_id} ({start_date})")
+        return summary_id
+
+    def _replace_timeline(self, user_id: str, memory_id: str, layer: int, key_events: list, default_date: str, base_importance: float):
+        """Regenerating a period replaces its timeline rows instead of adding another set."""
+        memory_service.replace_timeline_entries(user_id, memory_id, [
+            {
+                "date_key": event.get("date", default_date),
+                "layer": layer,
+                "importance": event.get("importance", base_importance),
+                "entities": event.get("entities", []),
+                "content_preview": event.get("event", ""),
+            }
+            for event in key_events
+        ])
+
+    def summarize_period(self, user_id: str, level: str, period_start: str) -> str:
+        """
+        Generate one (user, level, period) summary unless the ledger already has it.
+        Returns 'skipped' (already final, or claimed by a run in progress), 'done' or 'empty' (no source data, no LLM call).
+        Failures are recorded in the ledger and re-raised.
+        """
+        if not summary_ledger.claim(user_id, level, period_start):
+            return "skipped"
+        try:
+            summary_id = self._processors[level](user_id, period_start)
+        except Exception as e:
+            summary_ledger.mark_finished(user_id, level, period_start, "failed", error=str(e)[:500])
+            raise
+        status = "done" if summary_id else "empty"
+        summary_ledger.mark_finished(user_id, level, period_start, status, summary_id=summary_id)
+        return status
 
     def run_all_weekly_summaries(self):
         """Entry point for scheduler (Weekly)."""
-        self._run_for_all_users(self.process_weekly_for_user, "Weekly")
+        self._run_for_all_users("week", "Weekly")
 
     def run_all_monthly_summaries(self):
         """Entry point for scheduler (Monthly)."""
-        self._run_for_all_users(self.process_monthly_for_user, "Monthly")
+        self._run_for_all_users("month", "Monthly")
         
     def run_all_yearly_summaries(self):
         """Entry point for scheduler (Yearly)."""
-        self._run_for_all_users(self.process_yearly_for_user, "Yearly")
+        self._run_for_all_users("year", "Yearly")
+
+    def catch_up_missed_summaries(self):
+        """
+        Generate every missing period for every user (startup / after downtime).
+        Levels run in order because weeks feed months and months feed years. Per user,
+        periods run from the one after the latest final ledger entry (or from the first
+        conversation) up to the last closed period, plus failed periods with attempts left.
+        """
+        print("Checking for missed summaries...")
+        first_dates = memory_service.get_first_message_dates()
+        today = date.today()
+        for level, task_name in (("week", "Weekly"), ("month", "Monthly"), ("year", "Yearly")):
+            last_closed = last_closed_period(level, today)
+            last_final = summary_ledger.last_final_periods(level)
+            pending = set(summary_ledger.retryable(level))
+            for user_id, first_date in first_dates.items():
+                if user_id in last_final:
+                    start = next_period_start(level, date.fromisoformat(last_final[user_id]))
+                else:
+                    start = period_start_of(level, date.fromisoformat(first_date))
+                while start <= last_closed:
+                    pending.add((user_id, start.isoformat()))
+                    start = next_period_start(level, start)
+            if not pending:
+                print(f"No missed {task_name.lower()} summaries")
+                continue
+            self._run_jobs([(user_id, level, period) for user_id, period in sorted(pending)], f"{task_name} catch-up")
 
-    def _run_for_all_users(self, process_func, task_name):
+    def _run_for_all_users(self, level: str, task_name: str):
         conn = get_db_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT user_id FROM users")
-        users = cursor.fetchall()
-        conn.close()
-        
-        print(f"Starting {task_name} summary task for {len(users)} users...")
-        for row in users:
+        period = last_closed_period(level, date.today()).isoformat()
+        return self._run_jobs([(row["user_id"], level, period) for row in cursor.fetchall()], task_name)
+
+    def _run_jobs(self, jobs: list, task_name: str):
+        """
+        Run (user_id, level, period_start) summary jobs on a bounded worker pool.
+        Parallelism comes from settings.summary_concurrency; the shared rate limiter
+        keeps the run under the provider's RPM/TPM, and the first wave of jobs starts
+        after small random delays so it doesn't hit the API at the same instant.
+        """
+        print(f"Starting {task_name} summary task for {len(jobs)} jobs "
+              f"(concurrency={settings.summary_concurrency}, rpm={settings.summary_rpm})...")
+        counters = {"done": 0, "empty": 0, "skipped": 0, "failed": 0, "llm_calls": 0, "retries": 0}
+        started = time.monotonic()
+        waited_before = self.rate_limiter.waited_seconds
+
+        def job(index, spec):
+            user_id, level, period_start = spec
+            self._job_context.counters = counters
+            if index < settings.summary_concurrency:
+                time.sleep(random.uniform(0, settings.summary_start_jitter))
             try:
-                process_func(row["user_id"])
+                self._count(self.summarize_period(user_id, level, period_start))
             except Exception as e:
-                print(f"Error processing {task_name} for user {row['user_id']}: {e}")
+                self._count("failed")
+                print(f"Error processing {task_name} for user {user_id} ({period_start}): {e}")
+
+        with ThreadPoolExecutor(max_workers=settings.summary_concurrency, thread_name_prefix="summary") as pool:
+            list(pool.map(job, range(len(jobs)), jobs))
+
+        duration = time.monotonic() - started
+        with self._stats_lock:
+            report = dict(counters)
+        report.update({
+            "jobs": len(jobs),
+            "duration_s": round(duration, 1),
+            "jobs_per_min": round(len(jobs) / duration * 60, 1) if duration else 0.0,
+            "rate_limited_s": round(self.rate_limiter.waited_seconds - waited_before, 1),
+            "finished_at": datetime.now().isoformat(timespec="seconds"),
+        })
+        self.last_runs[task_name] = report
+        print(f"{task_name} summary task finished: {report}")
+        return report
+
+    def _count(self, key: str):
+        counters = getattr(self._job_context, "counters", None)
+        if counters is not None:
+            with self._stats_lock:
+                counters[key] += 1
 
+    def stats(self) -> dict:
+        return {"last_runs": dict(self.last_runs), "ledger": summary_ledger.stats()}
 
 summarizer = Summarizer()
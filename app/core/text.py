@@ -0,0 +1,8 @@
+import re
+import unicodedata
+
+_WHITESPACE = re.compile(r"\s+")
+
+def normalize_text(text: str) -> str:
+    """Normalization used for cache keys and rule matching: NFKC, trimmed, collapsed whitespace, lower-case."""
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFKC", text)).strip().lower()
@@ -1,27 +1,60 @@
+from collections import OrderedDict
 from datetime import datetime
 import json
+import threading
 import openai
 from app.config import settings
+from app.core.text import normalize_text
+from app.core.time_rules import local_time_parser
+
+_MISSING = object()
 
 class TimeParser:
     def __init__(self):
-        self.client = openai.OpenAI(
+        self.client = openai.AsyncOpenAI(
             api_key=settings.api_key,
             base_url=settings.api_base
         )
+        # (normalized phrase, current date) -> parsed range or None
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"memo_hits": 0, "local": 0, "llm": 0}
 
-    def parse_time_query(self, query: str) -> dict:
+    async def parse_time_query(self, query: str) -> dict:
         """
         Parse natural language time query into date range.
         Returns a dict with 'start_date' and 'end_date' (YYYY-MM-DD string) or None if no time found.
+        Common expressions are resolved by the local rule parser; only phrases it can't
+        match go to the LLM. Results are memoized per (normalized phrase, current date).
         """
         now = datetime.now()
+        key = (normalize_text(query), now.date().isoformat())
+        cached = self._memo_get(key)
+        if cached is not _MISSING:
+            return dict(cached) if cached else None
+
+        parsed = local_time_parser.parse(query, now.date())
+        if parsed:
+            self._bump("local")
+            self._memo_put(key, parsed)
+            return dict(parsed)
+
+        self._bump("llm")
+        try:
+            parsed = await self._parse_with_llm(query, now)
+        except Exception as e:
+            # print(f"Time extraction error: {e}") 
+            return None
+        self._memo_put(key, parsed)
+        return dict(parsed) if parsed else None
+
+    async def _parse_with_llm(self, query: str, now: datetime) -> dict:
         current_date = now.strftime("%Y-%m-%d")
         weekday = now.strftime("%A")
         
+        # Static instructions first (cacheable prefix), today's date last
         system_prompt = f"""
 You are a precise time entity extraction system.
-Current Date: {current_date} ({weekday})
 
 Your task is to extract the time range mentioned in the user's query relative to the Current Date.
 If the user mentions a specific date or relative time (e.g. "yesterday", "last week", "January 30th", "two days ago"), calculate the precise start and end dates.
@@ -46,33 +79,55 @@ Output: {{"start_date": "2026-02-14", "end_date": "2026-02-14"}}
 
 Query: "Hello there"
 Output: {{"start_date": null, "end_date": null}}
+
+Current Date: {current_date} ({weekday})
 """
         
-        try:
-            response = self.client.chat.completions.create(
-                model="deepseek-chat",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": query}
-                ],
-                temperature=0.1,
-                response_format={"type": "json_object"} 
-            )
-            
-            result = response.choices[0].message.content
-            
-            if not result:
-                return None
-                
-            parsed = json.loads(result)
-            
-            if not parsed.get("start_date") or not parsed.get("end_date"):
-                return None
-                
-            return parsed
+        response = await self.client.chat.completions.create(
+            model="deepseek-chat",
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": query}
+            ],
+            temperature=0.1,
+            response_format={"type": "json_object"} 
+        )
+        
+        result = response.choices[0].message.content
+        
+        if not result:
+            return None
             
-        except Exception as e:
-            # print(f"Time extraction error: {e}") 
+        parsed = json.loads(result)
+        
+        if not parsed.get("start_date") or not parsed.get("end_date"):
             return None
+            
+        return parsed
+
+    def _memo_get(self, key: tuple):
+        with self._lock:
+            if key not in self._memo:
+                return _MISSING
+            self._memo.move_to_end(key)
+            self._stats["memo_hits"] += 1
+            return self._memo[key]
+
+    def _memo_put(self, key: tuple, parsed):
+        with self._lock:
+            self._memo[key] = parsed
+            self._memo.move_to_end(key)
+            while len(self._memo) > settings.time_parse_memo_size:
+                self._memo.popitem(last=False)
+
+    def _bump(self, key: str):
+        with self._lock:
+            self._stats[key] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memo_size"] = len(self._memo)
+        return stats
 
 time_parser = TimeParser()
@@ -0,0 +1,355 @@
+import calendar
+import re
+from datetime import date, timedelta
+from app.core.text import normalize_text
+
+# Rule-based time-expression parser that runs before the LLM TimeParser.
+# Text is normalized first (NFKC, lower-case), so full-width digits and
+# "Last Week" behave like their plain forms. English patterns use letter
+# lookarounds instead of \b because CJK characters count as word characters.
+
+_CN_DIGITS = {"零": 0, "〇": 0, "一": 1, "二": 2, "两": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+_EN_NUMBERS = {
+    "a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6,
+    "seven": 7, "eight": 8, "nine": 9, "ten": 10, "eleven": 11, "twelve": 12, "a couple of": 2,
+}
+_EN_WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+_CN_WEEKDAYS = {"一": 0, "二": 1, "三": 2, "四": 3, "五": 4, "六": 5, "日": 6, "天": 6, "1": 0, "2": 1, "3": 2, "4": 3, "5": 4, "6": 5, "7": 6}
+_EN_MONTHS = {
+    "january": 1, "jan": 1, "february": 2, "feb": 2, "march": 3, "mar": 3, "april": 4, "apr": 4,
+    "may": 5, "june": 6, "jun": 6, "july": 7, "jul": 7, "august": 8, "aug": 8,
+    "september": 9, "sep": 9, "sept": 9, "october": 10, "oct": 10, "november": 11, "nov": 11,
+    "december": 12, "dec": 12,
+}
+
+_CN_NUM = r"[\d一二两三四五六七八九十几]+"
+_EN_NUM = r"\d+|a couple of|an?|one|two|three|four|five|six|seven|eight|nine|ten|eleven|twelve|(?:a )?few"
+_EN_MONTH = r"(?<![a-z])(" + "|".join(sorted(_EN_MONTHS, key=len, reverse=True)) + r")(?![a-z])"
+# Month and day: 3月12 / 3月12日 / 三月十二号 (append "?" to make the day optional)
+_CN_MONTH_DAY = r"(\d{1,2}|[一二三四五六七八九十]{1,2})\s*月(?:\s*(\d{1,2}(?!\d)|[一二三四五六七八九十]{1,3}(?=[日号]))\s*[日号]?)"
+_CN_WEEK = r"(?:个)?(?:周|星期|礼拜)"
+# Chinese prefixes: 上上 = two back, 上 = one back, 这/本 = current
+_CN_PREFIX = r"(上上|上|这|本)"
+_CN_YEARS_BACK = {"大前年": 3, "前年": 2, "去年": 1, "今年": 0}
+# A year word that isn't about when something happened: 我今年25岁 / 你今年多大了
+_NOT_TIME = re.compile(r"(?:大前年|前年|去年|今年)[^，。,.!?！？\s]{0,5}?(?:岁|多大)")
+
+def _to_int(token: str):
+    """Parse digits, Chinese numerals up to 99 and small English number words. Returns None for vague counts."""
+    token = token.strip()
+    if token.isdigit():
+        return int(token)
+    if token in _EN_NUMBERS:
+        return _EN_NUMBERS[token]
+    if "十" in token:
+        tens, _, units = token.partition("十")
+        if (tens and tens not in _CN_DIGITS) or (units and units not in _CN_DIGITS):
+            return None
+        return (_CN_DIGITS[tens] if tens else 1) * 10 + (_CN_DIGITS[units] if units else 0)
+    if len(token) == 1 and token in _CN_DIGITS:
+        return _CN_DIGITS[token]
+    return None
+
+def _add_months(day: date, months: int) -> date:
+    month_index = day.year * 12 + day.month - 1 + months
+    year, month = divmod(month_index, 12)
+    month += 1
+    return date(year, month, min(day.day, calendar.monthrange(year, month)[1]))
+
+def _month_range(year: int, month: int):
+    return date(year, month, 1), date(year, month, calendar.monthrange(year, month)[1])
+
+def _week_start(today: date, weeks_back: int = 0) -> date:
+    return today - timedelta(days=today.weekday() + 7 * weeks_back)
+
+def _past_month(today: date, month: int, day: int = None):
+    """A month (or month/day) without a year means its most recent occurrence."""
+    year = today.year
+    if month > today.month or (day and month == today.month and day > today.day):
+        year -= 1
+    if day:
+        single = date(year, month, day)
+        return single, single
+    return _month_range(year, month)
+
+class LocalTimeParser:
+    """
+    Deterministic parser for common Chinese and English time expressions.
+    parse() returns {"start_date", "end_date"} like the LLM TimeParser, or None if
+    no rule matches or the expression names an impossible date. Rules are tried in
+    order (most specific first); the first rule that resolves wins.
+    Queries the rules can't answer as one range also return None and go to the LLM:
+    several separate time expressions (上周三和上周五) or a year word used for an
+    age (我今年25岁).
+    "This week/month/year" ends today; past periods are whole.
+    """
+    def __init__(self):
+        self._rules = [
+            # Explicit dates
+            (r"(\d{4})\s*[-/.年]\s*(\d{1,2})\s*[-/.月]\s*(\d{1,2})(?!\d)\s*[日号]?", self._full_date),
+            (r"(\d{4})\s*(?:[-/.]|年)\s*(\d{1,2})(?!\d)\s*月?", self._year_month),
+            (r"(今年|去年|前年|大前年)\s*" + _CN_MONTH_DAY + r"?", self._cn_year_month_day),
+            (_CN_MONTH_DAY, self._month_day),
+            (_EN_MONTH + r"\s+(\d{1,2})(?:st|nd|rd|th)?(?!\d)(?:,?\s+(\d{4}))?", self._en_month_day),
+            (r"(?<!\d)(\d{1,2})(?:st|nd|rd|th)?\s+(?:of\s+)?" + _EN_MONTH + r"(?:,?\s+(\d{4}))?", self._en_day_month),
+            (r"(\d{4})\s*年", self._year),
+            # Rolling windows: 最近7天 / 过去两周 / past 3 days / last 2 weeks
+            (r"(?:最近|近|过去)\s*(" + _CN_NUM + r")\s*(天|日|周|个星期|星期|个礼拜|礼拜|个月|年)", self._cn_rolling),
+            (r"(?<![a-z])(?:the\s+)?(?:(?:last|past)\s+(" + _EN_NUM + r")|past)\s+(day|week|month|year)s?(?![a-z])", self._en_rolling),
+            # N units ago: 3天前 / 两周前 / 2 weeks ago
+            (r"(" + _CN_NUM + r")\s*(天|日|周|个星期|星期|个礼拜|礼拜|个月|年)(?:之)?前", self._cn_ago),
+            (r"(?<![a-z])(" + _EN_NUM + r")\s+(day|week|month|year)s?\s+ago(?![a-z])", self._en_ago),
+            # Same day in another year: 去年的今天 / this day last year (before the named days)
+            (r"(大前年|前年|去年|今年)\s*的?\s*(?:今天|今日|这天|这一天|同一天)"
+             r"|(?<![a-z])(?:this day|today) (last) year(?![a-z])", self._same_day_in_year),
+            # Named days
+            (r"大前天|(?<![a-z])three days ago(?![a-z])", lambda m, t: self._day(t, 3)),
+            (r"前天|(?<![a-z])(?:the\s+)?day before yesterday(?![a-z])", lambda m, t: self._day(t, 2)),
+            (r"昨天|昨日|昨晚|昨儿|(?<![a-z])(?:yesterday|last night)(?![a-z])", lambda m, t: self._day(t, 1)),
+            (r"今天|今日|今晚|今早|今儿|(?<![a-z])(?:today|tonight|this morning|this afternoon)(?![a-z])", lambda m, t: self._day(t, 0)),
+            # Weekdays: 上周三 / 这周五 / 周日 / last friday / on monday
+            (_CN_PREFIX + r"?\s*" + _CN_WEEK + r"([一二三四五六日天1-7])(?![起直定样般些次])", self._cn_weekday),
+            (r"(?<![a-z])(?:(last|this|on|past)\s+)?(" + "|".join(_EN_WEEKDAYS) + r")(?![a-z])", self._en_weekday),
+            # Weekends
+            (_CN_PREFIX + r"?\s*(?:个)?周末", self._cn_weekend),
+            (r"(?<![a-z])(last|this|the|past)\s+weekend(?![a-z])", self._en_weekend),
+            # Weeks, months, years
+            (_CN_PREFIX + r"\s*" + _CN_WEEK, lambda m, t: self._week(t, self._cn_back(m.group(1)))),
+            (r"(?<![a-z])(last|this)\s+week(?![a-z])", lambda m, t: self._week(t, 1 if m.group(1) == "last" else 0)),
+            (_CN_PREFIX + r"\s*(?:个)?月(?!前)", lambda m, t: self._month(t, self._cn_back(m.group(1)))),
+            (r"(?<![a-z])(last|this)\s+month(?![a-z])", lambda m, t: self._month(t, 1 if m.group(1) == "last" else 0)),
+            (r"大前年|前年|去年|今年|(?<![a-z])(?:last|this)\s+year(?![a-z])", self._named_year),
+            # Bare months: 一月 / 12月份 / in january
+            (r"(?<![\d年个])(\d{1,2}|十[一二]?|[一二三四五六七八九])\s*月(?!前)", self._cn_month),
+            (_EN_MONTH, self._en_month),
+            # Vague recent ranges
+            (r"前几天|前些天|前阵子|(?<![a-z])(?:the other day|a few days ago|few days ago)(?![a-z])",
+             lambda m, t: (t - timedelta(days=7), t - timedelta(days=1))),
+            (r"最近|这几天|这些天|近期|近来|(?<![a-z])(?:recently|lately|these days)(?![a-z])",
+             lambda m, t: (t - timedelta(days=6), t)),
+        ]
+        self._rules = [(re.compile(pattern), handler) for pattern, handler in self._rules]
+
+    def parse(self, query: str, today: date) -> dict:
+        text = normalize_text(query)
+        if _NOT_TIME.search(text):
+            return None
+        found = []  # (match start, match end, (start, end)) in rule order
+        for pattern, handler in self._rules:
+            for match in pattern.finditer(text):
+                try:
+                    resolved = handler(match, today)
+                except ValueError:
+                    # Impossible date ("2月30日"): don't widen it to a coarser rule (the
+                    # whole month) - leave it to the LLM parser
+                    return None
+                if resolved:
+                    found.append((match.start(), match.end(), resolved))
+        if not found:
+            return None
+        # Overlapping matches are one expression read by several rules ("上周三" is also "上周")
+        if self._expression_count(found) > 1:
+            return None
+        start, end = found[0][2]
+        return {"start_date": start.isoformat(), "end_date": end.isoformat()}
+
+    @staticmethod
+    def _expression_count(found: list) -> int:
+        count, covered_to = 0, -1
+        for match_start, match_end, _ in sorted(found):
+            if match_start >= covered_to:
+                count += 1
+            covered_to = max(covered_to, match_end)
+        return count
+
+    # --- Handlers: (match, today) -> (start, end) or None ---
+
+    @staticmethod
+    def _day(today: date, days_back: int):
+        day = today - timedelta(days=days_back)
+        return day, day
+
+    @staticmethod
+    def _cn_back(prefix: str) -> int:
+        return {"上上": 2, "上": 1}.get(prefix, 0)
+
+    @staticmethod
+    def _week(today: date, weeks_back: int):
+        start = _week_start(today, weeks_back)
+        return start, (today if weeks_back == 0 else start + timedelta(days=6))
+
+    @staticmethod
+    def _month(today: date, months_back: int):
+        if months_back == 0:
+            return today.replace(day=1), today
+        shifted = _add_months(today.replace(day=1), -months_back)
+        return _month_range(shifted.year, shifted.month)
+
+    @staticmethod
+    def _year_range(today: date, years_back: int):
+        if years_back == 0:
+            return date(today.year, 1, 1), today
+        return date(today.year - years_back, 1, 1), date(today.year - years_back, 12, 31)
+
+    def _full_date(self, match, today):
+        single = date(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+        return single, single
+
+    def _year_month(self, match, today):
+        month = int(match.group(2))
+        if not 1 <= month <= 12:
+            return None
+        return _month_range(int(match.group(1)), month)
+
+    def _year(self, match, today):
+        year = int(match.group(1))
+        return date(year, 1, 1), date(year, 12, 31)
+
+    def _same_day_in_year(self, match, today):
+        years_back = 1 if match.group(2) else _CN_YEARS_BACK[match.group(1)]
+        year = today.year - years_back
+        # 2月29日 in a year without one: the 28th
+        single = today.replace(year=year, day=min(today.day, calendar.monthrange(year, today.month)[1]))
+        return single, single
+
+    def _cn_year_month_day(self, match, today):
+        year = today.year - _CN_YEARS_BACK[match.group(1)]
+        month = _to_int(match.group(2))
+        if not month or not 1 <= month <= 12:
+            return None
+        if match.group(3) is None:
+            return _month_range(year, month)
+        day = _to_int(match.group(3))
+        if not day:
+            return None
+        single = date(year, month, day)
+        return single, single
+
+    def _month_day(self, match, today):
+        month, day = _to_int(match.group(1)), _to_int(match.group(2))
+        if not month or not day or not 1 <= month <= 12:
+            return None
+        return _past_month(today, month, day)
+
+    def _en_month_day(self, match, today):
+        month, day = _EN_MONTHS[match.group(1)], int(match.group(2))
+        if match.group(3):
+            single = date(int(match.group(3)), month, day)
+            return single, single
+        return _past_month(today, month, day)
+
+    def _en_day_month(self, match, today):
+        day, month = int(match.group(1)), _EN_MONTHS[match.group(2)]
+        if match.group(3):
+            single = date(int(match.group(3)), month, day)
+            return single, single
+        return _past_month(today, month, day)
+
+    def _cn_rolling(self, match, today):
+        return self._rolling(today, _to_int(match.group(1)), match.group(2))
+
+    def _en_rolling(self, match, today):
+        # "the past week" has no count
+        count = 1 if match.group(1) is None else _to_int(match.group(1))
+        return self._rolling(today, count, match.group(2))
+
+    @staticmethod
+    def _rolling(today: date, count, unit: str):
+        """A window ending today: 最近7天 = the 7 days up to and including today."""
+        if not count:
+            return None
+        if unit in ("天", "日", "day"):
+            return today - timedelta(days=count - 1), today
+        if unit in ("week", "周", "星期", "个星期", "礼拜", "个礼拜"):
+            return today - timedelta(days=7 * count - 1), today
+        months = count * 12 if unit in ("年", "year") else count
+        return _add_months(today, -months) + timedelta(days=1), today
+
+    def _cn_ago(self, match, today):
+        return self._ago(today, _to_int(match.group(1)), match.group(2))
+
+    def _en_ago(self, match, today):
+        return self._ago(today, _to_int(match.group(1)), match.group(2))
+
+    def _ago(self, today: date, count, unit: str):
+        """N days ago is a single day; N weeks/months/years ago is that whole calendar period."""
+        if unit in ("天", "日", "day"):
+            if count is None:
+                # 几天前 / a few days ago
+                return today - timedelta(days=7), today - timedelta(days=1)
+            return self._day(today, count)
+        if count is None:
+            return None
+        if unit in ("week", "周", "星期", "个星期", "礼拜", "个礼拜"):
+            start = _week_start(today, count)
+            return start, start + timedelta(days=6)
+        if unit in ("年", "year"):
+            return self._year_range(today, count)
+        return self._month(today, count)
+
+    def _cn_weekday(self, match, today):
+        weekday = _CN_WEEKDAYS[match.group(2)]
+        if match.group(1) is None:
+            # Plain 周三: the most recent one, today included
+            day = today - timedelta(days=(today.weekday() - weekday) % 7)
+        else:
+            day = _week_start(today, self._cn_back(match.group(1))) + timedelta(days=weekday)
+        return day, day
+
+    def _en_weekday(self, match, today):
+        qualifier, weekday = match.group(1), _EN_WEEKDAYS.index(match.group(2))
+        if qualifier == "this":
+            day = _week_start(today) + timedelta(days=weekday)
+        elif qualifier in ("last", "past"):
+            # "last friday": the most recent friday before today
+            day = today - timedelta(days=(today.weekday() - weekday - 1) % 7 + 1)
+        else:
+            day = today - timedelta(days=(today.weekday() - weekday) % 7)
+        return day, day
+
+    def _cn_weekend(self, match, today):
+        prefix = match.group(1)
+        if prefix is None:
+            return self._recent_weekend(today)
+        start = _week_start(today, self._cn_back(prefix)) + timedelta(days=5)
+        return start, start + timedelta(days=1)
+
+    def _en_weekend(self, match, today):
+        qualifier = match.group(1)
+        if qualifier == "this":
+            start = _week_start(today) + timedelta(days=5)
+            return start, start + timedelta(days=1)
+        if qualifier in ("last", "past"):
+            start = _week_start(today, 1) + timedelta(days=5)
+            return start, start + timedelta(days=1)
+        return self._recent_weekend(today)
+
+    @staticmethod
+    def _recent_weekend(today: date):
+        """Bare 周末 / the weekend: this one if we're in it, otherwise the last one."""
+        if today.weekday() >= 5:
+            return _week_start(today) + timedelta(days=5), today
+        start = _week_start(today, 1) + timedelta(days=5)
+        return start, start + timedelta(days=1)
+
+    def _named_year(self, match, today):
+        text = match.group(0)
+        years_back = _CN_YEARS_BACK.get(text)
+        if years_back is None:
+            years_back = 1 if text.startswith("last") else 0
+        return self._year_range(today, years_back)
+
+    def _cn_month(self, match, today):
+        month = _to_int(match.group(1))
+        if not month or not 1 <= month <= 12:
+            return None
+        return _past_month(today, month)
+
+    def _en_month(self, match, today):
+        name = match.group(1)
+        # "may" / "march" are also common verbs: only trust them after "in"
+        if name in ("may", "march", "mar") and not match.string[:match.start()].endswith("in "):
+            return None
+        return _past_month(today, _EN_MONTHS[name])
+
+local_time_parser = LocalTimeParser()
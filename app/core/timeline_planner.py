@@ -0,0 +1,113 @@
+from datetime import date, timedelta
+from app.config import settings
+from app.core.memory import memory_service
+from app.core.summarizer import period_start_of, period_end
+
+# Coarsest first
+LEVELS = ("year", "month", "week")
+
+LEVEL_LABELS = {"year": "这一年", "month": "这个月", "week": "这周"}
+
+class TimelinePlanner:
+    """
+    Chooses which memory layers answer a hybrid_timeline range.
+    The leading layer is the coarsest one that fits the range width: L3 yearly summaries
+    for ranges of at least settings.timeline_year_days, L2 monthly for
+    timeline_month_days, otherwise L1 weekly. Finer layers only fill periods the coarser
+    ones don't cover (e.g. this year's months before its yearly summary exists).
+    Raw L0 messages are read as keyword hits (more of them for short ranges), and as a
+    bounded fallback for the days no summary covers (the open week, periods that were
+    never summarized).
+    """
+    def __init__(self):
+        self._fetchers = {
+            "year": memory_service.get_yearly_summaries_by_range,
+            "month": memory_service.get_monthly_summaries_by_range,
+            "week": memory_service.get_weekly_summaries_by_range,
+        }
+
+    def plan(self, start_date: str, end_date: str, keywords: list) -> dict:
+        """{"levels": summary levels to read (coarsest first), "keyword_limit": L0 keyword hits to read (0 = none)}"""
+        days = (date.fromisoformat(end_date) - date.fromisoformat(start_date)).days + 1
+        if days >= settings.timeline_year_days:
+            top = "year"
+        elif days >= settings.timeline_month_days:
+            top = "month"
+        else:
+            top = "week"
+
+        if days <= settings.timeline_raw_days:
+            keyword_limit = settings.timeline_raw_limit
+        elif keywords:
+            keyword_limit = settings.timeline_wide_raw_limit
+        else:
+            keyword_limit = 0
+
+        plan = {"levels": LEVELS[LEVELS.index(top):], "keyword_limit": keyword_limit}
+        print(f"[timeline] {start_date}..{end_date} ({days}d): layers={','.join(plan['levels'])} keyword_raw={keyword_limit}")
+        return plan
+
+    def retrieve(self, user_id: str, start_date: str, end_date: str, keywords: list) -> dict:
+        """
+        Blocking: summaries for the range, L0 keyword hits, and - if there were no hits -
+        raw messages for the days no summary covers.
+        Returns {"summaries": [(level, period_start, row)], "raw": [{"timestamp", "role", "message"}]}.
+        """
+        plan = self.plan(start_date, end_date, keywords)
+        picked = self.summaries(user_id, start_date, end_date, plan["levels"])
+
+        raw = []
+        if plan["keyword_limit"]:
+            raw = memory_service.search_memories_in_range(user_id, start_date, end_date, keywords, plan["keyword_limit"])
+        if not raw:
+            gaps = self.uncovered(start_date, end_date, picked)
+            if gaps:
+                # Share the budget between gaps (usually one or two)
+                per_gap = max(1, settings.timeline_gap_raw_limit // len(gaps))
+                for gap_start, gap_end in gaps:
+                    raw.extend(memory_service.get_memories_by_date_range(user_id, gap_start, gap_end, per_gap, format_result=False))
+                print(f"[timeline] {len(gaps)} uncovered span(s) -> {len(raw)} raw messages")
+        return {"summaries": picked, "raw": raw}
+
+    def summaries(self, user_id: str, start_date: str, end_date: str, levels: tuple) -> list:
+        """
+        Summaries overlapping the range, coarsest first; a finer summary is skipped when a
+        coarser one already covers its period. Returns [(level, period_start, summary_row)].
+        """
+        start = date.fromisoformat(start_date)
+        covered = []  # (start, end) of periods already picked, ISO strings
+        picked = []
+        for level in levels:
+            aligned_start = period_start_of(level, start).isoformat()
+            for row in self._fetchers[level](user_id, aligned_start, end_date):
+                row_start = row[f"{level}_start"]
+                if any(covered_start <= row_start <= covered_end for covered_start, covered_end in covered):
+                    continue
+                covered.append((row_start, period_end(level, date.fromisoformat(row_start)).isoformat()))
+                picked.append((level, row_start, row))
+        return picked
+
+    @staticmethod
+    def uncovered(start_date: str, end_date: str, picked: list) -> list:
+        """[(start, end)] spans of the range (ISO dates, inclusive) that no picked summary covers."""
+        periods = sorted(
+            (date.fromisoformat(period_start), period_end(level, date.fromisoformat(period_start)))
+            for level, period_start, _ in picked
+        )
+        gaps = []
+        cursor, end = date.fromisoformat(start_date), date.fromisoformat(end_date)
+        for period_start, period_last in periods:
+            if period_start > cursor:
+                gaps.append((cursor, min(period_start - timedelta(days=1), end)))
+            cursor = max(cursor, period_last + timedelta(days=1))
+            if cursor > end:
+                break
+        if cursor <= end:
+            gaps.append((cursor, end))
+        return [(gap_start.isoformat(), gap_end.isoformat()) for gap_start, gap_end in gaps if gap_start <= gap_end]
+
+    @staticmethod
+    def format_summaries(picked: list) -> str:
+        return "\n".join(f"[{period_start} {LEVEL_LABELS[level]}] {row['summary']}" for level, period_start, row in picked)
+
+timeline_planner = TimelinePlanner()
@@ -0,0 +1,83 @@
+import re
+import threading
+from app.config import settings
+
+try:
+    from tokenizers import Tokenizer  # installed with chromadb; optional here
+except ImportError:
+    Tokenizer = None
+
+# Offline token estimate for DeepSeek-style BPE vocabularies: roughly 0.6 tokens per
+# CJK character and 0.3 per other character. Good enough for budgeting prompts and
+# rate limits without a network call or a tokenizer dependency.
+CJK_TOKENS_PER_CHAR = 0.6
+OTHER_TOKENS_PER_CHAR = 0.3
+
+_CJK = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return int(cjk * CJK_TOKENS_PER_CHAR + (len(text) - cjk) * OTHER_TOKENS_PER_CHAR) + 1
+
+_tokenizer = None
+_tokenizer_loaded = False
+_tokenizer_lock = threading.Lock()
+
+def _local_tokenizer():
+    """The tokenizer.json at settings.tokenizer_path (e.g. DeepSeek's), if configured and loadable."""
+    global _tokenizer, _tokenizer_loaded
+    if not _tokenizer_loaded:
+        with _tokenizer_lock:
+            if not _tokenizer_loaded:
+                path = settings.tokenizer_path
+                if path and Tokenizer is not None:
+                    try:
+                        _tokenizer = Tokenizer.from_file(path)
+                    except Exception as e:
+                        print(f"Could not load tokenizer {path}, using estimates: {e}")
+                _tokenizer_loaded = True
+    return _tokenizer
+
+def count_tokens(text: str) -> int:
+    """Exact count with the local tokenizer when one is configured, otherwise estimate_tokens()."""
+    if not text:
+        return 0
+    tokenizer = _local_tokenizer()
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, add_special_tokens=False).ids)
+    return estimate_tokens(text)
+
+def truncate_to_tokens(text: str, max_tokens: int, counter=estimate_tokens) -> str:
+    """Cut text so counter(result) <= max_tokens (keeps the beginning)."""
+    if counter(text) <= max_tokens:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if counter(text[:mid]) <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low]
+
+def token_windows(lines, max_tokens: int):
+    """
+    Group an iterable of lines into consecutive windows of at most max_tokens each.
+    Lazy: windows are yielded as soon as they fill, so callers can stream large inputs.
+    A single line over the budget is truncated to fit its own window.
+    """
+    window, used = [], 0
+    for line in lines:
+        cost = estimate_tokens(line) + 1  # + newline
+        if cost > max_tokens:
+            line = truncate_to_tokens(line, max_tokens - 1)
+            cost = max_tokens
+        if window and used + cost > max_tokens:
+            yield window
+            window, used = [], 0
+        window.append(line)
+        used += cost
+    if window:
+        yield window
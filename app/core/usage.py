@@ -0,0 +1,59 @@
+import threading
+from app.db.redis_client import async_redis_client
+
+class PromptCacheTelemetry:
+    """
+    Records DeepSeek's prompt-cache usage fields (prompt_cache_hit_tokens /
+    prompt_cache_miss_tokens) from every chat completion.
+    Per-user totals live in a Redis hash chat:{user_id}:prompt_cache so they are shared
+    across workers; process-wide totals are kept in memory for /api/metrics.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = {"requests": 0, "hit_tokens": 0, "miss_tokens": 0, "completion_tokens": 0}
+
+    async def record(self, user_id: str, usage):
+        if usage is None:
+            return
+        hit = getattr(usage, "prompt_cache_hit_tokens", None) or 0
+        miss = getattr(usage, "prompt_cache_miss_tokens", None)
+        if miss is None:
+            # Providers without cache fields: count the whole prompt as a miss
+            miss = (getattr(usage, "prompt_tokens", 0) or 0) - hit
+        completion = getattr(usage, "completion_tokens", 0) or 0
+
+        with self._lock:
+            self._totals["requests"] += 1
+            self._totals["hit_tokens"] += hit
+            self._totals["miss_tokens"] += miss
+            self._totals["completion_tokens"] += completion
+
+        try:
+            pipe = async_redis_client.pipeline(transaction=False)
+            key = f"chat:{user_id}:prompt_cache"
+            pipe.hincrby(key, "requests", 1)
+            pipe.hincrby(key, "hit_tokens", hit)
+            pipe.hincrby(key, "miss_tokens", miss)
+            pipe.hincrby(key, "completion_tokens", completion)
+            await pipe.execute()
+        except Exception as e:
+            print(f"Prompt cache telemetry error: {e}")
+        print(f"[usage] {user_id} prompt_cache hit={hit} miss={miss} ({self._rate(hit, miss):.0%} hit) completion={completion}")
+
+    async def user_stats(self, user_id: str) -> dict:
+        raw = await async_redis_client.hgetall(f"chat:{user_id}:prompt_cache")
+        stats = {key: int(value) for key, value in raw.items()}
+        stats["hit_rate"] = self._rate(stats.get("hit_tokens", 0), stats.get("miss_tokens", 0))
+        return stats
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._totals)
+        stats["hit_rate"] = self._rate(stats["hit_tokens"], stats["miss_tokens"])
+        return stats
+
+    @staticmethod
+    def _rate(hit: int, miss: int) -> float:
+        return hit / (hit + miss) if (hit + miss) else 0.0
+
+prompt_cache_telemetry = PromptCacheTelemetry()
@@ -0,0 +1,77 @@
+from datetime import date, timedelta
+from app.db.sqlite import get_db_connection
+
+class ConversationStats:
+    """
+    Reads of the per-user rollup tables (conversation_daily_stats, conversation_hourly_stats,
+    conversation_user_stats) that triggers keep up to date on every insert/delete.
+    Every call is a primary-key lookup, independent of how long the history is.
+    """
+    def overview(self, user_id: str) -> dict:
+        """Message totals by role plus first/last message time, or {} for a user without messages."""
+        cursor = get_db_connection().cursor()
+        cursor.execute(
+            "SELECT role, messages, first_ts, last_ts FROM conversation_user_stats WHERE user_id = ?",
+            (user_id,)
+        )
+        rows = cursor.fetchall()
+        if not rows:
+            return {}
+        return {
+            "messages": sum(row["messages"] for row in rows),
+            "by_role": {row["role"]: row["messages"] for row in rows},
+            "first_ts": min(row["first_ts"] for row in rows),
+            "last_ts": max(row["last_ts"] for row in rows),
+        }
+
+    def daily_counts(self, user_id: str, start_day: str, end_day: str) -> dict:
+        """{day: {role: messages}} for days in [start_day, end_day] that have messages."""
+        cursor = get_db_connection().cursor()
+        cursor.execute(
+            """
+            SELECT day, role, messages FROM conversation_daily_stats
+            WHERE user_id = ? AND day BETWEEN ? AND ?
+            ORDER BY day ASC
+            """,
+            (user_id, start_day, end_day)
+        )
+        counts = {}
+        for row in cursor.fetchall():
+            counts.setdefault(row["day"], {})[row["role"]] = row["messages"]
+        return counts
+
+    def hour_histogram(self, user_id: str, role: str = "user") -> list:
+        """Messages per local hour of day (24 counts) for one role."""
+        cursor = get_db_connection().cursor()
+        cursor.execute(
+            "SELECT hour, messages FROM conversation_hourly_stats WHERE user_id = ? AND role = ?",
+            (user_id, role)
+        )
+        histogram = [0] * 24
+        for row in cursor.fetchall():
+            histogram[row["hour"]] = row["messages"]
+        return histogram
+
+    def digest(self, user_id: str, today: date = None) -> list:
+        """Answers to the common stats questions, as prompt lines for the sql_query route."""
+        overview = self.overview(user_id)
+        if not overview:
+            return []
+        today = today or date.today()
+        yesterday = today - timedelta(days=1)
+        days = self.daily_counts(user_id, yesterday.isoformat(), today.isoformat())
+        histogram = self.hour_histogram(user_id)
+        top_hours = sorted((hour for hour in range(24) if histogram[hour]), key=lambda hour: -histogram[hour])[:3]
+
+        lines = [
+            f"第一条消息: {overview['first_ts']}",
+            f"最近一条消息: {overview['last_ts']}",
+            f"累计消息: {overview['messages']} 条 (用户 {overview['by_role'].get('user', 0)} 条)",
+            f"今天用户消息: {days.get(today.isoformat(), {}).get('user', 0)} 条",
+            f"昨天用户消息: {days.get(yesterday.isoformat(), {}).get('user', 0)} 条",
+        ]
+        if top_hours:
+            lines.append("用户最常聊天的时段: " + ", ".join(f"{hour}点 ({histogram[hour]} 条)" for hour in top_hours))
+        return lines
+
+conversation_stats = ConversationStats()
@@ -0,0 +1,313 @@
+"""
+Versioned schema migrations.
+
+The applied version is stored in system_state under SCHEMA_VERSION_KEY.
+init_db() creates the base tables, then run_migrations() applies every
+migration newer than the stored version, in order, inside one transaction.
+Append new migrations to MIGRATIONS; never edit one that has shipped.
+"""
+import sqlite3
+from datetime import datetime
+
+SCHEMA_VERSION_KEY = "schema_version"
+
+def _m001_hot_path_indexes(cursor):
+    """Composite indexes for per-user lookups (history, summaries, timeline)."""
+    # get_recent_history: WHERE user_id = ? ORDER BY id DESC
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversations_user_id ON conversations (user_id, id)")
+    # *_summaries_by_range: WHERE user_id = ? AND <period>_start BETWEEN ? AND ?
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_weekly_summaries_user_week ON weekly_summaries (user_id, week_start)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_monthly_summaries_user_month ON monthly_summaries (user_id, month_start)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_yearly_summaries_user_year ON yearly_summaries (user_id, year_start)")
+    # memory_timeline lookups by day
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_memory_timeline_user_date ON memory_timeline (user_id, date_key)")
+
+def _m002_conversation_epoch(cursor):
+    """
+    Integer epoch next to the text timestamp, so date-range scans are index range seeks.
+    ts_epoch = strftime('%s', timestamp): the local wall-clock time read as UTC seconds,
+    which keeps it consistent with the local-time text column (see sqlite.local_ts_to_epoch).
+    """
+    cursor.execute("ALTER TABLE conversations ADD COLUMN ts_epoch INTEGER")
+    cursor.execute("UPDATE conversations SET ts_epoch = CAST(strftime('%s', timestamp) AS INTEGER)")
+    # Rows inserted without an explicit ts_epoch (e.g. DB default timestamp) get it filled in
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_conversations_ts_epoch
+    AFTER INSERT ON conversations
+    WHEN NEW.ts_epoch IS NULL
+    BEGIN
+        UPDATE conversations SET ts_epoch = CAST(strftime('%s', NEW.timestamp) AS INTEGER) WHERE id = NEW.id;
+    END
+    ''')
+    # get_memories_by_date_range: WHERE user_id = ? AND ts_epoch BETWEEN ? AND ?
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversations_user_epoch ON conversations (user_id, ts_epoch)")
+
+def _m003_conversations_fts(cursor):
+    """
+    External-content FTS5 index over conversations.message with the trigram tokenizer
+    (substring matching that works for Chinese without word segmentation).
+    Kept in sync by triggers; existing rows are backfilled with 'rebuild'.
+    """
+    try:
+        cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS conversations_fts USING fts5(
+            message,
+            content='conversations',
+            content_rowid='id',
+            tokenize='trigram'
+        )
+        ''')
+    except sqlite3.OperationalError as e:
+        # SQLite < 3.34 or built without FTS5: keyword search keeps using LIKE
+        print(f"FTS5 trigram index unavailable, keyword search falls back to LIKE: {e}")
+        return
+
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_conversations_fts_insert AFTER INSERT ON conversations BEGIN
+        INSERT INTO conversations_fts (rowid, message) VALUES (NEW.id, NEW.message);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_conversations_fts_delete AFTER DELETE ON conversations BEGIN
+        INSERT INTO conversations_fts (conversations_fts, rowid, message) VALUES ('delete', OLD.id, OLD.message);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_conversations_fts_update AFTER UPDATE OF message ON conversations BEGIN
+        INSERT INTO conversations_fts (conversations_fts, rowid, message) VALUES ('delete', OLD.id, OLD.message);
+        INSERT INTO conversations_fts (rowid, message) VALUES (NEW.id, NEW.message);
+    END
+    ''')
+    # One-time backfill of existing rows
+    cursor.execute("INSERT INTO conversations_fts (conversations_fts) VALUES ('rebuild')")
+
+# (level, table, period column) for the L1/L2/L3 summary tables
+SUMMARY_TABLES = [
+    ("week", "weekly_summaries", "week_start"),
+    ("month", "monthly_summaries", "month_start"),
+    ("year", "yearly_summaries", "year_start"),
+]
+
+def _m004_summary_ledger(cursor):
+    """
+    One summary per (user, period): drop duplicates left by repeated runs (keeping the
+    newest, and its timeline rows), make the period indexes unique so writes can upsert,
+    and add the summary_jobs ledger that catch-up uses to find missing periods.
+    """
+    for level, table, period_column in SUMMARY_TABLES:
+        stale = f"SELECT id FROM {table} WHERE id NOT IN (SELECT MAX(id) FROM {table} GROUP BY user_id, {period_column})"
+        cursor.execute(f"DELETE FROM memory_timeline WHERE memory_id IN (SELECT 'summary_{level}_' || id FROM ({stale}))")
+        cursor.execute(f"DELETE FROM {table} WHERE id IN ({stale})")
+        index = f"idx_{table}_user_{level}"
+        cursor.execute(f"DROP INDEX IF EXISTS {index}")
+        cursor.execute(f"CREATE UNIQUE INDEX {index} ON {table} (user_id, {period_column})")
+
+    # Timeline rows are replaced per summary (memory_id) when a period is regenerated
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_memory_timeline_user_memory ON memory_timeline (user_id, memory_id)")
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS summary_jobs (
+        user_id TEXT,
+        level TEXT, -- 'week' | 'month' | 'year'
+        period_start DATE,
+        status TEXT, -- 'running' | 'done' | 'empty' | 'failed'
+        summary_id INTEGER,
+        attempts INTEGER DEFAULT 0,
+        error TEXT,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, level, period_start)
+    )
+    ''')
+    # Summaries that already exist count as done
+    for level, table, period_column in SUMMARY_TABLES:
+        cursor.execute(f'''
+        INSERT OR IGNORE INTO summary_jobs (user_id, level, period_start, status, summary_id, attempts, updated_at)
+        SELECT user_id, '{level}', {period_column}, 'done', id, 1, created_at FROM {table}
+        ''')
+
+def _timeline_entities_of(row: str) -> str:
+    """SELECT of the distinct normalized entities of a memory_timeline trigger row (NEW/OLD); bad JSON yields none."""
+    return f"""
+        SELECT DISTINCT lower(trim(value)) AS entity
+        FROM json_each(CASE WHEN json_valid({row}.entities) THEN {row}.entities ELSE '[]' END)
+        WHERE type = 'text' AND trim(value) != ''
+    """
+
+def _m005_timeline_entities(cursor):
+    """
+    Inverted index entity -> memory_timeline row, so entity recall is one index seek.
+    Entities are normalized with lower(trim()) (queries must use the same expression).
+    Kept in sync by triggers, like conversations_fts; existing rows are backfilled.
+    """
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS timeline_entities (
+        user_id TEXT,
+        entity TEXT, -- lower(trim(entity))
+        timeline_id INTEGER, -- memory_timeline.id
+        PRIMARY KEY (user_id, entity, timeline_id)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS trg_memory_timeline_entities_insert AFTER INSERT ON memory_timeline BEGIN
+        INSERT OR IGNORE INTO timeline_entities (user_id, entity, timeline_id)
+        SELECT NEW.user_id, entity, NEW.id FROM ({_timeline_entities_of("NEW")});
+    END
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS trg_memory_timeline_entities_delete AFTER DELETE ON memory_timeline BEGIN
+        DELETE FROM timeline_entities
+        WHERE user_id = OLD.user_id AND timeline_id = OLD.id AND entity IN ({_timeline_entities_of("OLD")});
+    END
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS trg_memory_timeline_entities_update AFTER UPDATE OF user_id, entities ON memory_timeline BEGIN
+        DELETE FROM timeline_entities
+        WHERE user_id = OLD.user_id AND timeline_id = OLD.id AND entity IN ({_timeline_entities_of("OLD")});
+        INSERT OR IGNORE INTO timeline_entities (user_id, entity, timeline_id)
+        SELECT NEW.user_id, entity, NEW.id FROM ({_timeline_entities_of("NEW")});
+    END
+    ''')
+    # One-time backfill of existing rows
+    cursor.execute('''
+    INSERT OR IGNORE INTO timeline_entities (user_id, entity, timeline_id)
+    SELECT t.user_id, lower(trim(j.value)), t.id
+    FROM memory_timeline t, json_each(t.entities) j
+    WHERE json_valid(t.entities) AND j.type = 'text' AND trim(j.value) != ''
+    ''')
+
+def _m006_conversation_stats(cursor):
+    """
+    Per-user rollups of conversations, so stats questions are primary-key lookups:
+    daily and hour-of-day message counts by role, and per-role totals with the first
+    and last message time. Kept in sync by insert/delete triggers (conversation rows
+    are otherwise never updated); existing rows are backfilled.
+    Days and hours come from the local-time text timestamp ('YYYY-MM-DD HH:MM:SS').
+    """
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS conversation_daily_stats (
+        user_id TEXT,
+        day DATE,
+        role TEXT,
+        messages INTEGER,
+        PRIMARY KEY (user_id, day, role)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS conversation_hourly_stats (
+        user_id TEXT,
+        hour INTEGER, -- 0-23, local time
+        role TEXT,
+        messages INTEGER,
+        PRIMARY KEY (user_id, hour, role)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS conversation_user_stats (
+        user_id TEXT,
+        role TEXT,
+        messages INTEGER,
+        first_ts TIMESTAMP,
+        last_ts TIMESTAMP,
+        PRIMARY KEY (user_id, role)
+    ) WITHOUT ROWID
+    ''')
+
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_conversations_stats_insert AFTER INSERT ON conversations BEGIN
+        INSERT INTO conversation_daily_stats (user_id, day, role, messages)
+        VALUES (NEW.user_id, substr(NEW.timestamp, 1, 10), NEW.role, 1)
+        ON CONFLICT (user_id, day, role) DO UPDATE SET messages = messages + 1;
+        INSERT INTO conversation_hourly_stats (user_id, hour, role, messages)
+        VALUES (NEW.user_id, CAST(substr(NEW.timestamp, 12, 2) AS INTEGER), NEW.role, 1)
+        ON CONFLICT (user_id, hour, role) DO UPDATE SET messages = messages + 1;
+        INSERT INTO conversation_user_stats (user_id, role, messages, first_ts, last_ts)
+        VALUES (NEW.user_id, NEW.role, 1, NEW.timestamp, NEW.timestamp)
+        ON CONFLICT (user_id, role) DO UPDATE SET
+            messages = messages + 1,
+            first_ts = min(first_ts, excluded.first_ts),
+            last_ts = max(last_ts, excluded.last_ts);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_conversations_stats_delete AFTER DELETE ON conversations BEGIN
+        UPDATE conversation_daily_stats SET messages = messages - 1
+        WHERE user_id = OLD.user_id AND day = substr(OLD.timestamp, 1, 10) AND role = OLD.role;
+        DELETE FROM conversation_daily_stats
+        WHERE user_id = OLD.user_id AND day = substr(OLD.timestamp, 1, 10) AND role = OLD.role AND messages <= 0;
+        UPDATE conversation_hourly_stats SET messages = messages - 1
+        WHERE user_id = OLD.user_id AND hour = CAST(substr(OLD.timestamp, 12, 2) AS INTEGER) AND role = OLD.role;
+        DELETE FROM conversation_hourly_stats
+        WHERE user_id = OLD.user_id AND hour = CAST(substr(OLD.timestamp, 12, 2) AS INTEGER) AND role = OLD.role AND messages <= 0;
+        UPDATE conversation_user_stats SET messages = messages - 1
+        WHERE user_id = OLD.user_id AND role = OLD.role;
+        DELETE FROM conversation_user_stats
+        WHERE user_id = OLD.user_id AND role = OLD.role AND messages <= 0;
+        -- Only a deleted first/last message needs a lookup (idx_conversations_user_epoch)
+        UPDATE conversation_user_stats SET
+            first_ts = (SELECT timestamp FROM conversations WHERE user_id = OLD.user_id AND role = OLD.role ORDER BY ts_epoch ASC LIMIT 1),
+            last_ts = (SELECT timestamp FROM conversations WHERE user_id = OLD.user_id AND role = OLD.role ORDER BY ts_epoch DESC LIMIT 1)
+        WHERE user_id = OLD.user_id AND role = OLD.role AND (first_ts = OLD.timestamp OR last_ts = OLD.timestamp);
+    END
+    ''')
+
+    # One-time backfill of existing rows
+    cursor.execute('''
+    INSERT OR REPLACE INTO conversation_daily_stats (user_id, day, role, messages)
+    SELECT user_id, substr(timestamp, 1, 10), role, COUNT(*) FROM conversations
+    GROUP BY user_id, substr(timestamp, 1, 10), role
+    ''')
+    cursor.execute('''
+    INSERT OR REPLACE INTO conversation_hourly_stats (user_id, hour, role, messages)
+    SELECT user_id, CAST(substr(timestamp, 12, 2) AS INTEGER), role, COUNT(*) FROM conversations
+    GROUP BY user_id, CAST(substr(timestamp, 12, 2) AS INTEGER), role
+    ''')
+    cursor.execute('''
+    INSERT OR REPLACE INTO conversation_user_stats (user_id, role, messages, first_ts, last_ts)
+    SELECT user_id, role, COUNT(*), MIN(timestamp), MAX(timestamp) FROM conversations
+    GROUP BY user_id, role
+    ''')
+
+# (version, description, function) - strictly increasing versions
+MIGRATIONS = [
+    (1, "hot path indexes", _m001_hot_path_indexes),
+    (2, "conversations.ts_epoch + range index", _m002_conversation_epoch),
+    (3, "conversations_fts trigram index", _m003_conversations_fts),
+    (4, "summary_jobs ledger + unique summary periods", _m004_summary_ledger),
+    (5, "timeline_entities inverted index", _m005_timeline_entities),
+    (6, "conversation stats rollups", _m006_conversation_stats),
+]
+
+def get_schema_version(cursor) -> int:
+    cursor.execute("SELECT value FROM system_state WHERE key = ?", (SCHEMA_VERSION_KEY,))
+    row = cursor.fetchone()
+    return int(row[0]) if row else 0
+
+def _set_schema_version(cursor, version: int):
+    now = datetime.now().isoformat()
+    cursor.execute(
+        "INSERT OR REPLACE INTO system_state (key, value, updated_at) VALUES (?, ?, ?)",
+        (SCHEMA_VERSION_KEY, str(version), now)
+    )
+
+def run_migrations(conn: sqlite3.Connection) -> int:
+    """
+    Apply pending migrations. Returns the resulting schema version.
+    BEGIN IMMEDIATE takes the write lock before reading the version, so
+    concurrent startups apply each migration exactly once.
+    """
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        current = get_schema_version(cursor)
+        for version, description, migrate in MIGRATIONS:
+            if version <= current:
+                continue
+            migrate(cursor)
+            _set_schema_version(cursor, version)
+            current = version
+            print(f"Applied schema migration {version}: {description}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return current
@@ -1,4 +1,5 @@
 import redis
+import redis.asyncio as aioredis
 import os
 
 # Default Redis configuration
@@ -6,6 +7,7 @@ REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 REDIS_DB = int(os.getenv("REDIS_DB", 0))
 
+# Sync client: used by scheduler / worker threads
 redis_client = redis.Redis(
     host=REDIS_HOST,
     port=REDIS_PORT,
@@ -13,8 +15,23 @@ redis_client = redis.Redis(
     decode_responses=True
 )
 
+# Async client: used on the event loop (chat hot path)
+async_redis_client = aioredis.Redis(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    db=REDIS_DB,
+    decode_responses=True
+)
+
 def check_redis_connection():
     try:
         return redis_client.ping()
     except redis.ConnectionError:
         return False
+
+async def close_async_redis():
+    """Close the async connection pool (called from app shutdown)."""
+    try:
+        await async_redis_client.aclose()
+    except Exception as e:
+        print(f"Error closing async Redis client: {e}")
@@ -1,10 +1,88 @@
+import calendar
 import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
 from app.config import settings
+from app.db.migrations import run_migrations
+
+class ConnectionManager:
+    """
+    Reusable per-thread SQLite connections.
+    Each thread (event-loop worker threads, scheduler, background tasks) keeps one
+    long-lived connection, so a chat turn no longer pays connect + pragma + close.
+    WAL mode lets readers proceed while the summarizer is writing.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=settings.sqlite_busy_timeout_ms / 1000,
+            check_same_thread=False  # Only used by its owning thread; allows close_all() at shutdown
+        )
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")  # Safe with WAL, fsync only at checkpoints
+        cursor.execute(f"PRAGMA cache_size=-{int(settings.sqlite_cache_size_kb)}")
+        cursor.execute(f"PRAGMA mmap_size={int(settings.sqlite_mmap_size)}")
+        cursor.execute(f"PRAGMA busy_timeout={int(settings.sqlite_busy_timeout_ms)}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+        return conn
+
+    def get_connection(self) -> sqlite3.Connection:
+        """Return this thread's connection, opening it on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Yield this thread's connection; commit on success, rollback on error."""
+        conn = self.get_connection()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def close_all(self):
+        """Close every connection opened by any thread (app shutdown)."""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception as e:
+                print(f"Error closing SQLite connection: {e}")
+        self._local = threading.local()
+
+connection_manager = ConnectionManager(settings.sqlite_path)
 
 def init_db():
-    conn = sqlite3.connect(settings.sqlite_path)
-    cursor = conn.cursor()
-    
+    conn = connection_manager.get_connection()
+    # Another worker may be mid-migration (an FTS rebuild or stats backfill can take minutes):
+    # wait for its write lock instead of failing with "database is locked"
+    conn.execute(f"PRAGMA busy_timeout={int(settings.sqlite_migration_busy_timeout_ms)}")
+    try:
+        with connection_manager.transaction() as conn:
+            _create_tables(conn.cursor())
+        run_migrations(conn)
+    finally:
+        conn.execute(f"PRAGMA busy_timeout={int(settings.sqlite_busy_timeout_ms)}")
+
+def _create_tables(cursor):
     # Create users table
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS users (
@@ -93,11 +171,36 @@ def init_db():
         updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     )
     ''')
-    
-    conn.commit()
-    conn.close()
 
 def get_db_connection():
-    conn = sqlite3.connect(settings.sqlite_path)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """
+    Return the calling thread's shared connection.
+    Do not close it; use db_transaction() for writes so they commit/rollback as a unit.
+    """
+    return connection_manager.get_connection()
+
+def db_transaction():
+    """Context manager for a write transaction on the calling thread's connection."""
+    return connection_manager.transaction()
+
+def close_all_connections():
+    connection_manager.close_all()
+
+# trigram tokenizer needs at least 3 characters to build a query term
+FTS_MIN_TERM_LENGTH = 3
+
+def table_exists(name: str) -> bool:
+    cursor = get_db_connection().cursor()
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,))
+    return cursor.fetchone() is not None
+
+def fts_match_expression(terms: list) -> str:
+    """Build an FTS5 MATCH expression that matches ANY term as a literal phrase."""
+    return " OR ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+def local_ts_to_epoch(ts: str) -> int:
+    """
+    "YYYY-MM-DD HH:MM:SS" (local wall clock) -> integer seconds.
+    Matches SQLite's strftime('%s', ts), which is how conversations.ts_epoch is defined.
+    """
+    return calendar.timegm(datetime.strptime(ts, "%Y-%m-%d %H:%M:%S").timetuple())
@@ -0,0 +1,79 @@
+from app.config import settings
+from app.db.sqlite import get_db_connection, db_transaction
+
+class SummaryLedger:
+    """
+    summary_jobs bookkeeping: one row per (user, level, period_start) with its status.
+    'done' and 'empty' are final, so re-running a period is a no-op; 'failed' periods
+    are retried by catch-up until MAX_ATTEMPTS. 'running' marks a period claimed by a
+    run in progress; one left by a crash is treated like a failure once it is older
+    than settings.summary_claim_timeout.
+    """
+    FINAL_STATUSES = ("done", "empty")
+    MAX_ATTEMPTS = 3
+
+    def claim(self, user_id: str, level: str, period_start: str) -> bool:
+        """
+        Atomically take a period for generation: True unless it is final or another run
+        (the startup catch-up, a cron job, an old leader) is generating it right now.
+        A 'running' claim older than settings.summary_claim_timeout is taken over.
+        """
+        with db_transaction() as conn:
+            cursor = conn.execute(
+                """
+                INSERT INTO summary_jobs (user_id, level, period_start, status, attempts, updated_at)
+                VALUES (?, ?, ?, 'running', 1, CURRENT_TIMESTAMP)
+                ON CONFLICT (user_id, level, period_start) DO UPDATE SET
+                    status = 'running', attempts = attempts + 1, error = NULL, updated_at = CURRENT_TIMESTAMP
+                WHERE status NOT IN ('done', 'empty', 'running')
+                   OR (status = 'running' AND updated_at < datetime('now', ?))
+                """,
+                (user_id, level, period_start, f"-{int(settings.summary_claim_timeout)} seconds")
+            )
+            return cursor.rowcount == 1
+
+    def mark_finished(self, user_id: str, level: str, period_start: str, status: str, summary_id: int = None, error: str = None):
+        with db_transaction() as conn:
+            conn.execute(
+                """
+                UPDATE summary_jobs SET status = ?, summary_id = ?, error = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE user_id = ? AND level = ? AND period_start = ?
+                """,
+                (status, summary_id, error, user_id, level, period_start)
+            )
+
+    def last_final_periods(self, level: str) -> dict:
+        """{user_id: latest period_start with a final status} for one level."""
+        cursor = get_db_connection().cursor()
+        cursor.execute(
+            f"""
+            SELECT user_id, MAX(period_start) AS period_start FROM summary_jobs
+            WHERE level = ? AND status IN ({','.join('?' * len(self.FINAL_STATUSES))})
+            GROUP BY user_id
+            """,
+            (level, *self.FINAL_STATUSES)
+        )
+        return {row["user_id"]: row["period_start"] for row in cursor.fetchall()}
+
+    def retryable(self, level: str) -> list:
+        """(user_id, period_start) of failed or interrupted periods that still have attempts left."""
+        cursor = get_db_connection().cursor()
+        cursor.execute(
+            """
+            SELECT user_id, period_start FROM summary_jobs
+            WHERE level = ? AND status IN ('failed', 'running') AND attempts < ?
+            """,
+            (level, self.MAX_ATTEMPTS)
+        )
+        return [(row["user_id"], row["period_start"]) for row in cursor.fetchall()]
+
+    def stats(self) -> dict:
+        """{level: {status: count}}"""
+        cursor = get_db_connection().cursor()
+        cursor.execute("SELECT level, status, COUNT(*) AS n FROM summary_jobs GROUP BY level, status")
+        stats = {}
+        for row in cursor.fetchall():
+            stats.setdefault(row["level"], {})[row["status"]] = row["n"]
+        return stats
+
+summary_ledger = SummaryLedger()
@@ -0,0 +1,53 @@
+import time
+from app.config import settings
+from app.db.redis_client import redis_client, async_redis_client
+
+class UserTombstones:
+    """
+    User deletions recorded in Redis (user_deleted:{user_id} -> deletion time, epoch seconds),
+    so every worker and host sees them, not only the one that handled the DELETE.
+    Queued writes (write-behind rows, embedding fragments) and cached reads (retrieval
+    results, collection handles) carry the wall-clock time they were created and are
+    dropped when that is not later than the user's tombstone.
+    Tombstones expire after settings.user_tombstone_ttl. Redis errors fail open
+    (nothing is treated as deleted), like the other Redis-backed caches.
+    """
+    @staticmethod
+    def _key(user_id: str) -> str:
+        return f"user_deleted:{user_id}"
+
+    async def mark(self, user_id: str) -> float:
+        deleted_at = time.time()
+        try:
+            await async_redis_client.set(self._key(user_id), deleted_at, ex=settings.user_tombstone_ttl)
+        except Exception as e:
+            print(f"[tombstone] could not record deletion of {user_id}: {e}")
+        return deleted_at
+
+    def deleted_at(self, user_ids) -> dict:
+        """Blocking: {user_id: deletion time} for the given users that have a tombstone."""
+        user_ids = list(set(user_ids))
+        if not user_ids:
+            return {}
+        try:
+            values = redis_client.mget([self._key(user_id) for user_id in user_ids])
+        except Exception as e:
+            print(f"[tombstone] lookup error: {e}")
+            return {}
+        return {user_id: float(value) for user_id, value in zip(user_ids, values) if value is not None}
+
+    async def deleted_at_async(self, user_id: str):
+        """Deletion time of one user, or None."""
+        try:
+            value = await async_redis_client.get(self._key(user_id))
+        except Exception as e:
+            print(f"[tombstone] lookup error: {e}")
+            return None
+        return float(value) if value is not None else None
+
+    @staticmethod
+    def is_stale(created_at: float, deleted_at) -> bool:
+        """Whether something created at `created_at` predates the user's deletion."""
+        return deleted_at is not None and created_at <= deleted_at
+
+user_tombstones = UserTombstones()
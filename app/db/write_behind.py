@@ -0,0 +1,230 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import deque
+from app.config import settings
+from app.db.sqlite import db_transaction, local_ts_to_epoch
+from app.db.user_tombstones import user_tombstones
+
+class WriteBehindQueue:
+    """
+    Write-behind persistence for hot-path inserts (conversations, memory timeline).
+    Callers enqueue and return immediately; a writer thread groups pending rows into
+    one transaction per flush, triggered by batch size or time window.
+    Rows not yet flushed stay visible through pending_conversations(), which the
+    history read path merges in, so a user's own recent messages are never missing.
+    When a batch fails its rows are retried one per transaction, so a bad row only holds
+    back itself; after MAX_ATTEMPTS it is dropped and appended to settings.write_behind_failed_path.
+    Rows queued before their user was deleted (by any worker, see user_tombstones) are discarded.
+    """
+    MAX_ATTEMPTS = 3
+
+    def __init__(self):
+        self._items = deque()
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()  # one writer at a time (thread or explicit flush)
+        self._thread = None
+        self._running = False
+        self._flushes = 0
+        self._rows_written = 0
+        self._rows_dropped = 0
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        """Stop the writer thread and flush everything still pending (app shutdown)."""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+        print(f"Write-behind stopped: {self._flushes} flushes, {self._rows_written} rows written")
+
+    # --- Producers ---
+
+    def enqueue_conversation(self, user_id: str, role: str, message: str, timestamp: str):
+        self._enqueue({
+            "kind": "conversation",
+            "user_id": user_id,
+            "role": role,
+            "message": message,
+            "timestamp": timestamp,
+            "attempts": 0,
+            "enqueued_at": time.time(),
+        })
+
+    def enqueue_timeline(self, user_id: str, date_key: str, memory_id: str, layer: int, importance: float, entities: list, content_preview: str = None):
+        self._enqueue({
+            "kind": "timeline",
+            "user_id": user_id,
+            "date_key": date_key,
+            "memory_id": memory_id,
+            "layer": layer,
+            "importance": importance,
+            "entities": entities,
+            "content_preview": content_preview,
+            "attempts": 0,
+            "enqueued_at": time.time(),
+        })
+
+    def _enqueue(self, item: dict):
+        with self._cond:
+            self._items.append(item)
+            running = self._running
+            if running and len(self._items) >= settings.write_behind_batch_size:
+                self._cond.notify_all()
+        if not running:
+            # No writer thread (scripts, startup before lifespan): write through
+            self.flush()
+
+    # --- Read consistency ---
+
+    def pending_conversations(self, user_id: str) -> list:
+        """Unflushed conversation rows for a user, as history dicts (chronological)."""
+        with self._cond:
+            return [
+                {"role": item["role"], "content": item["message"], "timestamp": item["timestamp"]}
+                for item in self._items
+                if item["kind"] == "conversation" and item["user_id"] == user_id
+            ]
+
+    # --- Writer ---
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+                if len(self._items) < settings.write_behind_batch_size:
+                    self._cond.wait(timeout=settings.write_behind_flush_interval)
+            self.flush()
+
+    def flush(self) -> int:
+        """Write every pending row in grouped transactions. Returns rows written."""
+        written = 0
+        with self._flush_lock:
+            while True:
+                with self._cond:
+                    if not self._items:
+                        break
+                    # Leave items in the deque until committed so readers still see them
+                    batch = list(self._items)[:settings.write_behind_batch_size]
+                try:
+                    self._write_batch(batch)
+                except sqlite3.OperationalError as e:
+                    # Locked / I/O error: the database is failing, not the rows; retry the batch later
+                    print(f"Write-behind flush error ({len(batch)} rows): {e}")
+                    time.sleep(0.1)
+                    break
+                except Exception as e:
+                    print(f"Write-behind flush error ({len(batch)} rows): {e}; retrying rows one by one")
+                    written += self._write_rows(batch)
+                    break
+                with self._cond:
+                    for _ in batch:
+                        self._items.popleft()
+                written += len(batch)
+                self._flushes += 1
+                self._rows_written += len(batch)
+        return written
+
+    def _write_rows(self, batch: list) -> int:
+        """
+        Retry a failed batch one row per transaction. Written rows leave the queue;
+        a row that fails again stays for the next flush until MAX_ATTEMPTS, then is dropped.
+        Returns rows written.
+        """
+        written = []
+        dropped = []
+        for item in batch:
+            try:
+                self._write_batch([item])
+            except sqlite3.OperationalError as e:
+                print(f"Write-behind row retry stopped: {e}")
+                break
+            except Exception as e:
+                item["attempts"] += 1
+                print(f"Write-behind {item['kind']} row for {item['user_id']} failed (attempt {item['attempts']}): {e}")
+                if item["attempts"] >= self.MAX_ATTEMPTS:
+                    dropped.append((item, str(e)))
+                continue
+            written.append(item)
+
+        with self._cond:
+            for item in written:
+                self._items.remove(item)
+            for item, _ in dropped:
+                self._items.remove(item)
+        self._rows_written += len(written)
+        if dropped:
+            self._dead_letter(dropped)
+        if len(written) < len(batch):
+            # Back off a little before the writer thread retries what is left
+            time.sleep(0.1)
+        return len(written)
+
+    def _dead_letter(self, dropped: list):
+        """Append rows that kept failing to settings.write_behind_failed_path (JSONL) for manual recovery."""
+        self._rows_dropped += len(dropped)
+        try:
+            with open(settings.write_behind_failed_path, "a", encoding="utf-8") as f:
+                for item, error in dropped:
+                    f.write(json.dumps({**item, "error": error}, ensure_ascii=False, default=str) + "\n")
+        except OSError as e:
+            print(f"Write-behind could not record dropped rows: {e}")
+        for item, _ in dropped:
+            print(f"Write-behind dropped {item['kind']} row for {item['user_id']} after {self.MAX_ATTEMPTS} attempts "
+                  f"(saved to {settings.write_behind_failed_path})")
+
+    def _write_batch(self, batch: list):
+        deleted = user_tombstones.deleted_at(item["user_id"] for item in batch)
+        if deleted:
+            live = [item for item in batch if not user_tombstones.is_stale(item["enqueued_at"], deleted.get(item["user_id"]))]
+            if len(live) < len(batch):
+                print(f"Write-behind discarded {len(batch) - len(live)} rows of deleted users")
+            batch = live
+        conversations = [item for item in batch if item["kind"] == "conversation"]
+        timeline = [item for item in batch if item["kind"] == "timeline"]
+
+        with db_transaction() as conn:
+            cursor = conn.cursor()
+            # Ensure users exist
+            cursor.executemany(
+                "INSERT OR IGNORE INTO users (user_id) VALUES (?)",
+                [(user_id,) for user_id in {item["user_id"] for item in conversations}]
+            )
+            cursor.executemany(
+                "INSERT INTO conversations (user_id, message, role, timestamp, ts_epoch) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (item["user_id"], item["message"], item["role"], item["timestamp"], local_ts_to_epoch(item["timestamp"]))
+                    for item in conversations
+                ]
+            )
+            cursor.executemany(
+                """
+                INSERT INTO memory_timeline
+                (user_id, date_key, memory_id, layer, importance, entities, content_preview)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                [
+                    (item["user_id"], item["date_key"], item["memory_id"], item["layer"], item["importance"],
+                     json.dumps(item["entities"]), item["content_preview"])
+                    for item in timeline
+                ]
+            )
+
+    def stats(self) -> dict:
+        with self._cond:
+            pending = len(self._items)
+        return {"pending": pending, "flushes": self._flushes, "rows_written": self._rows_written, "rows_dropped": self._rows_dropped}
+
+write_behind = WriteBehindQueue()
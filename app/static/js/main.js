@@ -259,9 +259,12 @@ document.addEventListener('DOMContentLoaded', async () => {
         
         console.log("Sending with flags:", contextFlags); // Debug
 
+        // Text received so far in this turn (used as interrupted context on abort)
+        let streamedText = "";
+
         try {
             interruptionController = new AbortController();
-            const response = await fetch('/api/chat', {
+            const response = await fetch('/api/chat/stream', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json'
@@ -274,25 +277,54 @@ document.addEventListener('DOMContentLoaded', async () => {
                 })
             });
 
-            // Stop animation once we get headers/response
-            
-            if (!response.ok) {
+            if (!response.ok || !response.body) {
                 throw new Error('Network response was not ok');
             }
 
-            const data = await response.json();
-            
-            // Check if backend performed recall
-            if (data.is_recalling) {
-                updateTypingText("对方陷入了回忆...");
-                await new Promise(r => setTimeout(r, 1500)); // Pause to show "Recalling" state
+            // Read Server-Sent Events from the response body
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            const bubbler = createStreamBubbler();
+            let sseBuffer = "";
+            let finished = false;
+
+            while (!finished) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                sseBuffer += decoder.decode(value, { stream: true });
+
+                // Frames are separated by a blank line
+                let boundary;
+                while ((boundary = sseBuffer.indexOf('\n\n')) !== -1) {
+                    const frame = parseSSEFrame(sseBuffer.slice(0, boundary));
+                    sseBuffer = sseBuffer.slice(boundary + 2);
+                    if (!frame) continue;
+
+                    if (frame.event === 'recalling') {
+                        // Backend picked a retrieval route
+                        updateTypingText("对方陷入了回忆...");
+                    } else if (frame.event === 'token') {
+                        updateTypingText("对方正在输入...");
+                        streamedText += frame.data.content;
+                        bubbler.push(frame.data.content);
+                    } else if (frame.event === 'done') {
+                        bubbler.finish(frame.data.timestamp_display);
+                        finished = true;
+                    } else if (frame.event === 'error') {
+                        throw new Error(frame.data.detail || 'Stream error');
+                    }
+                }
             }
-            
-            // Now switch to typing state
-            updateTypingText("对方正在输入...");
-            
-            // Start streaming simulation
-            await simulateStreaming(data.response, data.timestamp_display);
+
+            if (!finished) {
+                // Stream closed without a "done" event
+                bubbler.finish();
+            }
+
+            isAIResponding = false;
+            interruptionController = null;
+            showTyping(false);
+            updateSendButtonState();
 
         } catch (error) {
             console.error('Error:', error);
@@ -302,7 +334,9 @@ document.addEventListener('DOMContentLoaded', async () => {
             
             // Handle Abort (User Interruption) separately from Network Error
             if (error.name === 'AbortError') {
-                 console.log("Request aborted by user");
+                 console.log("Output interrupted by user");
+                 // Save what we had received so far so the AI knows where it was cut off
+                 if (streamedText) lastInterruptedContext = streamedText;
                  return; // Do not treat as network error
             }
 
@@ -383,73 +417,69 @@ document.addEventListener('DOMContentLoaded', async () => {
         return segments;
     }
 
-    async function simulateStreaming(fullText, timestampDisplay = null) {
-        interruptionController = new AbortController();
-        const signal = interruptionController.signal;
-        
-        // Use smart splitting to get message bubbles
-        const segments = smartSplit(fullText);
-        
+    // Parse one SSE frame ("event: x\ndata: {...}") into {event, data}
+    function parseSSEFrame(raw) {
+        let event = 'message';
+        let dataLines = [];
+        raw.split('\n').forEach(line => {
+            if (line.startsWith('event:')) {
+                event = line.slice(6).trim();
+            } else if (line.startsWith('data:')) {
+                dataLines.push(line.slice(5).trim());
+            }
+        });
+        if (dataLines.length === 0) return null;
         try {
-            updateTypingText("对方正在输入..."); // Step 3: Typing
-            
-            for (let i = 0; i < segments.length; i++) {
-                const segment = segments[i];
-                
-                if (signal.aborted) throw new Error('Interrupted');
+            return { event, data: JSON.parse(dataLines.join('\n')) };
+        } catch (e) {
+            console.error('Bad SSE frame', raw);
+            return null;
+        }
+    }
 
-                // 1. Show Typing Indicator for this segment
-                showTyping(true);
-                updateTypingText("对方正在输入...");
-                scrollToBottom();
+    // Turn a token stream into chat bubbles as soon as a segment is complete.
+    // Mirrors smartSplit: newline ends a bubble, long lines break at sentence enders.
+    function createStreamBubbler() {
+        let pending = "";
 
-                // 2. Calculate delay based on segment length (simulate reading/thinking/typing)
-                // Shorter for first message, longer for subsequent to simulate "typing" the next part
-                let typingDelay = 500 + Math.min(segment.length * 50, 2000); 
-                if (i === 0) typingDelay = 800; // First message comes out faster after "recalling"
-                
-                // Random variation
-                typingDelay += Math.random() * 500;
+        function emit(segment, timestampDisplay = null) {
+            if (segment.trim().length === 0) return;
+            showTyping(false);
+            appendMessage('ai', segment.trim(), timestampDisplay);
+            scrollToBottom();
+            showTyping(true);
+        }
 
-                await new Promise(r => setTimeout(r, typingDelay));
+        return {
+            push(delta) {
+                pending += delta;
 
-                if (signal.aborted) throw new Error('Interrupted');
+                // 1. Complete lines become bubbles
+                let newline;
+                while ((newline = pending.indexOf('\n')) !== -1) {
+                    emit(pending.slice(0, newline));
+                    pending = pending.slice(newline + 1);
+                }
 
-                // 3. Hide indicator and Show Message Bubble
-                showTyping(false);
-                appendMessage('ai', segment, timestampDisplay);
-                scrollToBottom();
-                
-                // 4. Small pause between bubbles if there are more
-                if (i < segments.length - 1) {
-                    await new Promise(r => setTimeout(r, 300 + Math.random() * 200));
+                // 2. Long running line: cut at the last sentence ender
+                if (pending.length >= 100) {
+                    const cut = Math.max(pending.lastIndexOf('。'), pending.lastIndexOf('！'), pending.lastIndexOf('？'));
+                    if (cut > 20) {
+                        emit(pending.slice(0, cut + 1));
+                        pending = pending.slice(cut + 1);
+                    }
                 }
+            },
+            finish(timestampDisplay = null) {
+                if (pending.trim().length > 0) {
+                    smartSplit(pending).forEach(segment => emit(segment, timestampDisplay));
+                }
+                pending = "";
+                showTyping(false);
             }
-        } catch (e) {
-            if (e.message === 'Interrupted') {
-                console.log("Output interrupted by user");
-                // Stop processing further segments
-                // Save context for next turn if we have processed at least one segment
-                // Wait, lastInterruptedContext should be what was *going to be said* but wasn't? 
-                // Or what was *already said*? 
-                // Requirement: "若被打断则该轮回复的剩余内容不再在界面中显示"
-                // And prompt: "用户在上一轮对话中打断了你的发言"
-                // Usually we want to know what was interrupted. 
-                // Since we don't have the full text easily accessible here as a variable outside loop (it is in fullText)
-                // Let's just save the fullText as context, maybe indicating it was cut off?
-                // Actually, if we want the AI to know "I was saying X and got cut off", X should be the full planned response?
-                // Or just the part that was shown?
-                // Let's save the *full text* that was planned, so the AI knows what it *intended* to say.
-                lastInterruptedContext = fullText;
-            }
-        } finally {
-            isAIResponding = false;
-            interruptionController = null;
-            showTyping(false);
-            updateSendButtonState();
-        }
+        };
     }
-    
+
     function appendMessage(role, text, timestampDisplay = null) {
         const msgDiv = document.createElement('div');
         msgDiv.className = `message ${role === 'user' ? 'user-message' : 'ai-message'}`;
@@ -3,9 +3,13 @@ from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
 from app.api.endpoints import router as api_router
-from app.db.sqlite import init_db, get_db_connection
+from app.db.sqlite import init_db, get_db_connection, db_transaction, close_all_connections
+from app.db.redis_client import close_async_redis
+from app.db.write_behind import write_behind
 from app.config import settings
 from app.core.summarizer import summarizer
+from app.core.embedding_queue import embedding_queue
+from app.core.leader import leader_election
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
 from contextlib import asynccontextmanager
@@ -17,15 +21,13 @@ scheduler = BackgroundScheduler()
 def record_system_event(event_key: str):
     """Record startup/shutdown timestamp to DB."""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        now = datetime.now().isoformat()
-        cursor.execute(
-            "INSERT OR REPLACE INTO system_state (key, value, updated_at) VALUES (?, ?, ?)",
-            (event_key, now, now)
-        )
-        conn.commit()
-        conn.close()
+        with db_transaction() as conn:
+            cursor = conn.cursor()
+            now = datetime.now().isoformat()
+            cursor.execute(
+                "INSERT OR REPLACE INTO system_state (key, value, updated_at) VALUES (?, ?, ?)",
+                (event_key, now, now)
+            )
         return datetime.fromisoformat(now)
     except Exception as e:
         print(f"Error recording system event {event_key}: {e}")
@@ -38,7 +40,6 @@ def get_last_system_event(event_key: str):
         cursor = conn.cursor()
         cursor.execute("SELECT value FROM system_state WHERE key = ?", (event_key,))
         row = cursor.fetchone()
-        conn.close()
         if row:
             return datetime.fromisoformat(row["value"])
         return None
@@ -46,72 +47,29 @@ def get_last_system_event(event_key: str):
         print(f"Error getting system event {event_key}: {e}")
         return None
 
-def check_missed_summaries():
-    """Check if we missed any summary schedules during downtime."""
-    print("Checking for missed summaries...")
-    last_shutdown = get_last_system_event("last_shutdown")
-    if not last_shutdown:
-        print("No last shutdown record found. Skipping missed summary check.")
-        return
-
-    now = datetime.now()
-    
-    # Check if a Sunday 3AM passed between shutdown and now
-    # Simple heuristic: If shutdown was before last Sunday 3AM and now is after, 
-    # AND we haven't run it yet (which we can't easily track without job history, 
-    # but running it again is idempotent-ish for weekly summary if date range is fixed).
-    # Better approach: Just run the summary logic. The summarizer logic usually checks data.
-    # Our summarizer generates summary for "last week".
-    # If we missed Sunday, we should run it now.
-    
-    # Check if "Sunday" occurred in [last_shutdown, now]
-    # This is a bit complex to calculate perfectly for all edge cases.
-    # Simplified logic: If (now - last_shutdown) > 7 days, definitely run.
-    # Or if today is e.g. Monday and last_shutdown was Saturday.
-    
-    # Let's use a robust way:
-    # If the scheduled job time (Sunday 3AM) falls within the downtime window.
-    # CronTrigger doesn't give us "next run time" from a past reference easily.
-    
-    # We will simply trigger a check. The summarizer generates summary for the *previous full week*.
-    # If we run it multiple times for the same week, it might duplicate or overwrite.
-    # Our `add_weekly_summary` inserts a new row. We should probably check if one exists first?
-    # For MVP Phase 2, let's just run it if downtime > 1 day or cross-weekend.
-    
-    # 1. Weekly Check
-    time_diff = now - last_shutdown
-    if time_diff.total_seconds() > 86400: # Down for more than a day
-        print("System was down for > 1 day. Triggering summary checks...")
-        summarizer.run_all_weekly_summaries()
-    elif last_shutdown.weekday() != 6 and now.weekday() == 0: # Shutdown before Sun, Up on Mon
-         print("System crossed Sunday during downtime. Triggering weekly summary...")
-         summarizer.run_all_weekly_summaries()
-
-    # 2. Monthly Check (If crossed the 1st of month)
-    # Check if month changed or year changed
-    if (now.year > last_shutdown.year) or (now.month > last_shutdown.month):
-        print("System crossed month boundary. Triggering monthly summary...")
-        summarizer.run_all_monthly_summaries()
-
-    # 3. Yearly Check (If crossed Jan 1st)
-    if now.year > last_shutdown.year:
-        print("System crossed year boundary. Triggering yearly summary...")
-        summarizer.run_all_yearly_summaries()
-
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup logic
     init_db()
+    write_behind.start()
+    embedding_queue.start()
     
     # Record Startup
     startup_time = record_system_event("last_startup")
     
-    # Check for missed summaries
-    check_missed_summaries()
+    # Only the elected leader runs summary jobs, so several workers/hosts don't
+    # generate the same summaries (a single process wins the lock on its first attempt).
+    # On election, catch up on summary periods missed during downtime (ledger-driven,
+    # idempotent); it runs in the scheduler's thread pool so startup isn't blocked on LLM calls.
+    leader_election.on_elected(lambda: scheduler.add_job(
+        leader_election.guard(summarizer.catch_up_missed_summaries),
+        id='summary_catch_up_job',
+        replace_existing=True
+    ))
     
     # Schedule Weekly Summary (Every Sunday at 3 AM)
     scheduler.add_job(
-        summarizer.run_all_weekly_summaries,
+        leader_election.guard(summarizer.run_all_weekly_summaries),
         CronTrigger(day_of_week='sun', hour=3, minute=0),
         id='weekly_summary_job',
         replace_existing=True
@@ -119,7 +77,7 @@ async def lifespan(app: FastAPI):
     
     # Schedule Monthly Summary (1st day of month at 3 AM)
     scheduler.add_job(
-        summarizer.run_all_monthly_summaries,
+        leader_election.guard(summarizer.run_all_monthly_summaries),
         CronTrigger(day=1, hour=3, minute=0),
         id='monthly_summary_job',
         replace_existing=True
@@ -127,19 +85,25 @@ async def lifespan(app: FastAPI):
 
     # Schedule Yearly Summary (Jan 1st at 3 AM)
     scheduler.add_job(
-        summarizer.run_all_yearly_summaries,
+        leader_election.guard(summarizer.run_all_yearly_summaries),
         CronTrigger(month=1, day=1, hour=3, minute=0),
         id='yearly_summary_job',
         replace_existing=True
     )
     
     scheduler.start()
+    leader_election.start()
     
     yield
     
     # Shutdown logic
     record_system_event("last_shutdown")
     scheduler.shutdown()
+    leader_election.stop()  # Release the lock so another instance takes over right away
+    embedding_queue.stop()  # Drain pending embeddings (journal the rest)
+    write_behind.stop()  # Flush batched inserts before closing connections
+    await close_async_redis()
+    close_all_connections()
 
 app = FastAPI(title=f"Personal Agent {settings.bot_name} - Phase 2", lifespan=lifespan)
 
@@ -155,4 +119,13 @@ async def read_root():
     return FileResponse("app/static/index.html")
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="127.0.0.1", port=8000, reload=True)
+    if settings.web_workers > 1 and settings.chroma_mode != "http":
+        # Each worker would open the embedded Chroma store on its own
+        raise SystemExit("WEB_WORKERS > 1 needs a Chroma server: set CHROMA_MODE=http (see CHROMA_HOST / CHROMA_PORT)")
+    uvicorn.run(
+        "main:app",
+        host=settings.host,
+        port=settings.port,
+        reload=settings.web_workers == 1,  # reload only works with a single worker
+        workers=settings.web_workers
+    )
@@ -0,0 +1,36 @@
+import os
+import tempfile
+
+import pytest
+
+# Tests never use a real Redis: point the clients at a closed port (before they are created)
+# and fail fast below; Redis-backed paths (sessions, tombstones, caches) fail open
+os.environ["REDIS_PORT"] = "1"
+
+from redis.asyncio.retry import Retry as AsyncRetry
+from redis.backoff import NoBackoff
+from redis.retry import Retry
+
+from app.config import settings
+from app.db.redis_client import redis_client, async_redis_client
+
+redis_client.set_retry(Retry(NoBackoff(), 0))
+async_redis_client.set_retry(AsyncRetry(NoBackoff(), 0))
+
+# app.core.memory opens its embedded Chroma store at import: keep it out of the working tree
+settings.chroma_path = tempfile.mkdtemp(prefix="chroma_test_")
+settings.embedding_journal_path = settings.chroma_path + "/embedding_journal.jsonl"
+
+import app.db.sqlite as sqlite_db
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """A fresh, fully migrated app.db in tmp_path; returns its read-write connection."""
+    path = tmp_path / "app.db"
+    monkeypatch.setattr(settings, "sqlite_path", path)
+    monkeypatch.setattr(settings, "write_behind_failed_path", tmp_path / "write_behind_failed.jsonl")
+    manager = sqlite_db.ConnectionManager(path)
+    monkeypatch.setattr(sqlite_db, "connection_manager", manager)
+    sqlite_db.init_db()
+    yield manager.get_connection()
+    manager.close_all()
@@ -0,0 +1,57 @@
+from app.db.conversation_stats import conversation_stats
+from app.db.sqlite import local_ts_to_epoch
+
+def _insert(db, user_id, role, timestamp):
+    cursor = db.execute(
+        "INSERT INTO conversations (user_id, message, role, timestamp, ts_epoch) VALUES (?, 'hi', ?, ?, ?)",
+        (user_id, role, timestamp, local_ts_to_epoch(timestamp))
+    )
+    db.commit()
+    return cursor.lastrowid
+
+def _delete(db, row_id):
+    db.execute("DELETE FROM conversations WHERE id = ?", (row_id,))
+    db.commit()
+
+def test_inserts_roll_up(db):
+    _insert(db, "u1", "user", "2026-10-12 09:15:00")
+    _insert(db, "u1", "user", "2026-10-12 21:40:00")
+    _insert(db, "u1", "assistant", "2026-10-12 21:40:05")
+    _insert(db, "u1", "user", "2026-10-13 21:05:00")
+    _insert(db, "u2", "user", "2026-10-13 21:06:00")
+
+    assert conversation_stats.overview("u1") == {
+        "messages": 4,
+        "by_role": {"user": 3, "assistant": 1},
+        "first_ts": "2026-10-12 09:15:00",
+        "last_ts": "2026-10-13 21:05:00",
+    }
+    assert conversation_stats.daily_counts("u1", "2026-10-12", "2026-10-13") == {
+        "2026-10-12": {"user": 2, "assistant": 1},
+        "2026-10-13": {"user": 1},
+    }
+    histogram = conversation_stats.hour_histogram("u1")
+    assert (histogram[9], histogram[21], sum(histogram)) == (1, 2, 3)
+
+def test_deleting_boundary_rows_recomputes_first_and_last(db):
+    first = _insert(db, "u1", "user", "2026-10-01 08:00:00")
+    _insert(db, "u1", "user", "2026-10-05 12:00:00")
+    last = _insert(db, "u1", "user", "2026-10-09 23:00:00")
+
+    _delete(db, first)
+    _delete(db, last)
+
+    overview = conversation_stats.overview("u1")
+    assert (overview["messages"], overview["first_ts"], overview["last_ts"]) == \
+        (1, "2026-10-05 12:00:00", "2026-10-05 12:00:00")
+    # Emptied days and hours disappear instead of lingering at zero
+    assert conversation_stats.daily_counts("u1", "2026-10-01", "2026-10-09") == {"2026-10-05": {"user": 1}}
+    assert db.execute("SELECT COUNT(*) FROM conversation_hourly_stats WHERE user_id = 'u1'").fetchone()[0] == 1
+
+def test_deleting_all_rows_clears_rollups(db):
+    row_ids = [_insert(db, "u1", "assistant", "2026-10-01 08:00:00") for _ in range(2)]
+    for row_id in row_ids:
+        _delete(db, row_id)
+    assert conversation_stats.overview("u1") == {}
+    for table in ("conversation_daily_stats", "conversation_hourly_stats", "conversation_user_stats"):
+        assert db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] == 0
@@ -0,0 +1,14 @@
+from app.core.memory import MemoryService
+
+def test_pending_rows_are_appended_once():
+    history = [
+        {"role": "user", "content": "hi", "timestamp": "2026-10-12 10:00:00"},
+        {"role": "assistant", "content": "hello", "timestamp": "2026-10-12 10:00:01"},
+    ]
+    pending = [
+        # Flushed between the pending snapshot and the SQLite read: in both, kept once
+        {"role": "assistant", "content": "hello", "timestamp": "2026-10-12 10:00:01"},
+        {"role": "user", "content": "still queued", "timestamp": "2026-10-12 10:00:05"},
+    ]
+    merged = MemoryService._merge_pending(history, pending)
+    assert [entry["content"] for entry in merged] == ["hi", "hello", "still queued"]
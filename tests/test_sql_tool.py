@@ -0,0 +1,62 @@
+import pytest
+
+from app.core.sql_tool import SQLQueryTool
+from app.db.sqlite import local_ts_to_epoch
+
+@pytest.fixture
+def tool(db):
+    for user_id, message in (("alice", "alice secret"), ("bob", "bob secret")):
+        timestamp = "2026-10-12 10:00:00"
+        db.execute(
+            "INSERT INTO conversations (user_id, message, role, timestamp, ts_epoch) VALUES (?, ?, 'user', ?, ?)",
+            (user_id, message, timestamp, local_ts_to_epoch(timestamp))
+        )
+    db.commit()
+    return SQLQueryTool()
+
+def _rejected(results):
+    return len(results) == 1 and results[0].startswith(("Error:", "SQL Execution Error:"))
+
+def test_reads_only_the_current_users_rows(tool):
+    results = tool.execute_query("alice", "SELECT message FROM conversations")
+    assert results == [str({"message": "alice secret"})]
+
+@pytest.mark.parametrize("sql", [
+    # Another user's rows: the per-user CTE shadows the table whatever the WHERE says
+    "SELECT message FROM conversations WHERE user_id = 'bob'",
+    "SELECT message FROM conversations WHERE user_id != 'alice'",
+])
+def test_other_users_rows_are_invisible(tool, sql):
+    assert tool.execute_query("alice", sql) == []
+
+@pytest.mark.parametrize("sql", [
+    # Schema-qualified names would bypass the CTEs
+    "SELECT message FROM main.conversations",
+    'SELECT message FROM "main".conversations',
+    "SELECT message FROM [main].conversations",
+    "SELECT message FROM temp.conversations",
+    "SELECT message FROM main.conversations WHERE user_id = 'bob'",  # indexed: passes the plan check
+    # Tables outside the allowlist
+    "SELECT name, sql FROM sqlite_master",
+    "SELECT * FROM sqlite_schema",
+    "SELECT * FROM users",
+    "SELECT * FROM conversations_fts",
+    # Not a single SELECT
+    "DELETE FROM conversations",
+    "SELECT 1; DELETE FROM conversations",
+    "PRAGMA table_info(conversations)",
+    "ATTACH DATABASE 'x.db' AS x",
+    # Forbidden functions
+    "SELECT load_extension('x')",
+])
+def test_rejected(tool, sql):
+    assert _rejected(tool.execute_query("alice", sql))
+
+def test_comment_cannot_hide_a_second_statement(tool):
+    assert _rejected(tool.execute_query("alice", "SELECT message FROM conversations -- \n; DELETE FROM conversations"))
+    assert tool.execute_query("alice", "SELECT message FROM conversations -- a comment; not code") == \
+        [str({"message": "alice secret"})]
+
+def test_rejections_are_counted(tool):
+    tool.execute_query("alice", "SELECT * FROM main.conversations")
+    assert tool.stats()["rejected"] == 1
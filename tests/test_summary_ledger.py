@@ -0,0 +1,21 @@
+from app.db.summary_ledger import summary_ledger
+
+def test_claim_is_exclusive_until_finished(db):
+    assert summary_ledger.claim("u1", "week", "2026-10-05")
+    # Startup catch-up and a cron job overlapping: only the first one generates
+    assert not summary_ledger.claim("u1", "week", "2026-10-05")
+    assert summary_ledger.claim("u1", "week", "2026-10-12")
+
+    summary_ledger.mark_finished("u1", "week", "2026-10-05", "failed", error="boom")
+    assert summary_ledger.claim("u1", "week", "2026-10-05")
+
+    summary_ledger.mark_finished("u1", "week", "2026-10-05", "done", summary_id=1)
+    assert not summary_ledger.claim("u1", "week", "2026-10-05")
+
+def test_stale_running_claim_is_taken_over(db):
+    assert summary_ledger.claim("u1", "month", "2026-09-01")
+    db.execute("UPDATE summary_jobs SET updated_at = datetime('now', '-1 day')")
+    db.commit()
+    assert summary_ledger.claim("u1", "month", "2026-09-01")
+    row = db.execute("SELECT status, attempts FROM summary_jobs").fetchone()
+    assert (row["status"], row["attempts"]) == ("running", 2)
@@ -0,0 +1,69 @@
+from datetime import date
+
+import pytest
+
+from app.core.time_rules import local_time_parser
+
+# Fixed "today": Wednesday 2026-10-14 (this week starts Monday 2026-10-12)
+TODAY = date(2026, 10, 14)
+
+CASES = [
+    # Today / yesterday
+    ("今天聊点什么", "2026-10-14", "2026-10-14"),
+    ("what did we do today", "2026-10-14", "2026-10-14"),
+    ("昨天我们聊了什么", "2026-10-13", "2026-10-13"),
+    ("yesterday", "2026-10-13", "2026-10-13"),
+    ("前天", "2026-10-12", "2026-10-12"),
+    # Weeks
+    ("上周我们说了什么", "2026-10-05", "2026-10-11"),
+    ("last week", "2026-10-05", "2026-10-11"),
+    ("这周", "2026-10-12", "2026-10-14"),
+    # Months and years
+    ("这个月", "2026-10-01", "2026-10-14"),
+    ("本月", "2026-10-01", "2026-10-14"),
+    ("this month", "2026-10-01", "2026-10-14"),
+    ("上个月", "2026-09-01", "2026-09-30"),
+    ("去年", "2025-01-01", "2025-12-31"),
+    ("今年", "2026-01-01", "2026-10-14"),
+    # N units ago / rolling windows
+    ("3天前", "2026-10-11", "2026-10-11"),
+    ("3 days ago", "2026-10-11", "2026-10-11"),
+    ("两周前", "2026-09-28", "2026-10-04"),
+    ("最近7天", "2026-10-08", "2026-10-14"),
+    # Explicit dates (a month/day without a year is its most recent occurrence)
+    ("2026-03-05", "2026-03-05", "2026-03-05"),
+    ("2026年3月5日", "2026-03-05", "2026-03-05"),
+    ("3月5日", "2026-03-05", "2026-03-05"),
+    ("11月3号", "2025-11-03", "2025-11-03"),
+    ("march 5", "2026-03-05", "2026-03-05"),
+    # Weekdays
+    ("上周三", "2026-10-07", "2026-10-07"),
+    ("周一", "2026-10-12", "2026-10-12"),
+    ("周五", "2026-10-09", "2026-10-09"),
+    ("last friday", "2026-10-09", "2026-10-09"),
+    ("this friday", "2026-10-16", "2026-10-16"),
+    # Same day in another year: the year modifier applies to the named day
+    ("去年的今天", "2025-10-14", "2025-10-14"),
+    ("去年今天我们在干嘛", "2025-10-14", "2025-10-14"),
+    ("前年的这一天", "2024-10-14", "2024-10-14"),
+    ("this day last year", "2025-10-14", "2025-10-14"),
+]
+
+def test_same_day_last_year_from_leap_day():
+    assert local_time_parser.parse("去年的今天", date(2028, 2, 29)) == {"start_date": "2027-02-28", "end_date": "2027-02-28"}
+
+@pytest.mark.parametrize("query,start_date,end_date", CASES)
+def test_parse(query, start_date, end_date):
+    assert local_time_parser.parse(query, TODAY) == {"start_date": start_date, "end_date": end_date}
+
+@pytest.mark.parametrize("query", [
+    "2月30日",      # impossible date: left to the LLM parser, not widened to February
+    "2026-02-30",
+    "你好呀",       # no time expression
+    "我今年25岁",   # a year word about age, not time
+    "你今年多大了",
+    "上周三和上周五",  # several separate expressions: not one range
+    "昨天和今天",
+])
+def test_unresolved(query):
+    assert local_time_parser.parse(query, TODAY) is None
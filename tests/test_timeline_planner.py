@@ -0,0 +1,18 @@
+from app.core.timeline_planner import TimelinePlanner
+
+def _week(start):
+    return ("week", start, {"summary": ""})
+
+def test_uncovered_spans_between_and_after_summaries():
+    picked = [_week("2026-09-28"), _week("2026-10-12")]  # the week of 10-05 was never summarized
+    assert TimelinePlanner.uncovered("2026-09-28", "2026-10-20", picked) == [
+        ("2026-10-05", "2026-10-11"),
+        ("2026-10-19", "2026-10-20"),
+    ]
+
+def test_coarser_summary_covers_finer_periods():
+    picked = [("month", "2026-09-01", {"summary": ""}), _week("2026-09-28")]
+    assert TimelinePlanner.uncovered("2026-09-10", "2026-10-04", picked) == []
+
+def test_nothing_summarized_is_one_gap():
+    assert TimelinePlanner.uncovered("2026-10-01", "2026-10-14", []) == [("2026-10-01", "2026-10-14")]
@@ -0,0 +1,75 @@
+import asyncio
+import json
+import sqlite3
+
+import pytest
+
+from app.config import settings
+from app.db.write_behind import WriteBehindQueue, write_behind
+
+def _messages(db, user_id):
+    return [row["message"] for row in db.execute("SELECT message FROM conversations WHERE user_id = ? ORDER BY id", (user_id,))]
+
+@pytest.fixture
+def queue(db):
+    """A queue in 'running' mode without its writer thread: rows stay pending until flush()."""
+    queue = WriteBehindQueue()
+    queue._running = True
+    return queue
+
+def test_rows_stay_readable_until_flushed(db, queue):
+    queue.enqueue_conversation("u1", "user", "hello", "2026-10-12 10:00:00")
+    assert _messages(db, "u1") == []
+    assert queue.pending_conversations("u1") == [{"role": "user", "content": "hello", "timestamp": "2026-10-12 10:00:00"}]
+    assert queue.flush() == 1
+    assert _messages(db, "u1") == ["hello"]
+    assert queue.pending_conversations("u1") == []
+
+def test_bad_row_only_holds_back_itself(db, queue):
+    queue.enqueue_conversation("u1", "user", "first", "2026-10-12 10:00:00")
+    queue.enqueue_conversation("u1", "user", "bad", "not a timestamp")
+    queue.enqueue_conversation("u1", "user", "third", "2026-10-12 10:01:00")
+
+    queue.flush()
+    assert _messages(db, "u1") == ["first", "third"]
+    assert queue.stats()["pending"] == 1
+
+    for _ in range(WriteBehindQueue.MAX_ATTEMPTS - 1):
+        queue.flush()
+    assert queue.stats()["pending"] == 0
+    assert queue.stats()["rows_dropped"] == 1
+    with open(settings.write_behind_failed_path, encoding="utf-8") as f:
+        dropped = [json.loads(line) for line in f]
+    assert [row["message"] for row in dropped] == ["bad"]
+
+def test_locked_database_is_not_charged_to_rows(db, queue, monkeypatch):
+    queue.enqueue_conversation("u1", "user", "hello", "2026-10-12 10:00:00")
+
+    def locked(batch):
+        raise sqlite3.OperationalError("database is locked")
+    with monkeypatch.context() as patch:
+        patch.setattr(queue, "_write_batch", locked)
+        for _ in range(WriteBehindQueue.MAX_ATTEMPTS + 1):
+            queue.flush()
+
+    assert queue.stats()["rows_dropped"] == 0
+    assert queue.flush() == 1
+    assert _messages(db, "u1") == ["hello"]
+
+def test_delete_flushes_queued_rows_before_deleting(db, monkeypatch):
+    from app.core.memory import memory_service
+
+    # Pending rows that would otherwise be written after the delete and bring the user back
+    monkeypatch.setattr(write_behind, "_running", True)
+    write_behind.enqueue_conversation("u1", "user", "hello", "2026-10-12 10:00:00")
+    write_behind.enqueue_timeline("u1", "2026-10-12", "m1", 0, 0.5, ["猫"], "hello")
+    write_behind.enqueue_conversation("u2", "user", "keep me", "2026-10-12 10:00:00")
+
+    asyncio.run(memory_service.delete_user_memory("u1"))
+
+    assert write_behind.stats()["pending"] == 0
+    write_behind.flush()
+    assert _messages(db, "u1") == []
+    assert db.execute("SELECT COUNT(*) FROM memory_timeline WHERE user_id = 'u1'").fetchone()[0] == 0
+    assert db.execute("SELECT COUNT(*) FROM users WHERE user_id = 'u1'").fetchone()[0] == 0
+    assert _messages(db, "u2") == ["keep me"]